@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Admission control for the startup of lunch-slave processes.
+
+Starting a lunch-slave on a remote host opens a SSH connection. Opening too
+many of them at once to the same host can make sshd refuse some of them
+(see MaxStartups in sshd_config) and overload small hosts. The master asks
+an L{AdmissionController} before it starts a lunch-slave.
+"""
+import collections
+
+from lunch import tokenbucket
+
+
+class AdmissionController(object):
+    """
+    Limits how many lunch-slave startups are in flight, per host and in
+    total, and how many can begin each second.
+
+    Pending startups wait in one FIFO queue per host. The hosts are served
+    in turn, so that a host with many commands does not delay the others.
+
+    A startup goes through these steps:
+     - enqueue(): it waits for its turn.
+     - grant(): it is allowed to begin. (it holds its slots)
+     - begin(): the lunch-slave is being started.
+     - release(): the lunch-slave is started, or failed to start.
+
+    A limit of 0 means no limit.
+    """
+    def __init__(self, max_per_host=0, max_total=0, rate=0.0, burst=None):
+        """
+        @param max_per_host: Maximum number of startups in flight for each host.
+        @type max_per_host: C{int}
+        @param max_total: Maximum number of startups in flight for all hosts.
+        @type max_total: C{int}
+        @param rate: Maximum number of startups per second.
+        @type rate: C{float}
+        @param burst: How many startups can begin at once when none began for a while. Defaults to the rate, or 1.
+        @type burst: C{int}
+        """
+        self.max_per_host = max_per_host
+        self.max_total = max_total
+        self.rate = rate
+        if burst is None:
+            burst = max(1, int(rate))
+        self.burst = burst
+        self._bucket = None # TokenBucket
+        if rate > 0:
+            self._bucket = tokenbucket.TokenBucket(rate, burst)
+        self._queues = collections.OrderedDict() # host: deque of keys
+        self._hosts = {} # key: host, for all the keys we know of
+        self._granted = set() # allowed to begin, but not begun yet
+        self._in_flight = set() # begun, but not released yet
+        self._per_host = collections.Counter() # host: granted + in flight
+        self.total_granted = 0
+        self.total_queued = 0
+
+    def is_enabled(self):
+        """
+        Returns whether there is any limit.
+        @rtype: C{bool}
+        """
+        return self.max_per_host > 0 or self.max_total > 0 or self.rate > 0
+
+    def is_granted(self, key):
+        return key in self._granted
+
+    def is_in_flight(self, key):
+        return key in self._in_flight
+
+    def is_queued(self, key):
+        return key in self._hosts and not self.is_granted(key) and \
+                not self.is_in_flight(key)
+
+    def enqueue(self, key, host):
+        """
+        Adds a startup at the end of the queue of its host.
+        Does nothing if it is already queued, granted or in flight.
+        """
+        if key in self._hosts:
+            return
+        self._hosts[key] = host
+        if host not in self._queues:
+            self._queues[host] = collections.deque()
+        self._queues[host].append(key)
+        self.total_queued += 1
+
+    def grant(self, now):
+        """
+        Grants as many queued startups as the limits allow, serving each
+        host in turn.
+        @param now: Time, in seconds since the epoch.
+        @rtype: C{list}
+        @return: The keys that were granted.
+        """
+        ret = []
+        while self._queues:
+            granted_one = False
+            for host in list(self._queues.keys()):
+                if self.max_total > 0 and \
+                        len(self._granted) + len(self._in_flight) >= self.max_total:
+                    return ret
+                if self._bucket is not None and not self._bucket.has_token(now):
+                    return ret
+                if self.max_per_host > 0 and \
+                        self._per_host[host] >= self.max_per_host:
+                    continue
+                queue = self._queues.pop(host)
+                key = queue.popleft()
+                if queue:
+                    self._queues[host] = queue # at the end: its turn is over
+                self._granted.add(key)
+                self._per_host[host] += 1
+                if self._bucket is not None:
+                    self._bucket.take(now)
+                self.total_granted += 1
+                ret.append(key)
+                granted_one = True
+            if not granted_one:
+                break
+        return ret
+
+    def begin(self, key):
+        """
+        The lunch-slave of a granted startup is being started.
+        """
+        if key in self._granted:
+            self._granted.remove(key)
+            self._in_flight.add(key)
+
+    def release(self, key):
+        """
+        Forgets about a startup, wherever it is, and frees its slots.
+        @return: Whether it was holding slots.
+        @rtype: C{bool}
+        """
+        host = self._hosts.pop(key, None)
+        if key in self._granted or key in self._in_flight:
+            self._granted.discard(key)
+            self._in_flight.discard(key)
+            self._per_host[host] -= 1
+            if self._per_host[host] <= 0:
+                del self._per_host[host]
+            return True
+        queue = self._queues.get(host)
+        if queue is not None and key in queue:
+            queue.remove(key)
+            if not queue:
+                del self._queues[host]
+        return False
+
+    def get_next_token_time(self, now):
+        """
+        Returns when the next startup can begin, as far as the rate is
+        concerned, or None if there is no rate limit.
+        @rtype: C{float}
+        """
+        if self._bucket is None:
+            return None
+        return self._bucket.get_next_token_time(now)
+
+    def get_queued(self):
+        """
+        Returns the keys that are waiting, in no particular order.
+        @rtype: C{list}
+        """
+        ret = []
+        for queue in self._queues.values():
+            ret.extend(queue)
+        return ret
+
+    def get_stats(self):
+        """
+        @rtype: C{dict}
+        """
+        return {
+            "queued": len(self.get_queued()),
+            "granted": len(self._granted),
+            "in_flight": len(self._in_flight),
+            "total_queued": self.total_queued,
+            "total_granted": self.total_granted,
+            }
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Budget of restarts, so that the commands that crash do not all restart at
+the same moments.
+
+Example : when a license server or a NFS share fails, hundreds of commands
+crash. When they all restart at once, they hammer it again as soon as it
+comes back. The master asks a L{RestartBudget} before it restarts a command.
+"""
+import collections
+
+from lunch import tokenbucket
+
+
+class RestartBudget(object):
+    """
+    Limits how many commands are restarted each minute, in total and on
+    each host.
+
+    The restarts over the budget are not dropped: they wait in one FIFO
+    queue, and are granted in order as the budget allows. A restart waiting
+    for a host that spent its budget does not delay the ones for the other
+    hosts.
+
+    A restart goes through these steps:
+     - enqueue(): it waits for its turn.
+     - grant(): it is allowed.
+     - use(): the command is restarted.
+    release() forgets about it, wherever it is.
+
+    A budget of 0 means no limit.
+    """
+    def __init__(self, per_minute=0, per_host_per_minute=0):
+        """
+        @param per_minute: How many restarts each minute, on all hosts.
+        @type per_minute: C{int}
+        @param per_host_per_minute: How many restarts each minute, on each host.
+        @type per_host_per_minute: C{int}
+        """
+        self.per_minute = per_minute
+        self.per_host_per_minute = per_host_per_minute
+        self._total = None # TokenBucket
+        if per_minute > 0:
+            self._total = tokenbucket.TokenBucket(per_minute / 60.0, per_minute)
+        self._per_host = {} # host: TokenBucket
+        self._queue = collections.OrderedDict() # key: host, in the order they came
+        self._granted = {} # key: host
+        self._throttled = set() # queued keys that already had to wait
+        self.total_restarts = 0
+        self.total_throttled = 0
+        self.throttled_per_host = collections.Counter()
+        self.throttled_per_key = collections.Counter()
+
+    def is_enabled(self):
+        """
+        Returns whether there is any limit.
+        @rtype: C{bool}
+        """
+        return self.per_minute > 0 or self.per_host_per_minute > 0
+
+    def is_granted(self, key):
+        return key in self._granted
+
+    def is_queued(self, key):
+        return key in self._queue
+
+    def enqueue(self, key, host):
+        """
+        Adds a restart at the end of the queue.
+        Does nothing if it is already queued or granted.
+        """
+        if key in self._queue or key in self._granted:
+            return
+        self._queue[key] = host
+
+    def grant(self, now):
+        """
+        Grants as many queued restarts as the budgets allow, in order.
+        The ones left in the queue are counted as throttled.
+        @param now: Time, in seconds since the epoch.
+        @rtype: C{list}
+        @return: The keys that were granted.
+        """
+        ret = []
+        for key, host in list(self._queue.items()):
+            if self._total is not None and not self._total.has_token(now):
+                break
+            bucket = self._get_host_bucket(host)
+            if bucket is not None and not bucket.has_token(now):
+                continue
+            if self._total is not None:
+                self._total.take(now)
+            if bucket is not None:
+                bucket.take(now)
+            del self._queue[key]
+            self._throttled.discard(key)
+            self._granted[key] = host
+            ret.append(key)
+        for key, host in self._queue.items():
+            if key not in self._throttled:
+                self._throttled.add(key)
+                self.total_throttled += 1
+                self.throttled_per_host[host] += 1
+                self.throttled_per_key[key] += 1
+        return ret
+
+    def use(self, key):
+        """
+        The command of a granted restart is restarted.
+        """
+        if key in self._granted:
+            del self._granted[key]
+            self.total_restarts += 1
+
+    def release(self, key):
+        """
+        Forgets about a restart, wherever it is. A granted restart that is
+        not used does not give back its share of the budget.
+        """
+        self._queue.pop(key, None)
+        self._granted.pop(key, None)
+        self._throttled.discard(key)
+
+    def get_next_token_time(self, now):
+        """
+        Returns when the next queued restart can be granted, or None if
+        none is queued.
+        @rtype: C{float}
+        """
+        ret = None
+        for host in set(self._queue.values()):
+            times = [now]
+            if self._total is not None:
+                times.append(self._total.get_next_token_time(now))
+            bucket = self._get_host_bucket(host)
+            if bucket is not None:
+                times.append(bucket.get_next_token_time(now))
+            if ret is None or max(times) < ret:
+                ret = max(times)
+        return ret
+
+    def get_queued(self):
+        """
+        Returns the keys that are waiting, in order.
+        @rtype: C{list}
+        """
+        return list(self._queue.keys())
+
+    def get_stats(self):
+        """
+        @rtype: C{dict}
+        """
+        return {
+            "queued": len(self._queue),
+            "granted": len(self._granted),
+            "total_restarts": self.total_restarts,
+            "total_throttled": self.total_throttled,
+            "throttled_per_host": dict(self.throttled_per_host),
+            "throttled_per_command": dict(self.throttled_per_key),
+            }
+
+    def _get_host_bucket(self, host):
+        if self.per_host_per_minute <= 0:
+            return None
+        if host not in self._per_host:
+            self._per_host[host] = tokenbucket.TokenBucket(
+                    self.per_host_per_minute / 60.0, self.per_host_per_minute)
+        return self._per_host[host]
@@ -27,8 +27,13 @@ The lunch-slave is then told which command to launch and asked to launch it, and
 
 Author: Alexandre Quessy <alexandre@quessy.net>
 """
+import collections
+import json
 import os
+import pty
+import random
 import stat
+import termios
 import time
 import logging
 import warnings
@@ -45,13 +50,25 @@ from twisted.python import logfile
 from twisted.python import procutils
 
 from lunch import sig
+from lunch import ssherrors
 from lunch import graph
 from lunch.states import *
 from lunch import logger
 from lunch import convert
+from lunch import framing
+from lunch import heartbeat
+from lunch import logsink
 
 log = logger.start(name='commands')
 
+# Version 1: lines of space-separated words.
+# Version 2: lines of JSON arrays. The first item is the key.
+# The lunch-slave tells us its highest version in its "ready" message.
+PROTOCOL_VERSION = 2
+
+# How many samples of the resources of a child are kept on its command.
+RESOURCE_HISTORY_LENGTH = 120
+
 def run_and_wait(executable, *arguments):
     """
     Runs a command and trigger its deferred with the output when done.
@@ -77,6 +94,51 @@ def run_and_wait(executable, *arguments):
     return d
 
 
+def open_pty_without_echo():
+    """
+    Opens a pseudo-terminal that does not echo what we write to it.
+    Otherwise, we would read back everything we send to the lunch-slave.
+    @return: (master fd, slave fd, tty name), for the usePTY argument of spawnProcess.
+    @rtype: C{tuple}
+    """
+    master_fd, slave_fd = pty.openpty()
+    attributes = termios.tcgetattr(slave_fd)
+    attributes[3] &= ~termios.ECHO # lflag
+    termios.tcsetattr(slave_fd, termios.TCSANOW, attributes)
+    return (master_fd, slave_fd, os.ttyname(slave_fd))
+
+
+def get_slave_command_line(identifier, host=None, user=None, ssh_port=None,
+        ssh_multiplexer=None):
+    """
+    Returns the command line that starts a lunch-slave, through SSH if the
+    host is not None.
+    Raises a RuntimeError if the executable cannot be found.
+    @rtype: C{list}
+    """
+    if host is None:
+        # if user is not None:
+            # TODO: Set gid if user is not None...
+        _command = ["lunch-slave", "--id", identifier]
+    else:
+        _command = ["ssh"]
+        if ssh_port is not None:
+            _command.extend(["-p", str(ssh_port)])
+        if user is not None:
+            _command.extend(["-l", user])
+        if ssh_multiplexer is not None:
+            _command.extend(ssh_multiplexer.get_ssh_options(user, host, ssh_port))
+        _command.extend([host])
+        _command.extend(["lunch-slave", "--id", identifier])
+        # I hope you put your SSH key on the remote host !
+        # FIXME: we should pop-up a terminal if keys are not set up.
+    try:
+        _command[0] = procutils.which(_command[0])[0]
+    except IndexError:
+        raise RuntimeError("Could not find path of executable %s." % (_command[0]))
+    return _command
+
+
 class SlaveProcessProtocol(protocol.ProcessProtocol):
     """
     Process of a lunch-slave. (through SSH, or directly bash)
@@ -88,6 +150,10 @@ class SlaveProcessProtocol(protocol.ProcessProtocol):
         @param command: L{Command} instance.
         """
         self.command = command
+        self._stdout_framer = framing.LineFramer(self._out_line_received,
+                line_too_long=self._line_too_long)
+        self._stderr_framer = framing.LineFramer(self._err_line_received,
+                line_too_long=self._line_too_long)
 
     def connectionMade(self):
         """
@@ -100,24 +166,29 @@ class SlaveProcessProtocol(protocol.ProcessProtocol):
         Called when text is received from the lunch-slave process stdout
 
         Twisted will not splitlines, it gives an arbitrary amount of
-        data at a time. This way, our manager only gets one line at 
-        a time.
+        data at a time. The framer keeps the partial lines until their end
+        is received, so that our manager only gets one whole line at a time.
         """
-        lines = data.splitlines()
-        for line in lines:
-            line_str = convert.bytes_to_str(line)
-            log.info("data received is : " + "\n" + line_str)
-            if line_str != "":
-                log.info("line content is : " + line_str)
-                self.command._received_message(line_str)
+        self._stdout_framer.feed(data)
+
+    def _out_line_received(self, line):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s <- %s" % (self.command.identifier, line))
+        self.command._received_message(line)
 
     def errReceived(self, data):
         """
         Called when text is received from the lunch-slave process stderr
         """
-        for line in data.splitlines().strip():
-            if line != "":
-                log.debug("stderr: " + line + "\n")
+        self._stderr_framer.feed(data)
+
+    def _err_line_received(self, line):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s stderr: %s" % (self.command.identifier, line))
+
+    def _line_too_long(self, length):
+        log.error("Discarded a line of more than %d bytes from the lunch-slave of %s." % (
+                length, self.command.identifier))
 
     def processEnded(self, reason):
         """
@@ -138,10 +209,10 @@ class SlaveProcessProtocol(protocol.ProcessProtocol):
         pass #log.msg("Slave stdin has closed.")
 
     def outConnectionLost(self):
-        pass #log.msg("Slave stdout has closed.")
-    
+        self._stdout_framer.flush()
+
     def errConnectionLost(self):
-        pass #log.msg("Slave stderr has closed.")
+        self._stderr_framer.flush()
 
     def processExited(self, reason):
         """
@@ -156,6 +227,172 @@ class SlaveProcessProtocol(protocol.ProcessProtocol):
         log.info("process has exited : %s." % (str(exit_code)))
 
 
+class SharedSlave(object):
+    """
+    One lunch-slave process that manages the children of many commands on
+    the same host.
+
+    The lines sent to the lunch-slave for a command are prefixed with
+    "@identifier ", and so are the lines it sends back about its child.
+    The process is started when a first command needs it, and quits when
+    none of them uses it anymore.
+    """
+    def __init__(self, host=None, user=None, ssh_port=None,
+            ssh_multiplexer=None, delay_before_kill=8.0):
+        self.host = host
+        self.user = user
+        self.ssh_port = ssh_port
+        self.ssh_multiplexer = ssh_multiplexer
+        self.delay_before_kill = delay_before_kill
+        self.identifier = "shared_%s" % (host or "localhost")
+        self.slave_state = STATE_STOPPED
+        self._received_ready = False
+        self._ready_message = "" # what follows "ready": the protocol version and the cores
+        self._commands = {} # identifier: L{Command}
+        self._process_protocol = None
+        self._process_transport = None
+        self._quit_deferred = None
+        self._sigkill_call = None
+
+    def attach(self, command):
+        """
+        Makes a command use this lunch-slave.
+        """
+        self._commands[command.identifier] = command
+
+    def detach(self, command):
+        self._commands.pop(command.identifier, None)
+
+    def get_commands(self):
+        """
+        Returns the commands that use this lunch-slave.
+        @rtype: C{list}
+        """
+        return list(self._commands.values())
+
+    def start_for(self, command):
+        """
+        Starts the lunch-slave process if needed, and tells the command if
+        it is already running.
+        """
+        if self.slave_state == STATE_RUNNING:
+            command._on_connection_made()
+            if self._received_ready:
+                command.recv_ready(self._ready_message)
+        elif self.slave_state == STATE_STOPPED:
+            _command = get_slave_command_line(self.identifier, host=self.host,
+                    user=self.user, ssh_port=self.ssh_port,
+                    ssh_multiplexer=self.ssh_multiplexer)
+            log.info("lunch-slave %s> Start agent $ %s" % (self.identifier, " ".join(_command)))
+            self._received_ready = False
+            self._process_protocol = SlaveProcessProtocol(self)
+            environ = {}
+            environ.update(os.environ) # passing the whole env (for SSH keys and more)
+            self.slave_state = STATE_STARTING
+            self._process_transport = reactor.spawnProcess(self._process_protocol,
+                    _command[0], _command, environ, usePTY=open_pty_without_echo())
+        # if it is STARTING, the command will be told when it is running.
+        # if it is STOPPING, the command will be told it is stopped.
+
+    def send(self, identifier, msg_bytes):
+        """
+        Sends a line to the lunch-slave, about the child of a command.
+        """
+        prefix = convert.str_to_bytes("@%s " % (identifier))
+        self._process_transport.write(prefix + msg_bytes)
+
+    def _on_connection_made(self):
+        self.slave_state = STATE_RUNNING
+        for command in self.get_commands():
+            if command.slave_state == STATE_STARTING:
+                command._on_connection_made()
+
+    def _received_message(self, line):
+        """
+        Received one line of text from the lunch-slave through its stdout.
+        Gives it to the command it is about.
+        """
+        if line.startswith("@"):
+            words = line[1:].split(" ", 1)
+            command = self._commands.get(words[0])
+            if command is not None and len(words) == 2:
+                command._received_message(words[1])
+            return
+        key, _, mess = line.partition(" ")
+        if key == "ready":
+            self._received_ready = True
+            self._ready_message = mess
+            for command in self.get_commands():
+                if command.slave_state == STATE_RUNNING and \
+                        not command._received_ready:
+                    command.recv_ready(mess)
+        elif key in ["msg", "log", "ok", "pong", "bye"]:
+            log.debug("lunch-slave %s> %s" % (self.identifier, line))
+        else: # errors, from the lunch-slave or from SSH
+            for command in self.get_commands():
+                command._received_message(line)
+
+    def _on_process_ended(self, exit_code):
+        """
+        The lunch-slave process died. Tells all the commands.
+        """
+        log.info("Shared lunch-slave %s exited with %s." % (self.identifier, exit_code))
+        self.slave_state = STATE_STOPPED
+        self._received_ready = False
+        self._process_transport.loseConnection()
+        if self._sigkill_call is not None and self._sigkill_call.active():
+            self._sigkill_call.cancel()
+        self._sigkill_call = None
+        for command in self.get_commands():
+            if command.slave_state != STATE_STOPPED:
+                command._on_process_ended(exit_code)
+        if self._quit_deferred is not None:
+            d = self._quit_deferred
+            self._quit_deferred = None
+            d.callback(None)
+
+    def release(self, command):
+        """
+        Called when a command does not use the lunch-slave anymore.
+        Makes the process quit if no command uses it.
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: A deferred called once the process has quit, if it quits.
+        """
+        for other in self.get_commands():
+            if other.slave_state != STATE_STOPPED:
+                return defer.succeed(None)
+        if self.slave_state == STATE_STOPPED:
+            return defer.succeed(None)
+        if self._quit_deferred is None:
+            self._quit_deferred = defer.Deferred()
+            self.slave_state = STATE_STOPPING
+            self._process_transport.signalProcess(15) # signal.SIGTERM
+            self._sigkill_call = reactor.callLater(self.delay_before_kill,
+                    self._signal_process, 9) # signal.SIGKILL
+        d = defer.Deferred()
+        def _cb(result):
+            d.callback(None)
+            return result
+        self._quit_deferred.addCallback(_cb)
+        return d
+
+    def kill(self):
+        """
+        Kills the lunch-slave process, when it does not answer anymore.
+        """
+        if self.slave_state != STATE_STOPPED:
+            self.slave_state = STATE_STOPPING
+            self._signal_process(9) # signal.SIGKILL
+
+    def _signal_process(self, signal_number):
+        self._sigkill_call = None
+        if self.slave_state == STATE_STOPPING:
+            try:
+                self._process_transport.signalProcess(signal_number)
+            except error.ProcessExitedAlready:
+                pass
+
+
 class Command(object):
     """
     Manages a lunch-slave process, telling it which child process to start.
@@ -172,7 +409,7 @@ class Command(object):
     #TODO: move send_* and recv_* methods to the SlaveProcessProtocol.
     #TODO: add wait_returned attribute. (commands after which we should wait them to end before calling next)
     
-    def __init__(self, command=None, identifier=None, env=None, user=None, host=None, order=None, sleep_after=0.25, respawn=True, minimum_lifetime_to_respawn=0.5, log_dir=None, depends=None, verbose=False, try_again_delay=0.25, give_up_after=0, enabled=None, delay_before_kill=8.0, ssh_port=None):
+    def __init__(self, command=None, identifier=None, env=None, user=None, host=None, order=None, sleep_after=0.25, respawn=True, minimum_lifetime_to_respawn=0.5, log_dir=None, depends=None, verbose=False, try_again_delay=0.25, give_up_after=0, enabled=None, delay_before_kill=8.0, ssh_port=None, ssh_multiplex=None, share_slave=None, prewarm=None, ready_tcp_port=None, ready_file=None, ready_output=None, ready_command=None, ready_timeout=10.0, notify=False, watchdog_sec=None, sockets=None, sample_every=None, rlimits=None, nice=None, ionice=None, memory_max=None, cpu_max=None, cpus=None, realtime_priority=None, realtime_policy="fifo", mlock_all=False, max_try_again_delay=60.0):
         """
         @param command: Shell string. The first item is the name of the name of the executable.
         @param depends: Commands to which this command depends on. List of strings.
@@ -202,10 +439,54 @@ class Command(object):
         @type verbose: bool
         @type delay_before_kill: float
         @type ssh_port: int
-        @param try_again_delay: Time to wait before trying again if it crashes at startup.
+        @param ssh_multiplex: Whether to share one SSH connection with the other commands for the same user, host and port. None means the master decides.
+        @type ssh_multiplex: C{bool}
+        @param share_slave: Whether to share one lunch-slave process with the other commands for the same user, host and port. None means the master decides.
+        @type share_slave: C{bool}
+        @param prewarm: Whether to start the lunch-slave as soon as the command is added, so that only its child is left to start. None means the master decides.
+        @type prewarm: C{bool}
+        @param try_again_delay: Time to wait before trying again if it crashes at startup. It doubles each time, up to max_try_again_delay, and the actual wait is random between 0 and it, so that the commands that crash together do not all try again together.
         @type try_again_delay: C{float}
+        @param max_try_again_delay: Maximum of the doubling try_again_delay.
+        @type max_try_again_delay: C{float}
         @param give_up_after: How many times to try again before giving up.
         @type give_up_after: C{int}
+        @param ready_tcp_port: The child is ready when this TCP port of its host accepts connections.
+        @type ready_tcp_port: C{int}
+        @param ready_file: The child is ready when this file exists on its host.
+        @type ready_file: C{str}
+        @param ready_output: The child is ready when a line of its output matches this regular expression.
+        @type ready_output: C{str}
+        @param ready_command: The child is ready when this shell command, run on its host, exits with 0.
+        @type ready_command: C{str}
+        @param ready_timeout: How many seconds a child can take to be ready. After that, it is restarted.
+        @type ready_timeout: C{float}
+        @param notify: The child is given a NOTIFY_SOCKET, like systemd does, and is ready when it sends READY=1 to it.
+        @type notify: C{bool}
+        @param watchdog_sec: If set, the child must send WATCHDOG=1 to its NOTIFY_SOCKET at least this often, or it is restarted.
+        @type watchdog_sec: C{float}
+        @param sockets: Sockets that the lunch-slave binds before it starts the child, which gets them with the LISTEN_FDS convention of systemd. Each of them is "tcp:[host:]port", "udp:[host:]port" or "unix:path". The dependees can start as soon as they are bound.
+        @type sockets: C{list}
+        @param sample_every: Seconds between the samples of the CPU, memory, threads and file descriptors of the process tree of the child. 0 disables it. The default is given by the master.
+        @type sample_every: C{float}
+        @param rlimits: Limits of the resources of the child, set with the ulimit builtin of bash. The keys are "as" (address space), "nofile" (open files), "core", "cpu", "data", "fsize", "memlock", "nproc" or "stack". The sizes are in bytes. None or "unlimited" means no limit.
+        @type rlimits: C{dict}
+        @param nice: Niceness of the child, from -20 to 19.
+        @type nice: C{int}
+        @param ionice: Scheduling class of the inputs and outputs of the child: "realtime", "best-effort" or "idle", maybe followed by ":" and its priority within the class, from 0 to 7.
+        @type ionice: C{str}
+        @param memory_max: Bytes of memory that the child and its descendants can use, without swap. Past that, the kernel kills them. It needs a cgroup v2 delegated to the lunch-slave.
+        @type memory_max: C{int}
+        @param cpu_max: How many CPUs the child and its descendants can use, like 0.5. It needs a cgroup v2 delegated to the lunch-slave.
+        @type cpu_max: C{float}
+        @param cpus: How many CPUs of its host the child gets for itself. The master chooses them, so that they do not overlap with the ones of the other commands on the same host, and the child can only run on them.
+        @type cpus: C{int}
+        @param realtime_priority: Realtime priority of the child, from 1 to 99. It needs a RLIMIT_RTPRIO at least as high for the user, or the CAP_SYS_NICE capability.
+        @type realtime_priority: C{int}
+        @param realtime_policy: Realtime scheduling policy of the child: "fifo" (SCHED_FIFO) or "rr" (SCHED_RR).
+        @type realtime_policy: C{str}
+        @param mlock_all: Whether the child can lock all its memory, like jackd does. Its RLIMIT_MEMLOCK is set to unlimited, which needs a hard limit that is unlimited too.
+        @type mlock_all: C{bool}
         """
         self.command = command
         self.identifier = identifier
@@ -215,27 +496,74 @@ class Command(object):
         self.user = user
         self.host = host
         self.ssh_port = ssh_port
+        self.ssh_multiplex = ssh_multiplex
+        self.ssh_multiplexer = None # L{lunch.sshmux.SSHMultiplexer}, set by the master
+        self.share_slave = share_slave
+        self.shared_slave = None # L{SharedSlave}, set by the master
+        self.prewarm = prewarm
+        self._start_child_when_ready = True # False while pre-warmed
+        self.ready_tcp_port = ready_tcp_port
+        self.ready_file = ready_file
+        self.ready_output = ready_output
+        self.ready_command = ready_command
+        self.ready_timeout = ready_timeout
+        self.notify = notify
+        self.watchdog_sec = watchdog_sec
+        self.child_status = None # last STATUS=... sent by the child
+        self.sockets = []
+        if sockets is not None:
+            self.sockets.extend(sockets)
+        self.sockets_bound = False # whether the lunch-slave bound them
+        self.sample_every = sample_every
+        self.resources = {} # last sample of the resources of the child
+        self.resource_history = collections.deque(maxlen=RESOURCE_HISTORY_LENGTH) # (time, resources) tuples
+        self.rlimits = {}
+        if rlimits is not None:
+            self.rlimits.update(rlimits)
+        self.nice = nice
+        self.ionice = ionice
+        self.memory_max = memory_max
+        self.cpu_max = cpu_max
+        self.applied_limits = {} # limits that the lunch-slave applied to the child
+        self.exit_reason = None # why the child last exited, like "oom"
+        self.cpus = cpus
+        self.realtime_priority = realtime_priority
+        self.realtime_policy = realtime_policy
+        self.mlock_all = mlock_all
+        self.cpu_placement = None # L{lunch.placement.CPUPlacement}, set by the master
+        self.affinity = None # CPUs assigned to the child, if any
+        self.child_ready = False # whether its dependees can start
+        self.ready_at = None # time when the child was last ready
         self.order = order
         self.sleep_after = sleep_after
         self.respawn = respawn
-        self.enabled = True 
+        self._enabled = True 
         if enabled is not None:
-            self.enabled = enabled
+            self._enabled = enabled
         self.to_be_deleted = False
         self.depends = depends
         self.how_many_times_run = 0
         self.how_many_times_tried = 0
+        self.started_running_at = None # time when the child was last RUNNING
+        self.start_requested_at = None # time when start() was first called, until it is RUNNING
+        self.time_to_running = None # seconds from start() to RUNNING, the last time
         self.delay_before_kill = delay_before_kill
         self.verbose = verbose
         self.retval = 0
         self.gave_up = False
         self.number_of_lines_received_from_slave = 0
         self._has_shown_ssh_error = False 
+        self.ssh_error = None # last lunch.ssherrors.SSHError
         self._has_shown_notfound_error = False 
         self.try_again_delay = try_again_delay
-        self._current_try_again_delay = try_again_delay # doubles up each time we try
+        self.max_try_again_delay = max_try_again_delay
+        self._current_try_again_delay = min(try_again_delay, max_try_again_delay) # doubles up each time we try
         self._next_try_time = 0
         self._received_ready = False
+        self.protocol_version = 1 # chosen when the lunch-slave is ready
+        self._recv_methods = self._get_recv_methods()
+        self._stop_sent = False # until the lunch-slave tells us the child state changed
+        self._start_sent = False # until the lunch-slave tells us the child state
         self._previous_launching_time = 0
         self.give_up_after = give_up_after # 0 means infinity of times
         self.minimum_lifetime_to_respawn = minimum_lifetime_to_respawn #FIXME: rename
@@ -255,6 +583,9 @@ class Command(object):
         self.child_pid_changed_signal = sig.Signal() # params: self, new_pid
         self.command_not_found_signal = sig.Signal() # params: self, command
         self.ssh_error_signal = sig.Signal() # params: self, error_message
+        self.scheduling_changed_signal = sig.Signal() # params: self
+                # -- Called when what decides if it can be started changes.
+        self.resources_changed_signal = sig.Signal() # params: self, resources
         if command is None:
             raise RuntimeError("You must provide a command to be run.")
         log.info("Creating command %s ($ %s) on %s@%s" % (self.identifier, self.command, self.user, self.host))
@@ -264,11 +595,101 @@ class Command(object):
         # Some attributes might be changed by the master, namely identifier and host.
         # That's why we sait until start() is called to initiate the slave_logger.
         self.slave_logger = None
+        self.log_sink = None # L{lunch.logsink.LogSink}, given by the master
         self.child_pid = None
+        # Heartbeat with the lunch-slave, set by the master. 0 disables it.
+        self.heartbeat_idle = 0
+        self.heartbeat_interval = 2.0
+        self.heartbeat_probes = 3
+        self.rtt = heartbeat.RTTHistogram() # round-trip times of the pings
+        self.slave_lost_count = 0 # how many times it did not answer the pings
+        self._heartbeat = None # L{lunch.heartbeat.Heartbeat}, while ready
+
+    @classmethod
+    def _get_recv_methods(cls):
+        """
+        Returns the dict of key: recv_* function, computed once per class.
+        """
+        if "_recv_methods_table" not in cls.__dict__:
+            cls._recv_methods_table = dict((name[len("recv_"):], getattr(cls, name))
+                    for name in dir(cls) if name.startswith("recv_"))
+        return cls._recv_methods_table
+
+    def get_next_try_time(self):
+        """
+        Returns the time before which we should not try to start the child again.
+        @rtype: C{float}
+        """
+        return self._next_try_time
+
+    def _set_next_try_time(self, next_try_time):
+        if self._next_try_time != next_try_time:
+            self._next_try_time = next_try_time
+            self.scheduling_changed_signal(self)
+
+    def is_being_stopped(self):
+        """
+        Checks if we told the lunch-slave to stop the child, and it did not
+        tell us yet that its state changed.
+        @rtype: C{bool}
+        """
+        return self._stop_sent and self.child_state in [STATE_RUNNING, STATE_STARTING]
+
+    def _get_enabled(self):
+        return self._enabled
+
+    def _set_enabled(self, enabled):
+        if self._enabled != enabled:
+            self._enabled = enabled
+            self.scheduling_changed_signal(self)
+
+    enabled = property(_get_enabled, _set_enabled,
+            doc="Whether the master should keep the child alive.")
+
+    def get_probe(self):
+        """
+        Returns the options of the readiness probe for the lunch-slave, or
+        None if the child is ready as soon as it is running.
+        @rtype: C{dict}
+        """
+        probe = {}
+        for key, value in [("tcp_port", self.ready_tcp_port),
+                ("file", self.ready_file), ("output", self.ready_output),
+                ("command", self.ready_command)]:
+            if value is not None:
+                probe[key] = value
+        if self.notify:
+            probe["notify"] = True
+        if len(probe) == 0:
+            return None
+        probe["timeout"] = self.ready_timeout
+        return probe
+
+    def is_ready(self):
+        """
+        Returns whether the child is running and ready to be used by the
+        commands that depend on it.
+        With socket activation, that is as soon as its sockets are bound,
+        since the connections of the dependees wait in their backlog.
+        @rtype: C{bool}
+        """
+        if self.sockets_bound and \
+                self.child_state in [STATE_STARTING, STATE_RUNNING]:
+            return True
+        return self.child_state == STATE_RUNNING and self.child_ready
+
+    def is_slave_ready(self):
+        """
+        Returns whether the lunch-slave is running and said it is ready.
+        @rtype: C{bool}
+        """
+        return self.slave_state == STATE_RUNNING and self._received_ready
 
     def is_ready_to_be_started(self):
         # self.enabled
         ret = self._next_try_time <= time.time() and self.child_state == STATE_STOPPED
+        if ret and self._start_sent:
+            ret = False # it is starting
         if ret and self.slave_state == STATE_RUNNING:
             if not self._received_ready:
                 # log.debug("Not ready to start child %s since we did not receive the ready message." % (self))
@@ -287,7 +708,10 @@ class Command(object):
                     os.makedirs(self.slave_log_dir)
                 except OSError as e:
                     raise RuntimeError("You need to be able to write in the current working directory in order to write log files. %s" % (e))
-            self.slave_logger = logfile.LogFile(slave_log_file, self.slave_log_dir)
+            if self.log_sink is not None:
+                self.slave_logger = self.log_sink.open_log(slave_log_file, self.slave_log_dir)
+            else:
+                self.slave_logger = logfile.LogFile(slave_log_file, self.slave_log_dir)
     
     def start(self):
         """
@@ -300,7 +724,7 @@ class Command(object):
         # self._has_shown_ssh_error = False
         self.gave_up = False
         if self.how_many_times_tried == 0:
-            self._current_try_again_delay = self.try_again_delay
+            self._current_try_again_delay = min(self.try_again_delay, self.max_try_again_delay)
         self.how_many_times_tried += 1
         self._start_logger()
         # If the lunch-slave is already running, we only need to tell it to start the child
@@ -309,52 +733,78 @@ class Command(object):
 			% (self.identifier))
             return
         if self.slave_state == STATE_RUNNING and self.child_state == STATE_STOPPED:
-            self._send_all_startup_commands()
+            self._request_start()
+            self._start_child_when_ready = True
+            if self._received_ready:
+                self._send_all_startup_commands()
             return
         elif self.child_state in [STATE_STOPPING, STATE_STARTING]:
             self.log("Cannot start child %s that is %s." % (self.identifier, self.child_state))
             return
         else:
-            if self.slave_state in [STATE_STARTING, STATE_STOPPING]:
+            if self.slave_state == STATE_STARTING and not self._start_child_when_ready:
+                # pre-warmed: the child will start as soon as it is ready
+                self._request_start()
+                self._start_child_when_ready = True
+                return
+            elif self.slave_state in [STATE_STARTING, STATE_STOPPING]:
                 self.log("Cannot start a lunch-slave %s that is %s." % (self.identifier, self.slave_state))
                 return # XXX
             else: # lunch-slave is STOPPED
                 # --------------- start the lunch-slave, and then its child
-                self.number_of_lines_received_from_slave = 0
-                self._received_ready = False
-                if self.host is None:
-                    # if self.user is not None:
-                        # TODO: Set gid if user is not None...
-                    is_remote = False # not using SSH
-                    _command = ["lunch-slave", "--id", self.identifier]
-                else:
-                    self.log("We will use SSH since host is %s" % (self.host))
-                    is_remote = True # using SSH
-                    _command = ["ssh"]
-                    if self.ssh_port is not None:
-                        _command.extend(["-p", str(self.ssh_port)])
-                    if self.user is not None:
-                        _command.extend(["-l", self.user])
-                    _command.extend([self.host])
-                    _command.extend(["lunch-slave", "--id", self.identifier])
-                    # I hope you put your SSH key on the remote host !
-                    # FIXME: we should pop-up a terminal if keys are not set up.
-                try:
-                    _command[0] = procutils.which(_command[0])[0]
-                except IndexError:
-                    raise RuntimeError("Could not find path of executable %s." % (_command[0]))
-                log.info("lunch-slave %s> Start agent $ %s" % (self.identifier, " ".join(_command)))
-                self._process_protocol = SlaveProcessProtocol(self)
-                #try:
-                proc_path = _command[0]
-                args = _command
-                environ = {}
-                environ.update(os.environ) # passing the whole env (for SSH keys and more)
-                self.set_slave_state(STATE_STARTING)
-                self.log("Starting lunch-slave: %s" % (self.identifier))
-                self._previous_launching_time = time.time()
-                self._process_transport = reactor.spawnProcess(self._process_protocol, proc_path, args, environ, usePTY=True)
-    
+                self._request_start()
+                self._start_child_when_ready = True
+                self._start_slave()
+
+    def _request_start(self):
+        if self.start_requested_at is None: # the first time start() is called
+            self.start_requested_at = time.time()
+
+    def prewarm_slave(self):
+        """
+        Starts the lunch-slave process, but not its child.
+
+        The child can then be started with start(), without waiting for
+        SSH and the lunch-slave to start.
+        """
+        if self.slave_state != STATE_STOPPED:
+            return
+        self._start_logger()
+        self.log("Pre-warming lunch-slave %s" % (self.identifier), logging.INFO)
+        self._start_child_when_ready = False
+        self._start_slave()
+
+    def _start_slave(self):
+        """
+        Starts the lunch-slave process. Its child is started once it is
+        ready, if _start_child_when_ready is True.
+        """
+        self.number_of_lines_received_from_slave = 0
+        self._received_ready = False
+        self._start_sent = False
+        self.ssh_error = None
+        self.protocol_version = 1 # until it tells us it is ready
+        if self.shared_slave is not None:
+            self.set_slave_state(STATE_STARTING)
+            self.shared_slave.start_for(self)
+            return
+        if self.host is not None:
+            self.log("We will use SSH since host is %s" % (self.host))
+        _command = get_slave_command_line(self.identifier,
+                host=self.host, user=self.user, ssh_port=self.ssh_port,
+                ssh_multiplexer=self.ssh_multiplexer)
+        log.info("lunch-slave %s> Start agent $ %s" % (self.identifier, " ".join(_command)))
+        self._process_protocol = SlaveProcessProtocol(self)
+        #try:
+        proc_path = _command[0]
+        args = _command
+        environ = {}
+        environ.update(os.environ) # passing the whole env (for SSH keys and more)
+        self.set_slave_state(STATE_STARTING)
+        self.log("Starting lunch-slave: %s" % (self.identifier))
+        self._previous_launching_time = time.time()
+        self._process_transport = reactor.spawnProcess(self._process_protocol, proc_path, args, environ, usePTY=open_pty_without_echo())
+
     def _format_env(self):
         """
         Format the environment variables to send them to the lunch-slave as a series of key-value pairs.
@@ -377,8 +827,11 @@ class Command(object):
         """
         self.send_message("do", self.command) 
     
-    def send_ping(self):
-        self.send_message("ping") # for fun
+    def send_ping(self, sequence=None):
+        if sequence is None:
+            self.send_message("ping")
+        else:
+            self.send_message("ping", str(sequence))
 
     def send_run(self):
         self.send_message("run")
@@ -396,56 +849,56 @@ class Command(object):
         @param key: string
         @param data: string
         """
-        msg = "%s %s\n" % (key, data)
+        if self.protocol_version >= 2:
+            args = [key]
+            if data != "":
+                args.append(data)
+            msg = json.dumps(args) + "\n"
+        else:
+            msg = "%s %s\n" % (key, data)
         if self.verbose:
             self.log("lunch-slave %s> Sending %s" % (self.identifier, msg.strip()))
         msg_bytes = convert.str_to_bytes(msg)
-        self._process_transport.write(msg_bytes)
+        if self.shared_slave is not None:
+            self.shared_slave.send(self.identifier, msg_bytes)
+        else:
+            self._process_transport.write(msg_bytes)
     
     def __del__(self):
         #TODO: send "stop" and SIGKILL if the lunch-slave and the child processes are stil running.
         if self.slave_logger is not None:
             self.slave_logger.close()
         
-    def _looks_like_ssh_error(self, line):
+    def _on_ssh_error(self, ssh_error):
         """
-        Checks the string received to see if it looks like a SSH error message.
-        @return: An error message if there is a problem, or None otherwise.
-        @rtype: C{str}
-        """
-        #XXX: if is returns a string, the master will give it up
-        ret = None
-        # log.debug("Checking if it looks like a SSH error: %s" % (line))
-        if "password:" in line:
-            ret = "The SSH server asks for a password. Make sure you use the right user name and that your public SSH key is installed on the remote host %s." % (self.host)
-            #giving up
-        elif "Enter passphrase for key" in line:
-            ret = "The SSH client asks for a passphrase to unlock your local private SSH key for which you have the corresponding public key on host %s. You should avoid this to be asked by providing that passphrase a first time using SSH by hand." % (self.host)
-            #giving up
-        elif "Connection refused" in line:
-            port = 22
-            if self.ssh_port is not None:
-                port = self.ssh_port
-            ret = "The SSH server is not running on port %d of host %s or not available." % (port, self.host)
-            #TODO: try to reconnect
-        elif "No route to host" in line:
-            ret = "We cannot find host %s." % (self.host)
-            #TODO: try to reconnect
-        elif "command not found" in line:
-            ret = "The lunch-slave command is not installed on the host %s." % (self.host)
-            #giving up
-        elif "ssh_exchange_identification" in line: #FIXME: what is that?
-            ret = "Some SSH problem occurred exchanging the identification on host %s. Is your host blacklisted?" % (self.host)
-        elif "Could not resolve hostname" in line:
-            ret = "Could not resolve hostname %s." % (self.host)
-        elif "Host key verification failed" in line:
-            ret = "Host key verification failed on %s. Add correct host key" % (self.host)
-        if ret is not None:
-            ret += "\nThe line received from SSH is :\n" + line
-            ret += "\nThis error happend when trying to launch %s" % (self)
-            log.error(line)
-            log.error(ret)
-        return ret
+        The SSH client could not launch the lunch-slave.
+
+        If the error might go away by itself, we will try again later, as if
+        the child had died too early. Otherwise, we give up.
+        @type ssh_error: L{lunch.ssherrors.SSHError}
+        """
+        if self.ssh_error is not None:
+            return # SSH often explains the same problem in many lines
+        self.ssh_error = ssh_error
+        message = ssh_error.get_description()
+        message += "\nThe line received from SSH is :\n" + ssh_error.line
+        message += "\nThis error happend when trying to launch %s" % (self)
+        log.error("--------- SSH PROBLEM: " + message + " -----------")
+        if ssh_error.retryable:
+            self._give_up_if_we_should()
+        else:
+            self.gave_up = True
+            self.enabled = False
+            log.info("Gave up starting command %s because of a SSH %s error." % (self.identifier, ssh_error.code))
+            if self.shared_slave is None and self._process_transport is not None:
+                # It might be waiting for a password forever.
+                try:
+                    self._process_transport.signalProcess("TERM")
+                except error.ProcessExitedAlready:
+                    pass
+        if not self._has_shown_ssh_error:
+            self._has_shown_ssh_error = True
+            self.ssh_error_signal(self, message)
 
     def _received_message(self, line):
         """
@@ -453,46 +906,37 @@ class Command(object):
         """
         line_str = line
         # self.log("_received_message line is %8s: %s" % (self.identifier, line))
-        # FIXME: right now, we check all the output from that guy
-        if True: #self.number_of_lines_received_from_slave == 0:
-            ssh_error = self._looks_like_ssh_error(line_str)
-            if ssh_error is not None: # It's a str
-                log.error("--------- SSH PROBLEM: " + ssh_error + " -----------")
-                # FIXME: self.enabled = False
-                if not self._has_shown_ssh_error:
-                    self._has_shown_ssh_error = True
-                    self.ssh_error_signal(self, ssh_error)
+        # Only the SSH client talks before the lunch-slave is ready.
+        if not self._received_ready:
+            ssh_error = ssherrors.parse_ssh_error(line_str, host=self.host,
+                    port=self.ssh_port)
+            if ssh_error is not None:
+                self._on_ssh_error(ssh_error)
                 return
-                #TODO: handle this
         self.number_of_lines_received_from_slave += 1
-        key = ''
-        try:
-            #log.info("line is : " + line)
-            words = line_str.split(" ")
-            key = words[0]
-            mess = line_str[len(key) + 1:]
-        except IndexError as e:
-            #self.log("Index error parsing message from lunch-slave. %s" % (e), logging.ERROR)
-            self.log('IndexError From lunch-slave %s: %s' % (self.identifier, line_str), logging.ERROR)
+        if self._heartbeat is not None:
+            self._heartbeat.activity()
+        key = None
+        if self.protocol_version >= 2 and line_str.startswith("["):
+            try:
+                message = json.loads(line_str)
+                key = message[0]
+                if not isinstance(key, str):
+                    raise ValueError("The message name must be a string.")
+                mess = " ".join([str(arg) for arg in message[1:]])
+            except (ValueError, IndexError, KeyError, TypeError) as e:
+                self.log('Invalid message from lunch-slave %s: %s' % (self.identifier, line_str), logging.ERROR)
+                return
         else:
-            method = None
-            # Dispatch the command to the appropriate method.  Note that all you
-            # need to do to implement a new command is add another do_* method.
-            if key in ["do", "env", "run", "logdir", "stop"]: # FIXME: receiving in stdin what we send to stdin lunch-slave !!!
-                pass #warnings.warn("We receive from the lunch-slave's stdout what we send to its stdin !")
-            else:
-                #log.info("Attribute value is recv_{key}".format(key=key))
-                method = None
-                try:
-                    method_name = 'recv_' + key
-                    log.info("Method name is " + method_name)
-                    method = getattr(self, method_name)
-                except AttributeError as e:
-                    self.log('AttributeError: Parsing a line from lunch-slave %s: %s' % (self.identifier, key), logging.ERROR)
-                    self.log(line_str)
-                    #self.log(line)
-                else:
-                    method(mess)
+            key, _, mess = line_str.partition(" ")
+        # Dispatch the command to the appropriate method.  Note that all you
+        # need to do to implement a new command is add another recv_* method.
+        method = self._recv_methods.get(key)
+        if method is None:
+            self.log('No such message from lunch-slave %s: %s' % (self.identifier, key), logging.ERROR)
+            self.log(line_str)
+        else:
+            method(self, mess)
 
     def recv_ok(self, mess):
         """
@@ -536,7 +980,33 @@ class Command(object):
         self.log("lunch-slave %s> retval %s" % (self.identifier, mess))
         words = mess.split(" ")
         self.retval = int(words[0])
-        self.log("%s: Return value of child is %s" % (self.identifier, self.retval), logging.INFO)
+        if self.exit_reason == EXIT_REASON_OOM:
+            self.log("%s: Return value of child is %s. It was killed because it used more than its memory_max of %s bytes." % (self.identifier, self.retval, self.memory_max), logging.ERROR)
+        else:
+            self.log("%s: Return value of child is %s" % (self.identifier, self.retval), logging.INFO)
+
+    def recv_exit_reason(self, mess):
+        """
+        Callback for the "exit_reason" message from the lunch-slave.
+
+        It comes before the "retval" one when we know why the child exited.
+        For now, it is only "oom", when the kernel killed it because it used
+        more memory than its cgroup allows.
+        """
+        self.exit_reason = mess.strip()
+
+    def recv_limits(self, mess):
+        """
+        Callback for the "limits" message from the lunch-slave.
+
+        It is followed by the key=value pairs of the limits that it applies
+        to the child it is starting.
+        """
+        self.applied_limits = {}
+        for key_val in mess.split():
+            key, _, value = key_val.partition("=")
+            self.applied_limits[key] = value
+        self.log("lunch-child %s> Its limits are %s" % (self.identifier, mess), logging.INFO)
     
     def recv_log(self, mess):
         """
@@ -549,29 +1019,156 @@ class Command(object):
         Callback for the "error" message from the lunch-slave.
         """
         self.log("lunch-slave %s> error %s" % (self.identifier, mess), logging.ERROR)
+        self._start_sent = False # it might have refused to start the child
     
     def recv_pong(self, mess):
         """
         Callback for the "pong" message from the lunch-slave.
+        It is followed by the sequence number of the ping, except with old
+        lunch-slaves.
         """
-        pass #self.log("pong from %s" % (self.identifier))
+        if self._heartbeat is None:
+            return
+        sequence = None
+        if mess.strip().isdigit():
+            sequence = int(mess)
+        rtt = self._heartbeat.pong_received(sequence)
+        if rtt is not None and self.verbose:
+            self.log("lunch-slave %s> pong after %f ms" % (self.identifier, rtt * 1000.0))
+
+    def _start_heartbeat(self):
+        if self.heartbeat_idle <= 0 or self._heartbeat is not None:
+            return
+        self._heartbeat = heartbeat.Heartbeat(self.send_ping,
+                self._on_slave_lost, idle=self.heartbeat_idle,
+                interval=self.heartbeat_interval,
+                probes=self.heartbeat_probes, histogram=self.rtt)
+        self._heartbeat.start()
+
+    def _stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._heartbeat.stop()
+            self._heartbeat = None
+
+    def _on_slave_lost(self):
+        """
+        The lunch-slave did not answer the last pings. Its SSH connection or
+        its host is probably hung, so we kill it. Its child is then stopped
+        and started again like when the lunch-slave dies.
+        """
+        self._stop_heartbeat()
+        self.slave_lost_count += 1
+        self.log("lunch-slave %s> Lost: no answer to %d pings in %s seconds. Killing it." % (
+                self.identifier, self.heartbeat_probes,
+                self.heartbeat_idle + self.heartbeat_interval * self.heartbeat_probes), logging.ERROR)
+        if self.child_state != STATE_STOPPED:
+            self._give_up_if_we_should()
+        if self.shared_slave is not None:
+            self.shared_slave.kill()
+        else:
+            try:
+                self._process_transport.signalProcess(9) # signal.SIGKILL
+            except error.ProcessExitedAlready:
+                pass
 
     def recv_bye(self, mess):
         """
         Callback for the "bye" message from the lunch-slave.
         """
-        self.log("lunch-slave %s> %s" % (self.identifier, "BYE (slave quits)"), logging.ERROR)
+        self.log("lunch-slave %s> %s" % (self.identifier, "BYE (slave quits)"), logging.INFO)
     
+    def recv_probe(self, mess):
+        """
+        Callback for the "probe" message from the lunch-slave.
+
+        Tells if the child passed its readiness probe ("ok") or not
+        ("timeout"), and after how many seconds. If not, it is restarted.
+        """
+        words = mess.split(" ")
+        if self.child_state != STATE_RUNNING:
+            return
+        if words[0] == "ok":
+            self.log("lunch-child %s> is ready." % (self.identifier), logging.INFO)
+            self.child_ready = True
+            self.ready_at = time.time()
+            self.scheduling_changed_signal(self) # its dependees can be started now
+        else:
+            self.log("lunch-child %s> is not ready after %s seconds. Restarting it." % (self.identifier, self.ready_timeout), logging.ERROR)
+            self._restart_child()
+
+    def recv_sockets(self, mess):
+        """
+        Callback for the "sockets" message from the lunch-slave.
+
+        The sockets of the child are bound, and it is about to be started.
+        """
+        self.log("lunch-child %s> Its %s sockets are bound." % (self.identifier, mess))
+        self.sockets_bound = True
+        self.ready_at = time.time()
+        self.scheduling_changed_signal(self)
+
+    def recv_resources(self, mess):
+        """
+        Callback for the "resources" message from the lunch-slave.
+
+        It is followed by the key=value pairs of the resources of the child
+        that changed since the previous one. See the ResourceSampler of the
+        lunch-slave.
+        """
+        for key_val in mess.split():
+            key, _, value = key_val.partition("=")
+            try:
+                if key == "cpu":
+                    self.resources[key] = float(value)
+                else:
+                    self.resources[key] = int(value)
+            except ValueError:
+                self.log("Wrong resource from lunch-slave %s: %s" % (self.identifier, key_val), logging.ERROR)
+        self.resource_history.append((time.time(), dict(self.resources)))
+        self.resources_changed_signal(self, self.resources)
+
+    def recv_child_status(self, mess):
+        """
+        Callback for the "child_status" message from the lunch-slave.
+
+        The child sent STATUS=... to its NOTIFY_SOCKET.
+        """
+        self.child_status = mess
+        self.log("lunch-child %s> status: %s" % (self.identifier, mess), logging.INFO)
+
+    def recv_watchdog(self, mess):
+        """
+        Callback for the "watchdog" message from the lunch-slave.
+
+        The child did not send WATCHDOG=1 in time, so it is considered hung
+        and restarted.
+        """
+        if self.child_state != STATE_RUNNING:
+            return
+        self.log("lunch-child %s> did not ping its watchdog for %s seconds. It is hung. Restarting it." % (self.identifier, self.watchdog_sec), logging.ERROR)
+        self._restart_child()
+
+    def _restart_child(self):
+        """
+        Stops a running child that is not working, so that the master
+        starts it again after the try_again_delay.
+        """
+        self._give_up_if_we_should()
+        self._stop_sent = True
+        self.send_stop()
+
     def get_state_info(self):
         """
         Returns a high-level comprehensive state for the user to see in the GUI.
         """
         #log.debug("gave up: %s" % (self.gave_up))
         if self.child_state == STATE_STOPPED:
-            if self.how_many_times_run == 0:
-                return INFO_TODO
-            elif self.gave_up:
+            if self.gave_up:
                 return INFO_GAVEUP
+            elif self.exit_reason == EXIT_REASON_OOM:
+                return INFO_OOM
+            elif self.how_many_times_run == 0:
+                return INFO_TODO
             elif not self.respawn:
                 return INFO_DONE
             elif not self.enabled:
@@ -580,6 +1177,9 @@ class Command(object):
                 return INFO_FAILED
             else:
                 return STATE_STOPPED # INFO_FAILED?
+        elif self.child_state == STATE_RUNNING and self.child_ready and \
+                self.get_probe() is not None:
+            return INFO_READY
         else:
             return self.child_state
     
@@ -587,17 +1187,22 @@ class Command(object):
         """
         Check if we should give up and give up if so.
         """
-        # double the time to wait before trying again.
-        # self.wait_before_trying_again -- this one never changes
-        # self._wait_before_trying_again_next_time -- this one is doubled each time.
+        # double the time to wait before trying again, up to its maximum.
+        # self.try_again_delay -- this one never changes
+        # self._current_try_again_delay -- this one is doubled each time.
+        # We wait a random time up to it (full jitter), so that the commands
+        # that crashed together do not try again together.
         if self.give_up_after != 0 and self.how_many_times_tried > self.give_up_after:
             self.gave_up = True
             self.enabled = False
             log.info("Gave up restarting command %s" % (self.identifier))
         else:
-            self._next_try_time = time.time() + self._current_try_again_delay
-            log.info("%s: Will wait %f seconds before trying again." % (self.identifier, self._current_try_again_delay))
-            self._current_try_again_delay *= 2
+            # max_try_again_delay may have been lowered since it was doubled.
+            self._current_try_again_delay = min(self._current_try_again_delay, self.max_try_again_delay)
+            delay = random.uniform(0, self._current_try_again_delay)
+            self._set_next_try_time(time.time() + delay)
+            log.info("%s: Will wait %f seconds before trying again." % (self.identifier, delay))
+            self._current_try_again_delay = min(self._current_try_again_delay * 2, self.max_try_again_delay)
             self.how_many_times_tried += 1
 
     def recv_state(self, mess):
@@ -629,30 +1234,141 @@ class Command(object):
         It means it is ready to received commands.
         """
         self._received_ready = True
-        if self.enabled:
+        words = mess.split()
+        version = 1
+        if words and words[0].isdigit():
+            version = min(int(words[0]), PROTOCOL_VERSION)
+            if self.cpu_placement is not None and len(words) > 1:
+                try:
+                    cores = [[int(cpu) for cpu in word.split(",")] for word in words[1:]]
+                except ValueError:
+                    self.log("Wrong cores from lunch-slave %s: %s" % (self.identifier, mess), logging.ERROR)
+                else:
+                    self.cpu_placement.set_topology(self.get_host_key(), cores)
+        if version >= 2:
+            self.send_message("protocol", str(version)) # still in version 1
+        self.protocol_version = version
+        self._start_heartbeat()
+        if self.enabled and self._start_child_when_ready:
             self._send_all_startup_commands()
+        else:
+            self.scheduling_changed_signal(self) # it can be started now
 
     def _send_all_startup_commands(self):
         """
         Tells the lunch-slave to launch its child process.
         Sets up the environment and command so that the lunch-slave can launch the child.
-        """
+
+        With the protocol version 2, they are all in one message.
+        """
+        self._start_sent = True
+        if self.protocol_version >= 2:
+            options = {"command": self.command, "logdir": self.child_log_dir,
+                    "env": self.env}
+            if self.get_probe() is not None:
+                options["probe"] = self.get_probe()
+            if self.notify or self.watchdog_sec:
+                options["notify"] = self.notify
+                options["watchdog"] = self.watchdog_sec
+            if self.sockets:
+                options["sockets"] = self.sockets
+            if self.sample_every:
+                options["sample_every"] = self.sample_every
+            if self.get_limits() is not None:
+                options["limits"] = self.get_limits()
+            if self.cpus:
+                self.affinity = self._get_affinity()
+                if self.affinity is not None:
+                    options["affinity"] = self.affinity
+            self.send_message("start", options)
+            self.log("run: lunch-child %s> $ %s" % (self.identifier, self.command), logging.INFO)
+            return
+        if self.sockets:
+            self.log("lunch-slave %s is too old for socket activation. Its child will bind its own sockets." % (self.identifier), logging.WARNING)
+        if self.get_limits() is not None or self.cpus:
+            self.log("lunch-slave %s is too old to limit the resources of its child. They are not limited." % (self.identifier), logging.WARNING)
         self.send_do()
         self.send_logdir()
         self.send_env()
         #self.send_ping()
         self.send_run()
 
+    def get_host_key(self):
+        """
+        Returns the name of the host of the child, for the CPU placement.
+        @rtype: C{str}
+        """
+        return self.host or "localhost"
+
+    def _get_affinity(self):
+        """
+        Returns the CPUs that the master assigned to the child, or None if
+        it cannot have the ones it asks for.
+        @rtype: C{list}
+        """
+        if self.cpu_placement is None:
+            return None
+        host = self.get_host_key()
+        if self.cpu_placement.get_topology(host) is None:
+            self.log("The CPUs of %s are unknown. %s can run on any of them." % (host, self.identifier), logging.WARNING)
+            return None
+        affinity = self.cpu_placement.assign(host, self.identifier, self.cpus)
+        if affinity is None:
+            self.log("Not enough free CPUs on %s for the %d of %s. It can run on any of them." % (host, self.cpus, self.identifier), logging.WARNING)
+        return affinity
+
+    def get_limits(self):
+        """
+        Returns the limits of the resources of the child, as given to the
+        lunch-slave, or None if there are none.
+        @rtype: C{dict}
+        """
+        limits = {}
+        if self.rlimits:
+            limits["rlimits"] = self.rlimits
+        for key in ["nice", "ionice", "memory_max", "cpu_max"]:
+            if getattr(self, key) is not None:
+                limits[key] = getattr(self, key)
+        if self.realtime_priority is not None:
+            limits["realtime_priority"] = self.realtime_priority
+            limits["realtime_policy"] = self.realtime_policy
+        if self.mlock_all:
+            limits["mlock_all"] = True
+        if not limits:
+            return None
+        return limits
+
     def _set_child_state(self, new_state):
         """
         Called when it is time to change the state of the child process.
         """
+        if new_state == STATE_STARTING:
+            self.exit_reason = None
         if new_state == STATE_STOPPED:
             self.child_pid = None
+            self.child_status = None
+            self.sockets_bound = False
+            self.resources = {}
+            self.start_requested_at = None
+        self._start_sent = False
         if self.child_state != new_state:
+            self.child_ready = False
             if new_state == STATE_RUNNING:
                 self.how_many_times_run += 1
+                self.started_running_at = time.time()
+                if self.get_probe() is None:
+                    self.child_ready = True
+                    if not self.sockets_bound: # ready since they were bound
+                        self.ready_at = self.started_running_at
+                elif self.protocol_version < 2:
+                    self.log("lunch-slave %s is too old to probe or watch its child. It is ready as soon as it is running." % (self.identifier), logging.WARNING)
+                    self.child_ready = True
+                    self.ready_at = self.started_running_at
+                if self.start_requested_at is not None:
+                    self.time_to_running = self.started_running_at - self.start_requested_at
+                    self.start_requested_at = None
             self.child_state = new_state
+            self._stop_sent = False
         #    log.msg(" --------------- XXX Trigerring signal %s" % (self.child_state))
             self.child_state_changed_signal(self, self.child_state)
 
@@ -662,8 +1378,8 @@ class Command(object):
         """
         self.how_many_times_tried += 1
         self.gave_up = False
-        self._next_try_time = 0
-        self._current_try_again_delay = self.try_again_delay
+        self._set_next_try_time(0)
+        self._current_try_again_delay = min(self.try_again_delay, self.max_try_again_delay)
     
     def stop(self):
         """
@@ -673,6 +1389,7 @@ class Command(object):
         self.enabled = False
         if self.child_state in [STATE_RUNNING, STATE_STARTING]:
             self.log('%s: stop' % (self.identifier), logging.INFO)
+            self._stop_sent = True
             self.send_stop()
         else:
             msg = "Cannot stop child %s that is %s." % (self.identifier, self.child_state)
@@ -692,6 +1409,8 @@ class Command(object):
 
         @rtype: L{twisted.internet.defer.Deferred}
         """
+        if self.shared_slave is not None:
+            return self._quit_shared_slave()
         DELAY_BETWEEN_EACH_SIGNAL = self.delay_before_kill
         if self._quit_slave_deferred is not None:
             raise RuntimeError("Slave seems to be already quitting.")
@@ -739,6 +1458,19 @@ class Command(object):
                 _cl_sigkill()
         return self._quit_slave_deferred
 
+    def _quit_shared_slave(self):
+        """
+        Tells the shared lunch-slave to stop our child and forget about it.
+        The lunch-slave process quits once no command uses it anymore.
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        if self.slave_state == STATE_RUNNING:
+            if self.child_state in [STATE_RUNNING, STATE_STARTING]:
+                self.stop()
+            self.send_message("quit")
+        self.set_slave_state(STATE_STOPPED)
+        return self.shared_slave.release(self)
+
     def _on_process_ended(self, exit_code):
         """
         The lunch-slave died ! Its child is probably dead too. (otherwise, it's a zombie with no parent)
@@ -746,6 +1478,7 @@ class Command(object):
         #TODO: add a signal slot for this event?
         #self.log("Exit code: " % (exit_code))
         former_slave_state = self.slave_state
+        self._stop_heartbeat()
         if former_slave_state == STATE_STARTING:
             self.log("Slave %s died during startup." % (self.identifier), logging.ERROR)
         elif former_slave_state == STATE_RUNNING:
@@ -756,7 +1489,11 @@ class Command(object):
         elif former_slave_state == STATE_STOPPING:
             self.log('Slave exited as expected.')
         self.set_slave_state(STATE_STOPPED)
-        self._process_transport.loseConnection()
+        if self.child_state != STATE_STOPPED:
+            self.log("The child of lunch-slave %s is lost with it." % (self.identifier), logging.ERROR)
+            self._set_child_state(STATE_STOPPED)
+        if self.shared_slave is None:
+            self._process_transport.loseConnection()
         #if self.respawn and self.enabled: #No! The master will take care of that.
         #    self.log("Restarting the lunch-slave %s." % (self.identifier), logging.INFO)
         #    self.start()
@@ -768,28 +1505,11 @@ class Command(object):
         Logs both to the lunch-slave's log file, and to the main app log. 
         """
         if self.slave_logger is not None:
-            prefix = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-            self.slave_logger.write("%s %s\n" % (prefix, msg))
-            self.slave_logger.flush()
-        log_number_to_name = {
-            logging.DEBUG: 'debug',
-            logging.INFO: 'info',
-            logging.WARNING: 'warning',
-            logging.ERROR: 'error',
-            logging.CRITICAL: 'critical',
-            }
-        if level == logging.DEBUG:
-            log.debug(msg)
-        elif level == logging.INFO:
-            log.info(msg)
-        elif level == logging.WARNING:
-            log.warning(msg)
-        elif level == logging.ERROR:
-            log.error(msg)
-        elif level == logging.CRITICAL:
-            log.critical(msg)
-
-        #log.msg(msg, logLevel=level)
+            self.slave_logger.write("%s %s\n" % (logsink.format_time(), msg))
+            if self.log_sink is None:
+                self.slave_logger.flush() # otherwise, the sink writes it soon
+        if log.isEnabledFor(level):
+            log.log(level, msg)
 
     def set_slave_state(self, new_state):
         """
@@ -797,9 +1517,11 @@ class Command(object):
         """
         msg = "Slave %s is %s." % (self.identifier, new_state)
         self.log(msg)
+        if new_state != STATE_RUNNING:
+            self._stop_heartbeat()
         if self.slave_state != new_state:
             self.slave_state = new_state
-            self.slave_state_changed_signal(self.slave_state)
+            self.slave_state_changed_signal(self, self.slave_state)
 
     def __str__(self):
         return "%s" % (self.identifier)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Heap of deadlines, so that the master knows when it should check a command
+again, without looking at all of them.
+
+Example : a command that crashed must wait 0.5 second before we try to start
+it again. The master stores that time here and wakes up at the earliest one.
+"""
+import heapq
+
+
+class DeadlineHeap(object):
+    """
+    Stores at most one deadline for each key.
+
+    Setting a new deadline for a key replaces its previous one. Replaced and
+    removed deadlines are left in the heap and skipped when they come up.
+    """
+    def __init__(self):
+        self._deadlines = {} # dict key: deadline
+        self._heap = [] # list of (deadline, counter, key) tuples
+        self._counter = 0 # so that keys never get compared
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def set(self, key, deadline):
+        """
+        Sets the deadline of a key.
+        @param deadline: Time, in seconds since the epoch.
+        @type deadline: C{float}
+        """
+        if self._deadlines.get(key) == deadline:
+            return
+        self._deadlines[key] = deadline
+        self._counter += 1
+        heapq.heappush(self._heap, (deadline, self._counter, key))
+        if len(self._heap) > 2 * len(self._deadlines) + 16:
+            self._compact()
+
+    def get(self, key):
+        """
+        Returns the deadline of a key, or None.
+        """
+        return self._deadlines.get(key)
+
+    def remove(self, key):
+        """
+        Removes the deadline of a key, if any.
+        """
+        self._deadlines.pop(key, None)
+
+    def get_earliest(self):
+        """
+        Returns the earliest deadline, or None if there is none.
+        @rtype: C{float}
+        """
+        self._skip_stale()
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def pop_expired(self, now):
+        """
+        Removes and returns the keys whose deadline is now or before.
+        @rtype: C{list}
+        @return: Keys, from the earliest to the latest deadline.
+        """
+        ret = []
+        while True:
+            self._skip_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            deadline, counter, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            ret.append(key)
+        return ret
+
+    def clear(self):
+        self._deadlines.clear()
+        del self._heap[:]
+
+    def _skip_stale(self):
+        """
+        Pops the entries at the top of the heap that were replaced or removed.
+        """
+        heap = self._heap
+        while heap and self._deadlines.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def _compact(self):
+        """
+        Rebuilds the heap without the replaced or removed entries.
+        """
+        self._heap = [entry for entry in self._heap
+                if self._deadlines.get(entry[2]) == entry[0]]
+        heapq.heapify(self._heap)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Splitting of a stream of bytes into lines.
+
+Twisted gives the data of a process in chunks of arbitrary size, which do
+not end where the lines end. A line split across two reads must be
+given in one piece, once its end has been received.
+"""
+MAX_LINE_LENGTH = 65536 # bytes
+
+class LineFramer(object):
+    """
+    Buffers the data received from a stream and calls a function with each
+    complete line of it, as a str, without its end of line.
+
+    Both "\\n" and "\\r\\n" end a line, since the lunch-slave talks through
+    a pseudo-terminal. Empty lines are skipped.
+    """
+    def __init__(self, line_received, max_length=MAX_LINE_LENGTH, line_too_long=None, encoding="utf-8"):
+        """
+        @param line_received: Called with each line, as a str.
+        @type line_received: callable
+        @param max_length: Maximum length of a line, in bytes. Longer lines are discarded.
+        @type max_length: int
+        @param line_too_long: Called with the length of the discarded data when a line is too long. Optional.
+        @type line_too_long: callable
+        @param encoding: Encoding of the stream. Invalid bytes are replaced.
+        @type encoding: str
+        """
+        self.line_received = line_received
+        self.line_too_long = line_too_long
+        self.max_length = max_length
+        self.encoding = encoding
+        self._buffer = bytearray()
+        self._discarding = False # until the end of a line that is too long
+
+    def feed(self, data):
+        """
+        Adds some data to the buffer and gives all the complete lines.
+        @param data: Chunk of the stream.
+        @type data: bytes, bytearray or memoryview
+        """
+        buf = self._buffer
+        buf += data
+        start = 0
+        # Each line is decoded from a view of the buffer, so that it is only
+        # copied once, and the buffer is shifted once per chunk.
+        try:
+            with memoryview(buf) as view:
+                while True:
+                    newline = buf.find(b"\n", start)
+                    if newline == -1:
+                        break
+                    begin = start
+                    end = newline
+                    start = newline + 1
+                    if end > begin and buf[end - 1] == 0x0d: # "\r"
+                        end -= 1
+                    if self._discarding:
+                        self._discarding = False
+                    elif end - begin > self.max_length:
+                        self._discard(end - begin)
+                    elif end > begin:
+                        self.line_received(str(view[begin:end], self.encoding, "replace"))
+        finally:
+            del buf[:start]
+        if len(buf) > self.max_length:
+            if not self._discarding:
+                self._discard(len(buf))
+            self._discarding = True
+            del buf[:]
+
+    def flush(self):
+        """
+        Gives what is left in the buffer as a last line, once the stream
+        has been closed.
+        """
+        rest = bytes(self._buffer.rstrip(b"\r"))
+        del self._buffer[:]
+        if self._discarding:
+            self._discarding = False
+        elif rest != b"":
+            self.line_received(rest.decode(self.encoding, "replace"))
+
+    def _discard(self, length):
+        if self.line_too_long is not None:
+            self.line_too_long(length)
@@ -39,19 +39,61 @@ class DirectedGraph(object):
 
     Some nodes can have two parents, but orphans are children of the root.
     
+    Nodes are indexed in two dicts, so that looking up the dependencies of a
+    node, or the nodes it supports, does not need to scan the whole graph.
+    Both dicts keep the order in which nodes were added.
+
+    The transitive closures returned by get_all_dependencies and
+    get_all_dependees are cached, and the cache entries that an edge change
+    could affect are dropped when edges are added or removed.
+
+    The version attribute is incremented each time a node or an edge is added
+    or removed. The launch order is only computed again when it has changed.
+
     Inspired from networkx.digraph.DiGraph
     """
     ROOT = "__ROOT__" # the root node, to which all depend
     def __init__(self):
-        self.deps = [] # dict node: list of [k, []] lists.
-        self.deps.append([self.ROOT, []])
+        self._dependencies = {} # dict node: list of nodes it depends on.
+        self._dependees = {} # dict node: dict of nodes that depend on it.
+        self._order = {} # dict node: int index. (order in which it was added)
+        self._next_index = 0
+        self._ancestors = {} # cache. dict node: dict of all its dependencies.
+        self._descendants = {} # cache. dict node: dict of all its dependees.
+        self.closure_cache_hits = 0
+        self.closure_cache_misses = 0
+        self.version = 0
+        self._launch_order = None
+        self._launch_positions = None # dict node: index in the launch order
+        self._launch_order_version = None
+        self._add_empty_node(self.ROOT)
+
+    def _add_empty_node(self, node):
+        self.version += 1
+        self._dependencies[node] = []
+        self._dependees[node] = {}
+        self._order[node] = self._next_index
+        self._next_index += 1
 
     def clear(self):
         """
         Removes all nodes and dependencies, except the root.
         """
-        self.deps = [[self.ROOT, []]]
+        self._dependencies = {}
+        self._dependees = {}
+        self._order = {}
+        self._next_index = 0
+        self._ancestors = {}
+        self._descendants = {}
+        self._add_empty_node(self.ROOT)
     
+    def has_node(self, node):
+        """
+        Checks if a node is in the graph.
+        @rtype: C{bool}
+        """
+        return node in self._dependencies
+
     def add_node(self, node, deps=None):
         """
         Adds a node to the graph, pointing to its dependencies. If no dependency is specified, it will point to the root.
@@ -59,8 +101,8 @@ class DirectedGraph(object):
         @param deps: :{list} of L{str} Its dependencies.
         Raises a GraphError if creating circular dependencies.
         """
-        if node not in self.get_all_nodes():
-            self.deps.append([node, []])
+        if node not in self._dependencies:
+            self._add_empty_node(node)
         if deps is not None:
             if type(deps) is list:
                 self.add_dependencies(node, deps)
@@ -80,16 +122,28 @@ class DirectedGraph(object):
         @param node_from: str
         @param node_to: str
         """
+        dependencies = self._get_dependencies_list(node_from)
         # makes sure we don't already have this node
-        dependencies = self.get_dependencies(node_from)
         if node_to not in dependencies:
+            if node_to not in self._dependencies:
+                raise GraphError("The is no %s node in the dependencies graph." % (node_to))
             # prevent from circular dependencies
-            if self.depends_on(node_to, node_from):
+            if node_to == node_from or self.depends_on(node_to, node_from):
                 raise GraphError("Circular dependency detected. A node cannot depend on itself.")
             else:
+                self._invalidate_closures(node_from, node_to)
                 dependencies.append(node_to)
-        elif node_to not in self.deps:
-            raise GraphError("The is no %s node in the dependencies graph." % (node_to))
+                self._dependees[node_to][node_from] = None
+
+    def _get_dependencies_list(self, node):
+        """
+        Returns the list in which we store the dependencies of a node.
+        Raises a GraphError if there is no such node.
+        """
+        try:
+            return self._dependencies[node]
+        except KeyError:
+            raise GraphError("No node %s in graph." % (node))
 
     def get_dependencies(self, node):
         """
@@ -98,14 +152,10 @@ class DirectedGraph(object):
         @rettype list
         @param node: str
         """
-        for k, v in self.deps:
-            if k is node:
-                return v
-        # else:
-        raise GraphError("No node %s in graph." % (node))
+        return list(self._get_dependencies_list(node))
 
     def get_all_nodes(self):
-        return [k for k, v in self.deps]
+        return list(self._dependencies)
 
     def get_root(self):
         """
@@ -118,87 +168,207 @@ class DirectedGraph(object):
         """
         If no dependency if left, it will depend on the root.
         """
-        # might raise a ValueError
-        dependencies = self.get_dependencies(node_from)
+        dependencies = self._get_dependencies_list(node_from)
         if node_to in dependencies:
-            dependencies.remove(node_to) 
-            if dependencies == []:
-                dependencies.append(self.ROOT)
+            self._remove_edge(node_from, node_to)
         else:
-            raise GraphError("No dependency %s for node %s.", node_to, node_from)
+            raise GraphError("No dependency %s for node %s." % (node_to, node_from))
+
+    def _remove_edge(self, node_from, node_to):
+        """
+        Removes an edge from both indexes.
+        If no dependency if left, node_from will depend on the root.
+        """
+        self._invalidate_closures(node_from, node_to)
+        dependencies = self._dependencies[node_from]
+        dependencies.remove(node_to)
+        del self._dependees[node_to][node_from]
+        if dependencies == []:
+            self._invalidate_closures(node_from, self.ROOT)
+            dependencies.append(self.ROOT)
+            self._dependees[self.ROOT][node_from] = None
         
     def remove_node(self, node):
         """
         Removes a node from the graph.
         Removes all the dependencies of other nodes to this one.
         """
-        if node in self.get_all_nodes():
-            for k, v in self.deps:
-                if k is node:
-                    self.deps.remove([k, v])
-        else:
+        if node == self.ROOT:
+            raise GraphError("Cannot remove the root of the graph.")
+        if node not in self._dependencies:
             raise GraphError("No node %s in graph." % (node))
+        for dependee in list(self._dependees[node]):
+            self._remove_edge(dependee, node)
+        for dependency in self._dependencies[node]:
+            self._invalidate_closures(node, dependency)
+            del self._dependees[dependency][node]
+        del self._dependencies[node]
+        del self._dependees[node]
+        del self._order[node]
+        self.version += 1
 
     def get_supported_by(self, node=None):
         """
         Returns the list of nodes that are directly supported by the given one.
+        They are in the order in which they were added to the graph.
         @param node: str or None. If None, will return the nodes supported by the root.
         """
         if node is None:
             node = self.ROOT
-        ret = []
-        for k, v in self.deps:
-            if node in v:
-                ret.append(k)
-        return ret
+        dependees = self._dependees.get(node)
+        if not dependees:
+            return []
+        return sorted(dependees, key=self._order.__getitem__)
 
     def get_all_dependees(self, node=None):
         """
         Returns the list of all the nodes that are supported by the given one, recursively !
+        Each node is listed once, in depth-first order.
         @param node: str or None. If None, will return the nodes supported by the root.
         """
         if node is None:
             node = self.ROOT
-        ret = []
-        for k, v in self.deps:
-            if node in v:
-                ret.append(k)
-                ret.extend(self.get_all_dependees(k))
-        return ret
+        return list(self._get_descendants(node))
         
     def get_all_dependencies(self, node):
         """
-        Returns the list of all the nodes that are supported by the given one, recursively !
+        Returns the list of all the nodes to which the given one depends, recursively !
+        Each node is listed once, in depth-first order. The root is not listed.
         @param node: str 
         """
-        ret = []
-        for k in self.get_dependencies(node):
-            if k != self.ROOT:
-                ret.append(k)
-                ret.extend(self.get_all_dependencies(k))
-        return ret
+        return list(self._get_ancestors(node))
 
     def depends_on(self, node, searched):
         """
         Checks if a node depends on another.
-        Recursive method. (might be limited by sys.getrecursionlimit())
         """
-        if node is self.ROOT:
+        if node == self.ROOT:
             return False
-        #elif node is searched:
-        #    raise GraphError("Both given nodes are the same.")
+        elif searched == self.ROOT:
+            self._get_dependencies_list(node) # raises if there is no such node
+            return True
         else:
-            li = self.get_dependencies(node)
-            for i in li:
-                if i is searched:
-                    return True
+            return searched in self._get_ancestors(node)
+
+    def get_launch_order(self):
+        """
+        Returns all the nodes, starting with the root, in an order in which
+        each node comes after all the nodes it depends on.
+
+        Siblings are in the order in which they were added, like with
+        iter_from_root_to_leaves, but a node that depends on many others is
+        only listed once the last of them has been listed.
+        The result is cached until the graph changes.
+        @rtype: C{tuple}
+        """
+        if self._launch_order_version != self.version:
+            remaining = {} # dict node: number of dependencies not listed yet
+            for node, dependencies in self._dependencies.items():
+                remaining[node] = len(dependencies)
+            order = [self.ROOT]
+            stack = [iter(self.get_supported_by(self.ROOT))]
+            while stack:
+                for current in stack[-1]:
+                    remaining[current] -= 1
+                    if remaining[current] == 0:
+                        order.append(current)
+                        stack.append(iter(self.get_supported_by(current)))
+                        break
                 else:
-                    if i is not self.ROOT:
-                        res = self.depends_on(i, searched)
-                        if res:
-                            return True
-            # if not found
-            return False
+                    stack.pop()
+            self._launch_order = tuple(order)
+            self._launch_positions = dict((node, i) for i, node in enumerate(order))
+            self._launch_order_version = self.version
+        return self._launch_order
+
+    def sort_in_launch_order(self, nodes):
+        """
+        Returns the given nodes sorted in the order of get_launch_order.
+        Nodes that are not in the graph are left out.
+        @rtype: C{list}
+        """
+        self.get_launch_order()
+        positions = self._launch_positions
+        return sorted([node for node in nodes if node in positions],
+                key=positions.__getitem__)
+
+    def get_closure_cache_stats(self):
+        """
+        Returns the statistics of the cache of transitive dependencies.
+        @return: dict with the "hits", "misses" and "size" keys.
+        @rtype: C{dict}
+        """
+        return {
+            "hits": self.closure_cache_hits,
+            "misses": self.closure_cache_misses,
+            "size": len(self._ancestors) + len(self._descendants),
+            }
+
+    def _get_ancestors(self, node):
+        """
+        Returns the (cached) dict of all the nodes to which a node depends.
+        """
+        try:
+            ret = self._ancestors[node]
+        except KeyError:
+            self.closure_cache_misses += 1
+            self._get_dependencies_list(node) # raises if there is no such node
+            ret = self._walk(node, self._dependencies.__getitem__)
+            self._ancestors[node] = ret
+        else:
+            self.closure_cache_hits += 1
+        return ret
+
+    def _get_descendants(self, node):
+        """
+        Returns the (cached) dict of all the nodes that depend on a node.
+        """
+        try:
+            ret = self._descendants[node]
+        except KeyError:
+            self.closure_cache_misses += 1
+            if node not in self._dependees:
+                return {} # not cached, as it used to return an empty list
+            ret = self._walk(node, self.get_supported_by)
+            self._descendants[node] = ret
+        else:
+            self.closure_cache_hits += 1
+        return ret
+
+    def _walk(self, node, get_next_nodes):
+        """
+        Depth-first walk, without recursion, from a node.
+        @param get_next_nodes: Callable that returns the nodes to visit after a given one.
+        @return: dict whose keys are the visited nodes, except the start node and the root.
+        """
+        visited = {}
+        stack = [iter(get_next_nodes(node))]
+        while stack:
+            for current in stack[-1]:
+                if current != self.ROOT and current not in visited:
+                    visited[current] = None
+                    stack.append(iter(get_next_nodes(current)))
+                    break
+            else:
+                stack.pop()
+        return visited
+
+    def _invalidate_closures(self, node_from, node_to):
+        """
+        Drops the cached closures that an edge from node_from to node_to
+        changes: the dependencies of node_from and of all its dependees, and
+        the dependees of node_to and of all the nodes it depends on.
+        """
+        self.version += 1
+        if self._ancestors:
+            self._ancestors.pop(node_from, None)
+            for node in self._walk(node_from, self._dependees.__getitem__):
+                self._ancestors.pop(node, None)
+        if self._descendants:
+            self._descendants.pop(node_to, None)
+            self._descendants.pop(self.ROOT, None)
+            for node in self._walk(node_to, self._dependencies.__getitem__):
+                self._descendants.pop(node, None)
 
     def _traverse(self, node, indent=0):
         """
@@ -226,11 +396,11 @@ def iter_from_root_to_leaves(graph):
     @return: An iterator.
     """
     current = graph.ROOT
-    visited = [] # list of visited nodes.
+    visited = set() # visited nodes.
     stack = [] # stack of iterators
     while True:
         if current not in visited:
-            visited.append(current)
+            visited.add(current)
             # DO YOUR STUFF HERE
             yield current
             children = graph.get_supported_by(current)
@@ -38,6 +38,7 @@ from lunch import __version__
 from lunch import dialogs
 from lunch.states import *
 from lunch import logger
+from lunch import placement
 
 #TODO: i18nize
 def _(value):
@@ -133,6 +134,46 @@ def man_lunch():
     log.info("$ %s" % (" ".join(cmd)))
     run_once(*cmd)
     
+def _format_ssh_error(ssh_error):
+    """
+    Shows the code of a SSH error, and whether we will try again.
+    """
+    if ssh_error is None:
+        return None
+    if ssh_error.retryable:
+        return "%s (retryable)" % (ssh_error.code)
+    return "%s (fatal)" % (ssh_error.code)
+
+def _format_rtt(stats):
+    """
+    Shows the round-trip times of the pings to a lunch-slave, in ms.
+    """
+    if stats["count"] == 0:
+        return None
+    return "last %.1f, median %.1f, p99 %.1f, max %.1f ms (%d pings)" % (
+            stats["last"] * 1000.0, stats["median"] * 1000.0,
+            stats["p99"] * 1000.0, stats["max"] * 1000.0, stats["count"])
+
+def _format_cpus(command):
+    """
+    Shows the CPUs assigned to a command, and the ones of the other commands
+    on the same host, like "2-3 (a: 0-1, b: 2-3)".
+    """
+    if command.cpu_placement is None:
+        return None
+    assignments = command.cpu_placement.get_assignments(command.get_host_key())
+    others = ", ".join(["%s: %s" % (identifier, placement.format_cpu_list(cpus))
+            for identifier, cpus in sorted(assignments.items())])
+    if command.identifier not in assignments:
+        return "%d wanted, not assigned (%s)" % (command.cpus, others)
+    return "%s (%s)" % (placement.format_cpu_list(assignments[command.identifier]), others)
+
+def _format_float_cell(column, cell, model, tree_iter, format_string):
+    """
+    Shows a float with the given format in a cell of the tree view.
+    """
+    cell.set_property("text", format_string % (model.get_value(tree_iter, column.get_sort_column_id())))
+
 def _format_command_line(text):
     """
     Formats the text of a command in order to display it in a gtk.TextView
@@ -262,7 +303,7 @@ class LunchApp(object):
         frame1.add(scroller)
         vpaned.add1(frame1)
         # The ListStore contains the data.
-        list_store = gtk.ListStore(str, str, str, int, str)
+        list_store = gtk.ListStore(str, str, str, int, str, float, float, int, int)
         # The TreeModelSort sorts the data
         self.model_sort = gtk.TreeModelSort(list_store)
         # The TreeView displays the sorted data in the GUI.
@@ -347,8 +388,20 @@ class LunchApp(object):
                 (_("delay_before_kill"), command.delay_before_kill),
                 (_("verbose"), command.verbose),
                 (_("how_many_times_tried"), command.how_many_times_tried),
+                (_("restarts throttled"), self.master.restart_budget.throttled_per_key[command.identifier]),
+                (_("time_to_running"), command.time_to_running),
+                (_("readiness probe"), command.get_probe()),
+                (_("child status"), command.child_status),
+                (_("sockets"), " ".join(command.sockets)),
                 (_("_has_shown_ssh_error"), command._has_shown_ssh_error),
+                (_("ssh_error"), _format_ssh_error(command.ssh_error)),
                 (_("gave_up"), command.gave_up),
+                (_("resources"), command.resources),
+                (_("limits"), command.applied_limits),
+                (_("cpus"), _format_cpus(command)),
+                (_("exit reason"), command.exit_reason),
+                (_("round-trip time"), _format_rtt(command.rtt.get_stats())),
+                (_("slave_lost_count"), command.slave_lost_count),
                 ]
             for key, val in keyval:
                 _format = "%" + ("%ds" % PADDING_IN_TEXTVIEW) + ": %s\n"
@@ -386,11 +439,11 @@ class LunchApp(object):
             self.openlog_button_widget.set_sensitive(False)
         else:
             # log.debug("command: %s" % (command.identifier))
-            if command.get_state_info() in [STATE_STARTING, STATE_RUNNING, STATE_STOPPING]:
+            if command.get_state_info() in [STATE_STARTING, STATE_RUNNING, INFO_READY, STATE_STOPPING]:
                 self.stop_command_button_widget.set_sensitive(True)
                 self.start_command_button_widget.set_sensitive(False)
                 self.openlog_button_widget.set_sensitive(True)
-            elif command.get_state_info() in [STATE_STOPPED, STATE_NOSLAVE, INFO_DONE, INFO_FAILED, INFO_TODO, INFO_GAVEUP]:
+            elif command.get_state_info() in [STATE_STOPPED, STATE_NOSLAVE, INFO_DONE, INFO_FAILED, INFO_TODO, INFO_GAVEUP, INFO_OOM]:
                 self.stop_command_button_widget.set_sensitive(False)
                 self.start_command_button_widget.set_sensitive(True)
                 self.openlog_button_widget.set_sensitive(True)
@@ -405,7 +458,7 @@ class LunchApp(object):
         sorting_column_number = 0
         # self.model_sort.set_sort_column_id(sorting_column_number, gtk.SORT_ASCENDING)
 
-        NUM_COLUMNS = 5
+        NUM_COLUMNS = 9
         columns = [None] * NUM_COLUMNS
         # Set column title
         columns[0] = gtk.TreeViewColumn(_("Identifier"))
@@ -413,6 +466,10 @@ class LunchApp(object):
         columns[2] = gtk.TreeViewColumn(_("Host"))
         columns[3] = gtk.TreeViewColumn(_("Executions")) # How many times
         columns[4] = gtk.TreeViewColumn(_("State")) # str
+        columns[5] = gtk.TreeViewColumn(_("CPU %")) # of the process tree
+        columns[6] = gtk.TreeViewColumn(_("Memory (MiB)")) # resident
+        columns[7] = gtk.TreeViewColumn(_("Threads"))
+        columns[8] = gtk.TreeViewColumn(_("Files")) # file descriptors
         
         # Set default properties for each column
         cells = [None] * NUM_COLUMNS
@@ -433,6 +490,10 @@ class LunchApp(object):
         cells[2].set_property("width-chars", 12) # Host
         cells[3].set_property("width-chars", 8) # Executions
         cells[4].set_property("width-chars", 8) # State
+        for i in range(5, NUM_COLUMNS):
+            cells[i].set_property("width-chars", 6)
+        columns[5].set_cell_data_func(cells[5], _format_float_cell, "%.1f")
+        columns[6].set_cell_data_func(cells[6], _format_float_cell, "%.1f")
 
     def _get_iter_for_command_row(self, looking_for):
         """
@@ -468,6 +529,8 @@ class LunchApp(object):
         #print("Connecting state changed signal to GUI.")
         command.child_state_changed_signal.connect(self.on_command_status_changed)
         command.child_pid_changed_signal.connect(self.on_command_child_pid_changed)
+        command.resources_changed_signal.connect(self.on_command_resources_changed)
+        command.scheduling_changed_signal.connect(self.on_command_scheduling_changed)
         command.ssh_error_signal.connect(self.on_ssh_error)
         command.command_not_found_signal.connect(self.on_command_not_found)
 
@@ -504,6 +567,8 @@ class LunchApp(object):
         #log.debug("Removing GUI's slot for state changed signal.")
         command.child_state_changed_signal.disconnect(self.on_command_status_changed)
         command.child_pid_changed_signal.disconnect(self.on_command_child_pid_changed)
+        command.resources_changed_signal.disconnect(self.on_command_resources_changed)
+        command.scheduling_changed_signal.disconnect(self.on_command_scheduling_changed)
         command.ssh_error_signal.disconnect(self.on_ssh_error)
     
     def on_command_not_found(self, command, command_txt):
@@ -541,12 +606,17 @@ class LunchApp(object):
         executions = command.how_many_times_run
         #state = command.child_state
         state = command.get_state_info()
+        resources = command.resources
         return [
                 command.identifier, 
                 command.command,
                 host,
                 executions,
-                state
+                state,
+                resources.get("cpu", 0.0),
+                resources.get("rss", 0) / 1024.0,
+                resources.get("threads", 0),
+                resources.get("fds", 0)
             ]
 
     def on_menu_open_logs(self, *args):
@@ -656,6 +726,21 @@ class LunchApp(object):
         log.debug("lunch-child %s> Its PID changed to %s" % (command.identifier, new_pid))
         self._update_command(command)
 
+    def on_command_scheduling_changed(self, command):
+        """
+        Called when the scheduling_changed_signal of the command is triggered.
+        That's when it passed its readiness probe, for example.
+        @param command L{lunch.commands.Command} 
+        """
+        self._update_command(command)
+
+    def on_command_resources_changed(self, command, resources):
+        """
+        Called when the resources_changed_signal of the command is triggered.
+        Only its row is updated, since it happens often.
+        """
+        self._update_row(command)
+
     def _update_command(self, command):
         self._update_row(command)
         self._update_buttons_according_to_selected_contact()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Heartbeat between the master and a lunch-slave, with the round-trip times.
+
+The master pings a lunch-slave every few seconds, even when it is busy
+sending other messages, so that the round-trip times are measured for all
+the hosts. When a ping is not answered, it pings it again a few times
+before it declares it lost, unless anything else is received from it in the
+meantime. A hung SSH connection or a frozen host is then noticed after
+idle + interval * probes seconds at most.
+"""
+import collections
+
+from twisted.internet import reactor
+
+# Upper bounds of the buckets of the histograms, in milliseconds.
+# The last bucket is for what is over the last bound.
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+def _percentile(sorted_values, fraction):
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class RTTHistogram(object):
+    """
+    Round-trip times of the last pings, in seconds.
+
+    Only the last max_samples of them are kept, so that the statistics
+    follow the current state of the network.
+    """
+    def __init__(self, max_samples=100):
+        self._samples = collections.deque(maxlen=max_samples)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, rtt):
+        """
+        Adds the round-trip time of a ping.
+        @param rtt: Seconds.
+        @type rtt: C{float}
+        """
+        self._samples.append(rtt)
+
+    def get_samples(self):
+        """
+        @rtype: C{list}
+        """
+        return list(self._samples)
+
+    def get_buckets(self):
+        """
+        Returns how many samples are in each bucket.
+        @return: List of (upper bound in ms, count) tuples. The upper bound
+        of the last one is None.
+        @rtype: C{list}
+        """
+        counts = [0] * (len(BUCKETS) + 1)
+        for rtt in self._samples:
+            milliseconds = rtt * 1000.0
+            index = len(BUCKETS)
+            for i, bound in enumerate(BUCKETS):
+                if milliseconds <= bound:
+                    index = i
+                    break
+            counts[index] += 1
+        return list(zip(BUCKETS + [None], counts))
+
+    def get_stats(self):
+        """
+        Returns the number of samples, the last one, the minimum, median,
+        99th percentile and maximum, in seconds, and the buckets.
+        The times are None if there is no sample.
+        @rtype: C{dict}
+        """
+        ret = {"count": len(self._samples), "last": None, "min": None,
+                "median": None, "p99": None, "max": None,
+                "buckets": self.get_buckets()}
+        if len(self._samples) != 0:
+            values = sorted(self._samples)
+            ret["last"] = self._samples[-1]
+            ret["min"] = values[0]
+            ret["median"] = _percentile(values, 0.5)
+            ret["p99"] = _percentile(values, 0.99)
+            ret["max"] = values[-1]
+        return ret
+
+    @classmethod
+    def merged(cls, histograms):
+        """
+        Returns a histogram with the samples of many, for example all those
+        of a host.
+        @rtype: L{RTTHistogram}
+        """
+        histograms = list(histograms)
+        ret = cls(max_samples=max(1, sum([h._samples.maxlen for h in histograms])))
+        for histogram in histograms:
+            for rtt in histogram._samples:
+                ret.add(rtt)
+        return ret
+
+
+class Heartbeat(object):
+    """
+    Pings a lunch-slave idle seconds after its last pong, then every
+    interval seconds until it answers. Calls on_lost once probes pings in a
+    row are not answered, and nothing else was received meanwhile.
+    """
+    def __init__(self, send_ping, on_lost, idle=5.0, interval=2.0, probes=3,
+            histogram=None, clock=None):
+        """
+        @param send_ping: Callable that sends a ping, given its sequence number.
+        @param on_lost: Callable called when the lunch-slave is lost.
+        @param idle: Seconds between an answered ping and the next one.
+        @param interval: Seconds between the pings that are not answered.
+        @param probes: How many pings are not answered before it is lost.
+        @param histogram: L{RTTHistogram} where to add the round-trip times.
+        @param clock: IReactorTime provider. The reactor by default.
+        """
+        self.send_ping = send_ping
+        self.on_lost = on_lost
+        self.idle = idle
+        self.interval = interval
+        self.probes = probes
+        self.histogram = histogram
+        if self.histogram is None:
+            self.histogram = RTTHistogram()
+        self.clock = clock
+        if self.clock is None:
+            self.clock = reactor
+        self.missed = 0 # pings in a row not answered yet
+        self._sequence = 0
+        self._sent = collections.OrderedDict() # sequence: time sent
+        self._delayed_call = None
+
+    def is_running(self):
+        return self._delayed_call is not None
+
+    def start(self):
+        self.missed = 0
+        self._sent.clear()
+        self._schedule(self.idle)
+
+    def stop(self):
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+        self._sent.clear()
+
+    def _schedule(self, delay):
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.reset(delay)
+        else:
+            self._delayed_call = self.clock.callLater(delay, self._on_timer)
+
+    def activity(self):
+        """
+        Called when anything is received from the lunch-slave. It is alive,
+        so the pings not answered yet do not count. The next ping is not
+        delayed, so that a busy lunch-slave is pinged too.
+        """
+        if self._delayed_call is None:
+            return
+        self.missed = 0
+
+    def pong_received(self, sequence=None):
+        """
+        Called when a pong is received. Matches it with its ping, or with
+        the oldest one if it has no sequence number, as with old lunch-slaves.
+        @return: The round-trip time, or None if it matches no ping.
+        """
+        sent_at = None
+        if sequence is not None and sequence in self._sent:
+            sent_at = self._sent.pop(sequence)
+            for older in [key for key in self._sent if key < sequence]:
+                del self._sent[older] # answered out of order: lost
+        elif sequence is None and len(self._sent) != 0:
+            sent_at = self._sent.popitem(last=False)[1]
+        self.activity()
+        if sent_at is None:
+            return None
+        if self._delayed_call is not None:
+            self._schedule(self.idle)
+        rtt = self.clock.seconds() - sent_at
+        self.histogram.add(rtt)
+        return rtt
+
+    def _on_timer(self):
+        self._delayed_call = None
+        if self.missed >= self.probes:
+            self._sent.clear()
+            self.on_lost()
+            return
+        self._sequence += 1
+        self._sent[self._sequence] = self.clock.seconds()
+        self.missed += 1
+        self._delayed_call = self.clock.callLater(self.interval, self._on_timer)
+        self.send_ping(self._sequence)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Runs the children of the local commands from within the master process.
+
+Instead of spawning a lunch-slave for each local command, the master loads
+the Slave and SlaveIO classes of the lunch-slave script and talks to them
+through an in-memory transport, with the same protocol.
+"""
+import importlib.machinery
+import importlib.util
+import os
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.python import procutils
+
+from lunch import commands
+from lunch import framing
+from lunch import logger
+from lunch.states import *
+
+log = logger.start(name='local')
+
+_slave_module = None # the lunch-slave script, once loaded
+
+def load_slave_module():
+    """
+    Loads the lunch-slave script as a Python module.
+    The one next to this package is preferred over the one in the $PATH,
+    so that the master and its in-process slaves are of the same version.
+    Raises a RuntimeError if it cannot be found.
+    """
+    global _slave_module
+    if _slave_module is None:
+        path = os.path.join(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))), "scripts", "lunch-slave")
+        if not os.path.exists(path):
+            try:
+                path = procutils.which("lunch-slave")[0]
+            except IndexError:
+                raise RuntimeError("Could not find path of executable lunch-slave.")
+        loader = importlib.machinery.SourceFileLoader("lunch_slave", path)
+        spec = importlib.util.spec_from_loader("lunch_slave", loader)
+        module = importlib.util.module_from_spec(spec)
+        loader.exec_module(module)
+        _slave_module = module
+    return _slave_module
+
+
+class _LoopbackTransport(object):
+    """
+    Transport of the in-process SlaveIO. 
+    
+    Gives what it writes to the LocalSlave in a later reactor iteration,
+    as if it came from a pipe.
+    """
+    def __init__(self, local_slave):
+        self.local_slave = local_slave
+        self.disconnecting = False
+        self._buffer = []
+        self._delayed_call = None
+        self._framer = framing.LineFramer(local_slave._received_message)
+
+    def write(self, data):
+        self._buffer.append(data)
+        if self._delayed_call is None:
+            self._delayed_call = reactor.callLater(0, self._flush)
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+    def _flush(self):
+        self._delayed_call = None
+        data = b"".join(self._buffer)
+        del self._buffer[:]
+        self._framer.feed(data)
+
+    def loseConnection(self):
+        pass # the master lives on
+
+    def cancel(self):
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+
+
+class LocalSlave(commands.SharedSlave):
+    """
+    Manages the children of the local commands within the master process.
+
+    Each command is addressed by its identifier, like with a shared
+    lunch-slave, but nothing is spawned except the children themselves.
+    """
+    def __init__(self):
+        commands.SharedSlave.__init__(self)
+        self.identifier = "in_process"
+        self._slave_io = None
+        self._transport = None
+
+    def start_for(self, command):
+        if self.slave_state == STATE_STOPPED:
+            module = load_slave_module()
+            self._transport = _LoopbackTransport(self)
+            self._slave_io = module.SlaveIO(module.Slave(identifier=self.identifier))
+            self.slave_state = STATE_STARTING
+            self._slave_io.makeConnection(self._transport) # sends "ready"
+            self._on_connection_made()
+        else:
+            commands.SharedSlave.start_for(self, command)
+
+    def send(self, identifier, msg_bytes):
+        prefix = ("@%s " % (identifier)).encode("ascii")
+        self._slave_io.dataReceived(prefix + msg_bytes)
+
+    def release(self, command):
+        """
+        The children are stopped by the commands. There is no process to quit.
+        """
+        return defer.succeed(None)
+
+    def kill(self):
+        pass # nothing to kill, and it cannot hang
+
+    def stop_all_children(self):
+        """
+        Stops the children that are still running, and the log flushing tasks.
+        Called when the master quits.
+        """
+        if self._slave_io is not None:
+            self._slave_io._before_shutdown()
+            self._slave_io.slave.close()
+            for child_io in self._slave_io.children.values():
+                child_io.slave.close()
+            self._transport.cancel()
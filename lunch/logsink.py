@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Buffered writing of the log files of the commands.
+
+Each command writes a line to its log file whenever something happens to
+its lunch-slave or child. With many commands, writing and flushing each
+of those lines on the reactor thread costs a lot of system calls.
+
+A L{LogSink} keeps the lines in memory and writes them in batches, one
+write per file, when enough of them are waiting or a short while after
+the first one. The files are written by a thread of its own, so that the
+reactor does not wait for the disk.
+"""
+import time
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python import logfile
+from twisted.python import threadpool
+from lunch import logger
+
+log = logger.start(name='logsink')
+
+MAX_BUFFER_SIZE = 65536 # bytes waiting before we write them
+FLUSH_INTERVAL = 0.5 # seconds a line can wait before we write it
+
+_timestamp_second = None
+_timestamp = None
+
+def format_time(now=None):
+    """
+    Returns the local time as a string for the log files.
+
+    The string is only formatted once each second.
+    @rtype: C{str}
+    """
+    global _timestamp_second
+    global _timestamp
+    if now is None:
+        now = time.time()
+    second = int(now)
+    if second != _timestamp_second:
+        _timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+        _timestamp_second = second
+    return _timestamp
+
+
+class BufferedLogFile(object):
+    """
+    Log file whose lines are written by a L{LogSink}.
+
+    Has the write(), flush() and close() methods of a
+    L{twisted.python.logfile.LogFile}, and it is rotated the same way.
+    The file is only opened when its first lines are written.
+    """
+    def __init__(self, sink, name, directory):
+        self.sink = sink
+        self.name = name
+        self.directory = directory
+        self.closed = False
+        self._log_file = None # only used by the writer thread
+
+    def write(self, data):
+        """
+        Adds some text to the file, later.
+        """
+        if not self.closed:
+            self.sink._append(self, data)
+
+    def flush(self):
+        """
+        Writes all that is waiting in the sink.
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        return self.sink.flush()
+
+    def close(self):
+        """
+        Closes the file once what is waiting has been written.
+        """
+        if not self.closed:
+            self.closed = True
+            self.sink._close_later(self)
+
+    def _write_now(self, data):
+        if self._log_file is None:
+            self._log_file = logfile.LogFile(self.name, self.directory)
+        self._log_file.write(data)
+        self._log_file.flush()
+
+    def _close_now(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+
+class LogSink(object):
+    """
+    Writes the lines of many log files in batches, from a thread.
+
+    The batches are written in order, by a single thread. Call close()
+    before the end of the process, so that nothing is lost.
+    """
+    def __init__(self, max_buffer_size=MAX_BUFFER_SIZE, flush_interval=FLUSH_INTERVAL, use_thread=True):
+        """
+        @param max_buffer_size: How many bytes can wait before they are written.
+        @type max_buffer_size: C{int}
+        @param flush_interval: How long, in seconds, a line can wait before it is written.
+        @type flush_interval: C{float}
+        @param use_thread: Whether to write the files from a thread, or from the reactor thread.
+        @type use_thread: C{bool}
+        """
+        self.max_buffer_size = max_buffer_size
+        self.flush_interval = flush_interval
+        self.use_thread = use_thread
+        self._pending = {} # BufferedLogFile: list of str
+        self._pending_size = 0
+        self._to_close = []
+        self._delayed_flush = None
+        self._writing = defer.succeed(None) # the last batch given to the thread
+        self._pool = None
+        self._log_files = [] # all the files, to close them at the end
+        # statistics:
+        self.lines_received = 0
+        self.bytes_written = 0
+        self.batches_written = 0
+        self.writes = 0
+        self.time_writing = 0.0
+
+    def open_log(self, name, directory):
+        """
+        Returns a log file that writes through this sink.
+        @param name: File name.
+        @param directory: Directory of the file.
+        @rtype: L{BufferedLogFile}
+        """
+        log_file = BufferedLogFile(self, name, directory)
+        self._log_files.append(log_file)
+        return log_file
+
+    def _append(self, log_file, data):
+        chunks = self._pending.get(log_file)
+        if chunks is None:
+            chunks = []
+            self._pending[log_file] = chunks
+        chunks.append(data)
+        self._pending_size += len(data)
+        self.lines_received += 1
+        if self._pending_size >= self.max_buffer_size:
+            self.flush()
+        elif self._delayed_flush is None:
+            self._delayed_flush = reactor.callLater(self.flush_interval, self.flush)
+
+    def _close_later(self, log_file):
+        self._to_close.append(log_file)
+        self._log_files.remove(log_file)
+        if self._delayed_flush is None:
+            self._delayed_flush = reactor.callLater(self.flush_interval, self.flush)
+
+    def flush(self):
+        """
+        Writes all the lines that are waiting.
+        @return: Deferred called once they have been written.
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        if self._delayed_flush is not None:
+            if self._delayed_flush.active():
+                self._delayed_flush.cancel()
+            self._delayed_flush = None
+        if len(self._pending) == 0 and len(self._to_close) == 0:
+            return self._wait_for_writing()
+        batches = [(log_file, "".join(chunks))
+                for log_file, chunks in self._pending.items()]
+        to_close = self._to_close
+        self._pending = {}
+        self._pending_size = 0
+        self._to_close = []
+        if self.use_thread:
+            d = threads.deferToThreadPool(reactor, self._get_pool(),
+                    _write_batches, batches, to_close)
+        else:
+            d = defer.maybeDeferred(_write_batches, batches, to_close)
+        d.addCallbacks(self._on_written, self._on_write_error)
+        self._writing = d
+        return self._wait_for_writing()
+
+    def _wait_for_writing(self):
+        """
+        Returns a Deferred that is called when the last batch is written.
+        """
+        d = defer.Deferred()
+        def _done(result):
+            d.callback(None)
+            return result
+        self._writing.addBoth(_done)
+        return d
+
+    def _on_written(self, result):
+        num_bytes, num_writes, duration = result
+        self.bytes_written += num_bytes
+        self.writes += num_writes
+        self.time_writing += duration
+        self.batches_written += 1
+
+    def _on_write_error(self, reason):
+        log.error("Could not write to the log files: %s" % (reason.getErrorMessage()))
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = threadpool.ThreadPool(1, 1, "lunch-logsink")
+            self._pool.start()
+        return self._pool
+
+    def close(self):
+        """
+        Writes what is waiting, closes all the files and stops the thread.
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        for log_file in list(self._log_files):
+            log_file.close()
+        d = self.flush()
+        def _stop_pool(result):
+            if self._pool is not None:
+                self._pool.stop()
+                self._pool = None
+        d.addCallback(_stop_pool)
+        return d
+
+    def get_stats(self):
+        """
+        Returns how much was written, and how long it took.
+        @rtype: C{dict}
+        """
+        bytes_per_second = 0.0
+        if self.time_writing > 0:
+            bytes_per_second = self.bytes_written / self.time_writing
+        return {
+            "lines_received": self.lines_received,
+            "bytes_pending": self._pending_size,
+            "bytes_written": self.bytes_written,
+            "batches_written": self.batches_written,
+            "writes": self.writes,
+            "time_writing": self.time_writing,
+            "bytes_per_second": bytes_per_second,
+            }
+
+
+def _write_batches(batches, to_close):
+    """
+    Writes some batches of lines and closes some files.
+    Called in the writer thread.
+    @return: Number of bytes, number of writes and time it took.
+    """
+    started = time.time()
+    num_bytes = 0
+    for log_file, data in batches:
+        log_file._write_now(data)
+        num_bytes += len(data)
+    for log_file in to_close:
+        log_file._close_now()
+    return (num_bytes, len(batches), time.time() - started)
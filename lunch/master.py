@@ -27,13 +27,23 @@ The Lunch master manages lunch slaves.
 
 from lunch import DEFAULT_LOG_DIR
 from lunch import DEFAULT_PID_DIR
+from lunch import admission
+from lunch import budget
+from lunch import commands
+from lunch import deadlines
 from lunch import graph
+from lunch import heartbeat
+from lunch import local
 from lunch import logger
+from lunch import logsink
+from lunch import placement
 from lunch import sig
+from lunch import sshmux
 from lunch import convert
 from lunch.states import STATE_RUNNING
 from lunch.states import STATE_STARTING
 from lunch.states import STATE_STOPPED
+from lunch.states import STATE_STOPPING
 from twisted.internet import defer
 from twisted.internet import reactor
 from twisted.internet import task
@@ -51,6 +61,16 @@ import py_compile
 log = None # global singleton
 LOG_NAME = 'master'
 
+# How the master decides when to check which child to start or stop:
+SCHEDULER_EVENTS = "events" # when a command changes, or when a delay expires
+SCHEDULER_POLLING = "polling" # every main_loop_every seconds
+SCHEDULERS = [SCHEDULER_EVENTS, SCHEDULER_POLLING]
+
+# How the sleep_after delays apply:
+LAUNCH_SEQUENTIAL = "sequential" # each launch delays the next one, globally
+LAUNCH_PARALLEL = "parallel" # each launch only delays its own dependees
+LAUNCH_MODES = [LAUNCH_SEQUENTIAL, LAUNCH_PARALLEL]
+
 
 def start_stdout_logging(log_level='info'):
     #log.startLogging(sys.stdout)
@@ -98,13 +118,35 @@ class Master(object):
     The Lunch Master launches slaves, which in turn launch childs.
     """
     def __init__(self, log_dir=None, pid_dir=None, pid_file=None,
-            log_file=None, config_file=None, verbose=False):
+            log_file=None, config_file=None, verbose=False, scheduler=None,
+            launch_mode=None, max_concurrent_launches=0,
+            max_startups_per_host=0, max_startups=0, start_rate=0.0,
+            ssh_multiplex=False, share_slaves=False, local_in_process=False,
+            prewarm=False, heartbeat_idle=5.0, heartbeat_interval=2.0,
+            heartbeat_probes=3, sample_every=5.0, restart_budget=0,
+            restart_budget_per_host=0):
         """
         @param log_dir: str Path.
         @param pid_dir: str Path.
         @param pid_file: str Path.
         @param log_file: str Path.
         @param config_file: str Path.
+        @param scheduler: str Either SCHEDULER_EVENTS (the default) or SCHEDULER_POLLING.
+        @param launch_mode: str Either LAUNCH_SEQUENTIAL (the default) or LAUNCH_PARALLEL.
+        @param max_concurrent_launches: int With LAUNCH_PARALLEL, how many commands can be starting at the same time. 0 means no limit.
+        @param max_startups_per_host: int How many lunch-slave processes can be starting at the same time on each host. 0 means no limit.
+        @param max_startups: int How many lunch-slave processes can be starting at the same time on all hosts. 0 means no limit.
+        @param start_rate: float How many lunch-slave processes can be started each second. 0 means no limit.
+        @param ssh_multiplex: bool Whether the commands on the same host share one SSH connection, unless they say otherwise.
+        @param share_slaves: bool Whether the commands on the same host share one lunch-slave process, unless they say otherwise.
+        @param local_in_process: bool Whether the children of the local commands are managed within the master process, instead of by lunch-slave processes.
+        @param prewarm: bool Whether to start the lunch-slave processes before their children can start, unless the commands say otherwise.
+        @param heartbeat_idle: float Seconds between the pings of a lunch-slave, once it answered the previous one. 0 disables the heartbeat.
+        @param heartbeat_interval: float Seconds between the pings that are not answered.
+        @param heartbeat_probes: int How many pings are not answered before the lunch-slave is lost, and killed.
+        @param sample_every: float Seconds between the samples of the resources used by the children, unless the commands say otherwise. 0 disables it.
+        @param restart_budget: int How many commands can be restarted each minute, on all hosts. The others wait for their turn. 0 means no limit.
+        @param restart_budget_per_host: int How many commands can be restarted each minute, on each host. 0 means no limit.
         """
         # attributes:
         self.commands = {} # dict of str identifier: L{lunch.commands.Command}
@@ -134,8 +176,55 @@ class Master(object):
                                     # 20 times a second.
         self._time_now = time.time()
         self.launch_next_time = time.time() # time in future
-        self._looping_call = task.LoopingCall(self.main_loop)
-        self._looping_call.start(self.main_loop_every, False) 
+        if scheduler is None:
+            scheduler = SCHEDULER_EVENTS
+        if scheduler not in SCHEDULERS:
+            raise RuntimeError("No such scheduler: %s" % (scheduler))
+        self.scheduler = scheduler
+        if launch_mode is None:
+            launch_mode = LAUNCH_SEQUENTIAL
+        if launch_mode not in LAUNCH_MODES:
+            raise RuntimeError("No such launch mode: %s" % (launch_mode))
+        self.launch_mode = launch_mode
+        self.max_concurrent_launches = max_concurrent_launches
+        self._launching = {} # nodes started, whose child is not running yet: whether it is STARTING
+        self._waiting_for_launch_slot = set() # nodes ready, but over the limit
+        self.admission = admission.AdmissionController(
+                max_per_host=max_startups_per_host, max_total=max_startups,
+                rate=start_rate)
+        self.restart_budget = budget.RestartBudget(per_minute=restart_budget,
+                per_host_per_minute=restart_budget_per_host)
+        self.ssh_multiplex = ssh_multiplex
+        self.ssh_multiplexer = sshmux.SSHMultiplexer(self.pid_dir)
+        self.ssh_check_every = 30.0 # checks the SSH master connections
+        self._ssh_check_call = None
+        self.share_slaves = share_slaves
+        self.shared_slaves = {} # (user, host, ssh_port): L{lunch.commands.SharedSlave}
+        self.local_in_process = local_in_process
+        self.local_slave = None # L{lunch.local.LocalSlave}, once needed
+        self.prewarm = prewarm
+        self.heartbeat_idle = heartbeat_idle
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_probes = heartbeat_probes
+        self.sample_every = sample_every
+        self.log_sink = logsink.LogSink() # writes the log files of the commands
+        self.cpu_placement = placement.CPUPlacement() # CPUs of the commands with the cpus option
+        # Only the dirty nodes are checked: on the next tick of the polling
+        # scheduler, or as soon as possible with the events scheduler.
+        self._dirty_nodes = set()
+        self._evaluation_call = None # DelayedCall
+        # Nodes waiting for launch_next_time or for their retry delay:
+        self._wake_up_times = deadlines.DeadlineHeap()
+        self._wake_up_call = None # DelayedCall for the earliest wake up time
+        self._wake_up_call_time = None # the time for which it was scheduled
+        self._looping_call = None
+        self.ticks = 0 # how many times we checked the dirty nodes
+        self.nodes_examined = 0 # total, for all ticks
+        self.nodes_acted_on = 0 # total of nodes started, stopped or deleted
+        self.last_tick_stats = {"examined": 0, "acted_on": 0}
+        if self.scheduler == SCHEDULER_POLLING:
+            self._looping_call = task.LoopingCall(self.main_loop)
+            self._looping_call.start(self.main_loop_every, False) 
         self.wants_to_live = False # The master is either trying to make every
                                    # child live or die. 
         self.command_added_signal = sig.Signal() # param: Command object
@@ -176,27 +265,69 @@ class Master(object):
             c.enabled = True
         self.prepare_all_commands()
         self.wants_to_live = True
+        self._mark_all_dirty()
     
     def add_command(self, command):
         """
         This method is wrapped (called) by the add_command function.
         @param command: L{lunch.commands.Command} object.
         """    
-        # check if addr is local, set it to none if so.
-        if command.host in self.local_addresses:
-            log.info("Filtering out host %s since it is in list of local addresses." % (
-                    command.host))
-            command.host = None    
-        # set default names if they are none:
+        # set default names if they are none, before any shared slave knows it by its name:
         if command.identifier is None:
             command.identifier = "default_%d" % (self.i)
             #TODO: use the first word of the command
             self.i += 1
         while command.identifier in self.commands: # making sure it is unique
             command.identifier += "X"
+        # check if addr is local, set it to none if so.
+        if command.host in self.local_addresses:
+            log.info("Filtering out host %s since it is in list of local addresses." % (
+                    command.host))
+            command.host = None    
+        ssh_multiplex = command.ssh_multiplex
+        if ssh_multiplex is None:
+            ssh_multiplex = self.ssh_multiplex
+        if command.host is not None and ssh_multiplex:
+            command.ssh_multiplexer = self.ssh_multiplexer
+            if self._ssh_check_call is None:
+                self._ssh_check_call = task.LoopingCall(
+                        self.ssh_multiplexer.check_all)
+                self._ssh_check_call.start(self.ssh_check_every, False)
+        if command.log_sink is None:
+            command.log_sink = self.log_sink
+        if command.sample_every is None:
+            command.sample_every = self.sample_every
+        if command.cpus:
+            command.cpu_placement = self.cpu_placement
+        share_slave = command.share_slave
+        if share_slave is None:
+            share_slave = self.share_slaves
+        if not (command.host is None and self.local_in_process):
+            command.heartbeat_idle = self.heartbeat_idle
+            command.heartbeat_interval = self.heartbeat_interval
+            command.heartbeat_probes = self.heartbeat_probes
+        if command.host is None and self.local_in_process:
+            if self.local_slave is None:
+                self.local_slave = local.LocalSlave()
+            command.shared_slave = self.local_slave
+            command.shared_slave.attach(command)
+        elif share_slave:
+            key = (command.user, command.host, command.ssh_port)
+            if key not in self.shared_slaves:
+                self.shared_slaves[key] = commands.SharedSlave(
+                        host=command.host, user=command.user,
+                        ssh_port=command.ssh_port,
+                        ssh_multiplexer=command.ssh_multiplexer,
+                        delay_before_kill=command.delay_before_kill)
+            command.shared_slave = self.shared_slaves[key]
+            command.shared_slave.attach(command)
         # Adding it the the dependencies tree.
         self.tree.add_node(command.identifier, command.depends)
         self.commands[command.identifier] = command
+        command.child_state_changed_signal.connect(self._on_command_changed)
+        command.slave_state_changed_signal.connect(self._on_command_changed)
+        command.scheduling_changed_signal.connect(self._on_command_changed)
+        self._mark_dirty(command.identifier)
         # calls the signal
         self.command_added_signal(command)
 
@@ -235,33 +366,323 @@ class Master(object):
         #log.info("----- Managing slaves LOOP ----")
 
         self._time_now = time.time()
-        iterator = graph.iter_from_root_to_leaves(self.tree)
-        for current in iterator:
-            if current != self.tree.ROOT:
-                self._treat_node(current)
+        self._mark_dirty_if_woken_up(self._time_now)
+        self._treat_dirty_nodes()
+
+    def get_scheduler_stats(self):
+        """
+        Returns how many nodes were examined and acted on (started, stopped
+        or deleted) during the last tick, and since the master started.
+        @rtype: C{dict}
+        """
+        return {
+            "scheduler": self.scheduler,
+            "ticks": self.ticks,
+            "examined": self.nodes_examined,
+            "acted_on": self.nodes_acted_on,
+            "last_tick_examined": self.last_tick_stats["examined"],
+            "last_tick_acted_on": self.last_tick_stats["acted_on"],
+            }
+
+    def _treat_dirty_nodes(self):
+        """
+        Treats the dirty nodes, in the launch order.
+        Nodes that become dirty meanwhile will be treated next time.
+        """
+        nodes = self.tree.sort_in_launch_order(self._dirty_nodes)
+        self._dirty_nodes = set()
+        examined = 0
+        acted_on = 0
+        for node in nodes:
+            if node in self.commands: # might have been deleted
+                examined += 1
+                if self._treat_node(node):
+                    acted_on += 1
+        self.ticks += 1
+        self.nodes_examined += examined
+        self.nodes_acted_on += acted_on
+        self.last_tick_stats = {"examined": examined, "acted_on": acted_on}
+
+    def _on_command_changed(self, command, *args):
+        """
+        Called when the state of a child or a lunch-slave changes, or when
+        what decides if a command can be started changes.
+        """
+        next_try_time = command.get_next_try_time()
+        if next_try_time > time.time() and command.identifier in self.commands:
+            self._wake_up_at(command.identifier, next_try_time)
+        if command.identifier in self._launching:
+            if command.child_state == STATE_STARTING:
+                self._launching[command.identifier] = True
+            elif command.child_state == STATE_RUNNING or \
+                    command.slave_state in [STATE_STOPPING, STATE_STOPPED] or \
+                    not command.enabled or \
+                    self._launching[command.identifier]: # it failed to start
+                self._release_launch_slot(command.identifier)
+        if self.admission.is_in_flight(command.identifier):
+            if command.child_state != STATE_STOPPED or \
+                    command.slave_state in [STATE_STOPPING, STATE_STOPPED] or \
+                    command.is_slave_ready() or not command.enabled:
+                self._release_admission(command.identifier)
+        self._mark_dirty(command.identifier)
+
+    def _has_free_launch_slot(self):
+        """
+        Checks if we are under max_concurrent_launches.
+        """
+        return self.max_concurrent_launches <= 0 or \
+                len(self._launching) < self.max_concurrent_launches
+
+    def _release_launch_slot(self, node):
+        """
+        A command is done starting. Gives its slot to the nodes waiting for one.
+        """
+        self._launching.pop(node, None)
+        for waiting in self._waiting_for_launch_slot:
+            self._mark_dirty(waiting)
+        self._waiting_for_launch_slot.clear()
+
+    def _is_admitted(self, node):
+        """
+        Asks the admission controller if we can start the lunch-slave of a
+        node. If not, the node waits in its queue.
+        @rtype: C{bool}
+        """
+        return self._wait_for_turn(self.admission, node, self.commands[node].host)
+
+    def _release_admission(self, node):
+        """
+        The lunch-slave of a node is started, failed to start, or will not
+        be started. Gives its slots to the nodes waiting in the queues.
+        """
+        if self.admission.release(node):
+            self._grant_turns(self.admission)
+
+    def _is_within_restart_budget(self, node):
+        """
+        Asks the restart budget if we can restart a node. If not, the node
+        waits in its queue.
+        @rtype: C{bool}
+        """
+        was_queued = self.restart_budget.is_queued(node)
+        ret = self._wait_for_turn(self.restart_budget, node,
+                self.commands[node].get_host_key())
+        if not ret and not was_queued:
+            log.info("Restarting %s is over the restart budget. It waits for its turn." % (node))
+        return ret
+
+    def _wait_for_turn(self, queue, node, host):
+        """
+        Asks the admission controller or the restart budget if a node can go
+        on. If not, the node waits in its queue.
+        @param queue: L{lunch.admission.AdmissionController} or L{lunch.budget.RestartBudget}.
+        @rtype: C{bool}
+        """
+        if not queue.is_granted(node):
+            queue.enqueue(node, host)
+            self._grant_turns(queue)
+        return queue.is_granted(node)
+
+    def _grant_turns(self, queue):
+        """
+        Marks dirty the nodes that the admission controller or the restart
+        budget let go on. Wakes up when its rate allows the next one.
+        @param queue: L{lunch.admission.AdmissionController} or L{lunch.budget.RestartBudget}.
+        """
+        now = time.time()
+        for node in queue.grant(now):
+            self._mark_dirty(node)
+        queued = queue.get_queued()
+        if queued:
+            next_token_time = queue.get_next_token_time(now)
+            if next_token_time is not None and next_token_time > now:
+                self._wake_up_at(queued[0], next_token_time)
+
+    def get_restart_budget_stats(self):
+        """
+        Returns how many restarts are queued and granted, how many were done
+        since the master started, and how many had to wait because of the
+        restart budget, in total, for each host and for each command.
+        @rtype: C{dict}
+        """
+        return self.restart_budget.get_stats()
+
+    def get_admission_stats(self):
+        """
+        Returns how many lunch-slave startups are queued, granted and in
+        flight, and how many were queued and granted since the master started.
+        @rtype: C{dict}
+        """
+        return self.admission.get_stats()
+
+    def get_time_to_running(self):
+        """
+        Returns how long each command took, the last time it was started,
+        from the moment the master started it until its child was running.
+        None if it never ran.
+        @rtype: C{dict}
+        """
+        ret = {}
+        for identifier, command in self.commands.items():
+            ret[identifier] = command.time_to_running
+        return ret
+
+    def get_resources(self):
+        """
+        Returns the last sample of the resources used by the process tree of
+        each child: "cpu" (percentage of one CPU), "rss" (KiB), "threads",
+        "fds" and "procs". It is empty if the child is not running.
+        The previous samples are in the resource_history of each command.
+        @rtype: C{dict}
+        """
+        ret = {}
+        for identifier, command in self.commands.items():
+            ret[identifier] = dict(command.resources)
+        return ret
+
+    def get_cpu_placement(self):
+        """
+        Returns the CPUs assigned to the commands with the cpus option, for
+        each host: a dict of host: dict of identifier: list of CPUs.
+        @rtype: C{dict}
+        """
+        return self.cpu_placement.get_assignments()
+
+    def get_rtt_stats(self):
+        """
+        Returns the statistics of the round-trip times of the pings to the
+        lunch-slaves, for each command and for each host, and how many
+        times each lunch-slave was lost.
+        See L{lunch.heartbeat.RTTHistogram.get_stats}.
+        @rtype: C{dict}
+        """
+        by_host = {}
+        ret = {"commands": {}, "hosts": {}, "lost": {}}
+        for identifier, command in self.commands.items():
+            ret["commands"][identifier] = command.rtt.get_stats()
+            ret["lost"][identifier] = command.slave_lost_count
+            by_host.setdefault(command.host or "localhost", []).append(command.rtt)
+        for host, histograms in by_host.items():
+            ret["hosts"][host] = heartbeat.RTTHistogram.merged(histograms).get_stats()
+        return ret
+
+    def _get_launch_time(self, node):
+        """
+        Returns the time from which a node can be started, given the
+        sleep_after delays.
+
+        In sequential mode, that is launch_next_time, for all nodes.
+        In parallel mode, a node waits for sleep_after seconds after each of
+        the nodes on which it depends has started running, or has passed its
+        readiness probe.
+        @rtype: C{float}
+        """
+        if self.launch_mode == LAUNCH_SEQUENTIAL:
+            return self.launch_next_time
+        ret = 0
+        for dependency in self.tree.get_all_dependencies(node):
+            dep_command = self.commands[dependency]
+            if dep_command.ready_at is not None:
+                ret = max(ret, dep_command.ready_at + dep_command.sleep_after)
+        return ret
+
+    def _mark_dirty(self, node):
+        """
+        Schedules a check of a node, and of all the nodes that depend on it or
+        on which it depends, since their fate might depend on its state.
+        """
+        if node not in self.commands:
+            return
+        self._dirty_nodes.add(node)
+        self._dirty_nodes.update(self.tree.get_all_dependencies(node))
+        self._dirty_nodes.update(self.tree.get_all_dependees(node))
+        self._schedule_evaluation()
+
+    def _mark_all_dirty(self):
+        self._dirty_nodes.update(self.commands)
+        self._schedule_evaluation()
+
+    def _schedule_evaluation(self):
+        """
+        With the events scheduler, checks the dirty nodes as soon as the
+        reactor is idle. Many changes at once result in a single evaluation.
+        """
+        if self.scheduler != SCHEDULER_EVENTS:
+            return # the next tick will do it
+        if self._evaluation_call is None or not self._evaluation_call.active():
+            self._evaluation_call = reactor.callLater(0, self._evaluate_dirty_nodes)
+
+    def _evaluate_dirty_nodes(self):
+        self._evaluation_call = None
+        self._time_now = time.time()
+        self._treat_dirty_nodes()
+
+    def _wake_up_at(self, node, wake_up_time):
+        """
+        Schedules a check of a node that waits until the given time.
+        """
+        self._wake_up_times.set(node, wake_up_time)
+        self._schedule_wake_up()
+
+    def _schedule_wake_up(self):
+        """
+        Makes sure we wake up exactly at the earliest wake up time.
+        With both schedulers, so that the polling one does not add up to
+        main_loop_every seconds to each delay.
+        """
+        earliest = self._wake_up_times.get_earliest()
+        if self._wake_up_call is not None and self._wake_up_call.active():
+            if self._wake_up_call_time == earliest:
+                return
+            self._wake_up_call.cancel()
+        self._wake_up_call = None
+        self._wake_up_call_time = earliest
+        if earliest is not None:
+            delay = max(0, earliest - time.time())
+            self._wake_up_call = reactor.callLater(delay, self._on_wake_up)
+
+    def _mark_dirty_if_woken_up(self, now):
+        """
+        Marks the nodes whose wake up time has come as dirty.
+        @return: Whether some were.
+        """
+        expired = self._wake_up_times.pop_expired(now)
+        for node in expired:
+            if node in self.commands:
+                self._dirty_nodes.add(node)
+        return len(expired) != 0
+
+    def _on_wake_up(self):
+        """
+        Treats the nodes whose wake up time has come, and waits for the next
+        wake up time.
+        """
+        self._wake_up_call = None
+        now = time.time()
+        if self._mark_dirty_if_woken_up(now):
+            self._time_now = now
+            self._treat_dirty_nodes()
+        self._schedule_wake_up()
 
     def _treat_node(self, node):
         """
-        Called once for each command on each main loop iteration.
+        Called for each dirty command, to start or stop it if needed.
+        @return: Whether it started, stopped or deleted a command.
+        @rtype: C{bool}
         """
         command = self.commands[node]
-        all_dependencies = self.tree.get_all_dependencies(node)
-        all_dependees = self.tree.get_all_dependees(node)
-
-        has_dependees_to_wait_for = False # to wait so that they quit
-        for dependee_name in all_dependees:
-            dependee = self.commands[dependee_name]
-            if dependee.child_state != STATE_STOPPED:
-                has_dependees_to_wait_for = True
-        
+        acted = False
         # If RUNNING, check if we should stop it:
         if command.child_state == STATE_RUNNING:
-            self._stop_node_if_needed(node)
+            acted = self._stop_node_if_needed(node)
         elif command.child_state == STATE_STOPPED:
-            self._start_node_if_needed(node)
-            self._stop_nodes_that_depend_on_this_one(node)
+            acted = self._start_node_if_needed(node)
+            if self._stop_nodes_that_depend_on_this_one(node):
+                acted = True
         if command.to_be_deleted:
             self._delete_command(node)
+            acted = True
+        return acted
 
     def _node_has_dependees_that_are_stopped(self, node):
         """
@@ -281,27 +702,34 @@ class Master(object):
     def _stop_nodes_that_depend_on_this_one(self, current_node):
         """
         Pre-condition: Node is not running. (might have changed a second ago)
+        @return: Whether it stopped some.
         """
         all_dependees = self.tree.get_all_dependees(current_node)
         command = self.commands[current_node]
+        ret = False
         if command.child_state == STATE_STOPPED:
             for dependee in all_dependees:
                 other = self.commands[dependee]
-                if other.child_state == STATE_RUNNING:
+                if other.child_state == STATE_RUNNING and \
+                        not other.is_being_stopped():
                     other.stop()
                     other.enabled = True # FIXME: that's very important
+                    ret = True
+        return ret
     
     def _stop_node_if_needed(self, node):
         """
         Pre-condition: Node is running.
+        @return: Whether it stopped it.
         """
         command = self.commands[node]
         all_dependencies = self.tree.get_all_dependencies(node)
-        all_dependees = self.tree.get_all_dependees(node)
-        has_dependees_to_wait_for = self._node_has_dependees_that_are_stopped(node)
+        if command.is_being_stopped():
+            return False # we are waiting for it to stop
         
         if self.wants_to_live is False:
             command.stop()
+            return True
         else:
             # check all node on which this node depends
             has_unsatisfied_dependency = False
@@ -316,20 +744,28 @@ class Master(object):
                 log.info("Got to stop %s since it has unsatisfied dependencies." % (
                         command.identifier)) 
                 command.stop()
+                return True
+        return False
                         
     def _start_node_if_needed(self, node):
         """
         Pre-condition: Node is not running.
+        @return: Whether it started it.
         """
         command = self.commands[node]
         all_dependencies = self.tree.get_all_dependencies(node)
-        all_dependees = self.tree.get_all_dependees(node)
         has_dependees_to_wait_for = self._node_has_dependees_that_are_stopped(node)
         
         # self.launch_next_time is for launching the next process...
         # so it must be updated as soon as we start one.
+        launch_time = self._get_launch_time(node)
+        if self.wants_to_live and command.enabled and \
+                command.child_state == STATE_STOPPED:
+            wake_up_time = max(launch_time, command.get_next_try_time())
+            if wake_up_time > self._time_now:
+                self._wake_up_at(node, wake_up_time)
         if self.wants_to_live and \
-                self.launch_next_time <= self._time_now and \
+                launch_time <= self._time_now and \
                 command.enabled and \
                 command.is_ready_to_be_started():
             if has_dependees_to_wait_for: # We cannot start this node if there
@@ -348,29 +784,95 @@ class Master(object):
                 #    start_it = False
                 for dependency in all_dependencies:
                     dep_command = self.commands[dependency]
-                    if dep_command.child_state != STATE_RUNNING and \
+                    if not dep_command.is_ready() and \
                             dep_command.respawn is True: 
                         start_it = False
                     elif dep_command.respawn is False and \
                             dep_command.how_many_times_run == 0:
                         start_it = False
+                if start_it and self.launch_mode == LAUNCH_PARALLEL:
+                    if not self._has_free_launch_slot():
+                        start_it = False
+                        self._waiting_for_launch_slot.add(node)
+                if start_it and command.how_many_times_tried > 0 and \
+                        self.restart_budget.is_enabled():
+                    if not self._is_within_restart_budget(node):
+                        start_it = False
+                if start_it and command.slave_state == STATE_STOPPED and \
+                        self.admission.is_enabled():
+                    if not self._is_admitted(node):
+                        start_it = False
                 # Finally, start it if we are ready to.
                 if start_it:
-                    self.launch_next_time = self._time_now + command.sleep_after
+                    if self.launch_mode == LAUNCH_SEQUENTIAL:
+                        self.launch_next_time = self._time_now + command.sleep_after
                     log.info("Will start %s." % (command.identifier))
                     command.start()
+                    if self.launch_mode == LAUNCH_PARALLEL:
+                        self._launching[node] = False
+                    self.admission.begin(node)
+                    self.restart_budget.use(node)
+                    return True
+        if self._prewarm_node_if_needed(node):
+            return False
+        if self.admission.is_granted(node) and not (self.wants_to_live and
+                command.enabled and command.slave_state == STATE_STOPPED):
+            self._release_admission(node) # it will not use its slots
+        if self.restart_budget.is_granted(node) and not (self.wants_to_live and
+                command.enabled and command.child_state == STATE_STOPPED):
+            self.restart_budget.release(node)
+        return False
+
+    def _prewarm_node_if_needed(self, node):
+        """
+        Starts the lunch-slave of a node that cannot start its child yet,
+        if pre-warming is enabled for it.
+
+        Pre-warmed lunch-slaves go through the admission control, like the
+        others, but do not wait for their dependencies nor for sleep_after.
+        @return: Whether it started it.
+        """
+        command = self.commands[node]
+        prewarm = command.prewarm
+        if prewarm is None:
+            prewarm = self.prewarm
+        if not prewarm or not self.wants_to_live or not command.enabled or \
+                command.slave_state != STATE_STOPPED or \
+                command.child_state != STATE_STOPPED or command.gave_up or \
+                command.get_next_try_time() > self._time_now:
+            return False
+        if not command.respawn and command.how_many_times_run >= 1:
+            return False
+        if self.admission.is_enabled() and not self._is_admitted(node):
+            return False
+        command.prewarm_slave()
+        self.admission.begin(node)
+        return True
     
     def _delete_command(self, node):
         """
         Actually deletes it.
         """
         ref = self.commands[node]
+        self._mark_dirty(node) # its neighbours
         del self.commands[node]
+        ref.child_state_changed_signal.disconnect(self._on_command_changed)
+        ref.slave_state_changed_signal.disconnect(self._on_command_changed)
+        ref.scheduling_changed_signal.disconnect(self._on_command_changed)
+        self._wake_up_times.remove(node)
+        self._waiting_for_launch_slot.discard(node)
+        if node in self._launching:
+            self._release_launch_slot(node)
+        self._release_admission(node)
+        self.restart_budget.release(node)
+        self.cpu_placement.release(ref.get_host_key(), node)
         #log.debug(self.commands)
         self.tree.remove_node(node) # XXX ?
         log.info("Removed command %s from the graph" % (node))
         self.command_removed_signal(ref)
         ref.quit_slave()
+        if ref.shared_slave is not None:
+            ref.shared_slave.detach(ref)
 
     def _get_all(self):
         """
@@ -405,6 +907,7 @@ class Master(object):
         #TODO: stop the looping call.
         _commands = self._get_all()
         self.wants_to_live = False
+        self._mark_all_dirty()
         for c in _commands:
             if c.child_state in [STATE_RUNNING, STATE_STARTING]:
                 c.stop()
@@ -418,9 +921,10 @@ class Master(object):
         """
         if identifier in list(self.commands.keys()):
             command = self.commands[identifier]
-            if command.get_state_info() == STATE_RUNNING: #FIXME
+            if command.child_state == STATE_RUNNING:
                 command.stop()
             command.to_be_deleted = True
+            self._mark_dirty(identifier)
 
     def restart_all(self):
         """
@@ -499,7 +1003,9 @@ class Master(object):
                 reactor.callLater(0.1, _later, self, data)
             else:
                 log.info("Done stopping the Lunch Master.")
-                deferred.callback(True) # stops reactor
+                d = self.ssh_multiplexer.close_all()
+                d.addBoth(lambda result: self.log_sink.close())
+                d.addBoth(lambda result: deferred.callback(True)) # stops reactor
         
         _later(self, _shutdown_data)
         return deferred
@@ -517,11 +1023,24 @@ class Master(object):
             if command.slave_state == STATE_RUNNING:
                 deferreds.append(command.quit_slave())
         # stop the master's loop
-        if self._looping_call.running:
+        if self._looping_call is not None and self._looping_call.running:
             d = self._looping_call.deferred
             self._looping_call.stop() # FIXME
             deferreds.append(d)
-        return defer.DeferredList(deferreds)
+        if self._ssh_check_call is not None and self._ssh_check_call.running:
+            self._ssh_check_call.stop()
+        deferreds.append(self.ssh_multiplexer.close_all())
+        if self.local_slave is not None:
+            self.local_slave.stop_all_children()
+        for delayed_call in [self._evaluation_call, self._wake_up_call]:
+            if delayed_call is not None and delayed_call.active():
+                delayed_call.cancel()
+        self._evaluation_call = None
+        self._wake_up_call = None
+        self._wake_up_call_time = None
+        d = defer.DeferredList(deferreds)
+        d.addCallback(lambda result: self.log_sink.close()) # once the slaves said bye
+        return d
 
 
 def _validate_identifier(identifier):
@@ -742,7 +1261,14 @@ def execute_config_file(lunch_master, config_file, chmod_config_file=True):
     def add_command(command=None, identifier=None, env=None, user=None,
             host=None, group=None, order=None, sleep_after=0.25, respawn=True,
             minimum_lifetime_to_respawn=0.5, log_dir=None, sleep=None,
-            depends=None, try_again_delay=0.25, give_up_after=0, ssh_port=None):
+            depends=None, try_again_delay=0.25, give_up_after=0, ssh_port=None,
+            ssh_multiplex=None, share_slave=None, prewarm=None,
+            ready_tcp_port=None, ready_file=None, ready_output=None,
+            ready_command=None, ready_timeout=10.0, notify=False,
+            watchdog_sec=None, sockets=None, sample_every=None, rlimits=None,
+            nice=None, ionice=None, memory_max=None, cpu_max=None, cpus=None,
+            realtime_priority=None, realtime_policy="fifo", mlock_all=False,
+            max_try_again_delay=60.0):
         """
         This is the only function that users use from within the configuration
         file. It adds a Command instance to the list of commands to run. 
@@ -757,6 +1283,8 @@ def execute_config_file(lunch_master, config_file, chmod_config_file=True):
             raise RuntimeError("Groups are deprecated. Use dependencies instead.")
         if identifier is not None:
             _validate_identifier(identifier)
+        if realtime_policy not in ["fifo", "rr"]:
+            raise RuntimeError("The realtime_policy must be \"fifo\" or \"rr\", not %s." % (realtime_policy))
         if sleep is not None:
             raise RuntimeError("The sleep keyword argument has been renamed to sleep_after.")
             sleep_after = sleep
@@ -771,7 +1299,17 @@ def execute_config_file(lunch_master, config_file, chmod_config_file=True):
                 minimum_lifetime_to_respawn=minimum_lifetime_to_respawn,
                 log_dir=log_dir, identifier=identifier, depends=depends,
                 try_again_delay=try_again_delay, give_up_after=give_up_after,
-                ssh_port=ssh_port)
+                ssh_port=ssh_port, ssh_multiplex=ssh_multiplex,
+                share_slave=share_slave, prewarm=prewarm,
+                ready_tcp_port=ready_tcp_port, ready_file=ready_file,
+                ready_output=ready_output, ready_command=ready_command,
+                ready_timeout=ready_timeout, notify=notify,
+                watchdog_sec=watchdog_sec, sockets=sockets,
+                sample_every=sample_every, rlimits=rlimits, nice=nice,
+                ionice=ionice, memory_max=memory_max, cpu_max=cpu_max,
+                cpus=cpus, realtime_priority=realtime_priority,
+                realtime_policy=realtime_policy, mlock_all=mlock_all,
+                max_try_again_delay=max_try_again_delay)
         lunch_master.add_command(c)
     # -------------------------------------
     #global _commands # is this necessary?
@@ -825,7 +1363,13 @@ def create_dir_and_make_writable(directory):
 
 
 def run_master(config_file, log_to_file=False, pid_dir=None, log_dir=None,
-        chmod_config_file=True, verbose=False, log_level="info"):
+        chmod_config_file=True, verbose=False, log_level="info", scheduler=None,
+        launch_mode=None, max_concurrent_launches=0,
+        max_startups_per_host=0, max_startups=0, start_rate=0.0,
+        ssh_multiplex=False, share_slaves=False, local_in_process=False,
+        prewarm=False, heartbeat_idle=5.0, heartbeat_interval=2.0,
+        heartbeat_probes=3, sample_every=5.0, restart_budget=0,
+        restart_budget_per_host=0):
     """
     Runs the master that calls commands using ssh or so.
 
@@ -859,7 +1403,18 @@ def run_master(config_file, log_to_file=False, pid_dir=None, log_dir=None,
     log.debug("-------------------- Starting master -------------------")
     log.info("Using lunch master module %s" % (__file__))
     lunch_master = Master(log_dir=log_dir, pid_file=pid_file,
-            log_file=log_file, config_file=config_file, verbose=verbose)
+            log_file=log_file, config_file=config_file, verbose=verbose,
+            scheduler=scheduler, launch_mode=launch_mode,
+            max_concurrent_launches=max_concurrent_launches,
+            max_startups_per_host=max_startups_per_host,
+            max_startups=max_startups, start_rate=start_rate,
+            ssh_multiplex=ssh_multiplex, share_slaves=share_slaves,
+            local_in_process=local_in_process, prewarm=prewarm,
+            heartbeat_idle=heartbeat_idle,
+            heartbeat_interval=heartbeat_interval,
+            heartbeat_probes=heartbeat_probes, sample_every=sample_every,
+            restart_budget=restart_budget,
+            restart_budget_per_host=restart_budget_per_host)
     execute_config_file(lunch_master, config_file, chmod_config_file=chmod_config_file)
     # TODO: return a Deferred
     return lunch_master
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Placement of the children on the CPUs of their host, so that the commands
+that ask for some CPUs get CPUs of their own.
+
+Example : an audio engine that asks for cpus=2 and an encoder that asks for
+cpus=1 on a host with 4 cores get two cores and one core, and the kernel does
+not migrate them to each other's CPUs.
+"""
+
+
+def format_cpu_list(cpus):
+    """
+    Returns a list of CPUs like "0-3,6", as in /sys/devices/system/cpu.
+    @type cpus: C{list}
+    @rtype: C{str}
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(["%d" % (first) if first == last else "%d-%d" % (first, last)
+            for first, last in ranges])
+
+
+def parse_cpu_list(text):
+    """
+    Parses a list of CPUs like "0-3,6", as in /sys/devices/system/cpu.
+    @rtype: C{list}
+    @raise ValueError: If it is not a list of CPUs.
+    """
+    cpus = []
+    for part in text.strip().split(","):
+        if part == "":
+            continue
+        first, _, last = part.partition("-")
+        if last == "":
+            last = first
+        cpus.extend(range(int(first), int(last) + 1))
+    return sorted(set(cpus))
+
+
+class CPUPlacement(object):
+    """
+    Assigns CPUs that do not overlap to the commands on each host.
+
+    The topology of each host is given as its cores, each of them being the
+    list of its CPUs (its hardware threads). Whole cores are given first, so
+    that a command does not share a core with another one if that can be
+    avoided. An assignment is kept until it is released, so that a command
+    gets the same CPUs when it is restarted.
+    """
+    def __init__(self):
+        self._cores = {} # dict host: list of lists of CPUs
+        self._assigned = {} # dict host: dict identifier: list of CPUs
+
+    def set_topology(self, host, cores):
+        """
+        Sets the cores of a host, as reported by its lunch-slave.
+        @param cores: list of lists of CPUs.
+        """
+        self._cores[host] = [sorted(core) for core in cores if core]
+
+    def get_topology(self, host):
+        """
+        Returns the cores of a host, or None if we do not know them yet.
+        @rtype: C{list}
+        """
+        return self._cores.get(host)
+
+    def assign(self, host, identifier, how_many):
+        """
+        Assigns CPUs of a host to a command.
+        @return: The sorted list of its CPUs, or None if the topology of the
+        host is unknown or if there are not enough free CPUs.
+        @rtype: C{list}
+        """
+        assigned = self._assigned.setdefault(host, {})
+        if len(assigned.get(identifier, [])) == how_many:
+            return assigned[identifier]
+        assigned.pop(identifier, None)
+        cores = self._cores.get(host)
+        if cores is None or how_many <= 0:
+            return None
+        used = set()
+        for cpus in assigned.values():
+            used.update(cpus)
+        chosen = []
+        # whole free cores first, then the free CPUs of the cores that are
+        # already shared, so that the other free cores stay whole:
+        for core in cores:
+            if len(chosen) + len(core) <= how_many and not used.intersection(core):
+                chosen.extend(core)
+        for core in sorted(cores, key=lambda core: not used.intersection(core)):
+            for cpu in core:
+                if len(chosen) < how_many and cpu not in used and cpu not in chosen:
+                    chosen.append(cpu)
+        if len(chosen) < how_many:
+            return None
+        assigned[identifier] = sorted(chosen)
+        return assigned[identifier]
+
+    def release(self, host, identifier):
+        """
+        Frees the CPUs of a command.
+        """
+        self._assigned.get(host, {}).pop(identifier, None)
+
+    def get_assignments(self, host=None):
+        """
+        Returns the CPUs of the commands, for each host, or for one host.
+        @rtype: C{dict}
+        """
+        if host is not None:
+            return dict(self._assigned.get(host, {}))
+        return dict([(key, dict(value)) for key, value in self._assigned.items()])
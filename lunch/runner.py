@@ -57,6 +57,40 @@ def run():
             help="Makes the logging output very verbose.")
     parser.add_option("-k", "--kill", action="store_true",
             help="Kills another lunch master that uses the same config file and logging directory. Exits once it's done.")
+    parser.add_option("-s", "--scheduler", type="choice",
+            choices=["events", "polling"], default="events",
+            help="Chooses when the master checks which processes to start or stop: \"events\" when one of them changes state or a delay expires, or \"polling\" 20 times a second. Default is %default.")
+    parser.add_option("-a", "--launch-mode", type="choice",
+            choices=["sequential", "parallel"], default="sequential",
+            help="With \"sequential\", the sleep_after delay of each process delays the launch of all the next ones. With \"parallel\", it only delays the processes that depend on it, and independent processes are launched at the same time. Default is %default.")
+    parser.add_option("-c", "--max-concurrent-launches", type="int", default=0,
+            help="With --launch-mode=parallel, how many processes can be starting at the same time. Default is 0, which means no limit.")
+    parser.add_option("-H", "--max-startups-per-host", type="int", default=0,
+            help="How many lunch-slave processes (and SSH connections) can be starting at the same time on each host. The others wait for their turn. Default is 0, which means no limit.")
+    parser.add_option("-m", "--max-startups", type="int", default=0,
+            help="How many lunch-slave processes can be starting at the same time on all hosts. Default is 0, which means no limit.")
+    parser.add_option("-r", "--start-rate", type="float", default=0.0,
+            help="How many lunch-slave processes can be started each second. Default is 0, which means no limit.")
+    parser.add_option("-x", "--ssh-multiplex", action="store_true",
+            help="Makes the processes on the same host share one SSH connection, using the ControlMaster feature of OpenSSH. Can also be set for each command with the ssh_multiplex option.")
+    parser.add_option("-o", "--one-slave-per-host", action="store_true",
+            help="Makes the processes on the same host share one lunch-slave process. Can also be set for each command with the share_slave option.")
+    parser.add_option("-i", "--local-in-process", action="store_true",
+            help="Manages the local processes from within the master process, instead of starting a lunch-slave process for each of them.")
+    parser.add_option("-w", "--prewarm", action="store_true",
+            help="Starts the lunch-slave processes as soon as possible, before their child processes can be started, so that only the child processes are left to start. Can also be set for each command with the prewarm option.")
+    parser.add_option("--heartbeat-idle", type="float", default=5.0,
+            help="How many seconds between the pings of a lunch-slave, once it answered the previous one. Default is %default. 0 disables the heartbeat.")
+    parser.add_option("--heartbeat-interval", type="float", default=2.0,
+            help="How many seconds between the pings of a lunch-slave that does not answer. Default is %default.")
+    parser.add_option("--heartbeat-probes", type="int", default=3,
+            help="How many pings a lunch-slave can leave unanswered before it is considered lost and killed, so that its process is restarted. Default is %default.")
+    parser.add_option("--sample-every", type="float", default=5.0,
+            help="How many seconds between the samples of the CPU, memory, threads and file descriptors used by each process and its descendants. Default is %default. 0 disables it. Can also be set for each command with the sample_every option.")
+    parser.add_option("--restart-budget", type="int", default=0,
+            help="How many processes can be restarted each minute, on all hosts. The others wait for their turn. Default is 0, which means no limit.")
+    parser.add_option("--restart-budget-per-host", type="int", default=0,
+            help="How many processes can be restarted each minute, on each host. The others wait for their turn. Default is 0, which means no limit.")
     (options, args) = parser.parse_args()
     # --------- set configuration file
     if options.config_file:
@@ -135,7 +169,23 @@ def run():
             #print("DEBUG: using config_file %s" % (config_file))
             lunch_master = master.run_master(config_file,
                     log_to_file=file_logging_enabled, pid_dir=pid_dir,
-                    log_dir=logging_dir, log_level=log_level)
+                    log_dir=logging_dir, log_level=log_level,
+                    scheduler=options.scheduler,
+                    launch_mode=options.launch_mode,
+                    max_concurrent_launches=options.max_concurrent_launches,
+                    max_startups_per_host=options.max_startups_per_host,
+                    max_startups=options.max_startups,
+                    start_rate=options.start_rate,
+                    ssh_multiplex=bool(options.ssh_multiplex),
+                    share_slaves=bool(options.one_slave_per_host),
+                    local_in_process=bool(options.local_in_process),
+                    prewarm=bool(options.prewarm),
+                    heartbeat_idle=options.heartbeat_idle,
+                    heartbeat_interval=options.heartbeat_interval,
+                    heartbeat_probes=options.heartbeat_probes,
+                    sample_every=options.sample_every,
+                    restart_budget=options.restart_budget,
+                    restart_budget_per_host=options.restart_budget_per_host)
         except master.FileNotFoundError as e:
             #print("Error starting lunch as master.")
             msg = "A configuration file is missing. Try the --help flag. "
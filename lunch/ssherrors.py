@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Recognition of the errors of the SSH client when it launches a lunch-slave.
+
+Only what the SSH client writes before the lunch-slave says it is ready
+needs to be checked. All the patterns are in a single regular expression,
+so that a line is scanned once.
+"""
+import re
+
+# error codes:
+SSH_ERROR_AUTH = "auth"
+SSH_ERROR_HOST_KEY = "host_key"
+SSH_ERROR_REFUSED = "refused"
+SSH_ERROR_UNREACHABLE = "unreachable"
+SSH_ERROR_MISSING_SLAVE = "missing_slave"
+
+# The SSH server or the network might come back, but these need the user:
+RETRYABLE_ERRORS = [SSH_ERROR_REFUSED, SSH_ERROR_UNREACHABLE]
+
+# name of the group, pattern, error code, description
+_PATTERNS = [
+    ("password", r"password:", SSH_ERROR_AUTH,
+        "The SSH server asks for a password. Make sure you use the right user name and that your public SSH key is installed on the remote host %(host)s."),
+    ("passphrase", r"Enter passphrase for key", SSH_ERROR_AUTH,
+        "The SSH client asks for a passphrase to unlock your local private SSH key for which you have the corresponding public key on host %(host)s. You should avoid this to be asked by providing that passphrase a first time using SSH by hand."),
+    ("publickey", r"Permission denied \(publickey", SSH_ERROR_AUTH,
+        "The SSH server on host %(host)s refused your public SSH key. Make sure you use the right user name and that your public SSH key is installed on it."),
+    ("host_key", r"Host key verification failed", SSH_ERROR_HOST_KEY,
+        "Host key verification failed on %(host)s. Add correct host key"),
+    ("refused", r"Connection refused", SSH_ERROR_REFUSED,
+        "The SSH server is not running on port %(port)d of host %(host)s or not available."),
+    ("exchange", r"(?:ssh|kex)_exchange_identification", SSH_ERROR_REFUSED,
+        "Some SSH problem occurred exchanging the identification on host %(host)s. Is your host blacklisted?"),
+    ("no_route", r"No route to host", SSH_ERROR_UNREACHABLE,
+        "We cannot find host %(host)s."),
+    ("timed_out", r"Connection timed out", SSH_ERROR_UNREACHABLE,
+        "The connection to port %(port)d of host %(host)s timed out."),
+    ("resolve", r"Could not resolve hostname", SSH_ERROR_UNREACHABLE,
+        "Could not resolve hostname %(host)s."),
+    ("missing_slave", r"command not found|lunch-slave: not found", SSH_ERROR_MISSING_SLAVE,
+        "The lunch-slave command is not installed on the host %(host)s."),
+    ]
+
+_MATCHER = re.compile("|".join(["(?P<%s>%s)" % (name, pattern)
+        for name, pattern, code, description in _PATTERNS]))
+_CODES = dict([(name, code) for name, pattern, code, description in _PATTERNS])
+_DESCRIPTIONS = dict([(name, description) for name, pattern, code, description in _PATTERNS])
+
+
+class SSHError(object):
+    """
+    Error of the SSH client, recognized in a line of its output.
+    """
+    def __init__(self, name, line, host=None, port=None):
+        """
+        @param name: Name of the pattern that matched.
+        @param line: Line received from SSH.
+        @param host: Remote host name.
+        @param port: SSH port.
+        """
+        self.name = name
+        self.code = _CODES[name]
+        self.line = line
+        self.host = host
+        if port is None:
+            port = 22
+        self.port = port
+        self.retryable = self.code in RETRYABLE_ERRORS
+
+    def get_description(self):
+        """
+        Returns a message that explains the error to the user.
+        @rtype: C{str}
+        """
+        return _DESCRIPTIONS[self.name] % {"host": self.host, "port": self.port}
+
+    def __str__(self):
+        return self.get_description()
+
+
+def parse_ssh_error(line, host=None, port=None):
+    """
+    Checks if a line looks like an error message of the SSH client.
+    @param line: Line received from SSH.
+    @type line: C{str}
+    @return: The error, or None if it does not look like one.
+    @rtype: L{SSHError}
+    """
+    match = _MATCHER.search(line)
+    if match is None:
+        return None
+    return SSHError(match.lastgroup, line, host=host, port=port)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Sharing of one SSH connection between the lunch-slave processes of a host.
+
+Uses the ControlMaster feature of OpenSSH: the first ssh process for a
+(user, host, port) becomes the master of the connection and listens on a
+control socket. The next ones only open a new session in that connection,
+which avoids a full SSH handshake for each command.
+"""
+import hashlib
+import os
+
+from twisted.internet import defer
+from twisted.internet import utils
+from twisted.python import procutils
+
+from lunch import logger
+
+log = logger.start(name='sshmux')
+
+CONTROL_PERSIST = 600 # seconds an unused master connection stays open
+
+class SSHMultiplexer(object):
+    """
+    Manages the control sockets of the SSH master connections.
+
+    The sockets are in a directory owned by lunch, usually the PID directory.
+    """
+    def __init__(self, control_dir, ssh_executable="ssh"):
+        """
+        @param control_dir: Directory where to create the control sockets.
+        @type control_dir: C{str}
+        """
+        self.control_dir = control_dir
+        self.ssh_executable = ssh_executable
+        self._connections = {} # control path: (user, host, port)
+        self.connections_opened = 0 # how many ssh became master
+        self.connections_reused = 0 # how many ssh used an existing master
+
+    def get_control_path(self, user, host, port):
+        """
+        Returns the path to the control socket for a (user, host, port).
+        It is short, since the path of a UNIX socket cannot be long.
+        @rtype: C{str}
+        """
+        key = "%s@%s:%s" % (user, host, port)
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.control_dir, "lunch-ssh-%s.sock" % (digest))
+
+    def get_ssh_options(self, user, host, port):
+        """
+        Returns the options to give to ssh in order to share the connection
+        to a host.
+        @rtype: C{list}
+        """
+        control_path = self.get_control_path(user, host, port)
+        if os.path.exists(control_path):
+            self.connections_reused += 1
+        else:
+            self.connections_opened += 1
+        self._connections[control_path] = (user, host, port)
+        return [
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=%s" % (control_path),
+            "-o", "ControlPersist=%d" % (CONTROL_PERSIST),
+            ]
+
+    def get_stats(self):
+        """
+        @rtype: C{dict}
+        """
+        return {
+            "connections": len(self._connections),
+            "opened": self.connections_opened,
+            "reused": self.connections_reused,
+            }
+
+    def _run_control_command(self, control_path, command):
+        """
+        Sends a control command to the master connection of a socket.
+        @param command: Either "check" or "exit".
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: A deferred called with the exit code of ssh.
+        """
+        user, host, port = self._connections[control_path]
+        try:
+            executable = procutils.which(self.ssh_executable)[0]
+        except IndexError:
+            log.error("Could not find executable %s" % (self.ssh_executable))
+            return defer.succeed(1)
+        args = ["-S", control_path, "-O", command]
+        if user is not None:
+            args.extend(["-l", user])
+        args.append(host)
+        return utils.getProcessValue(executable, args, env=os.environ)
+
+    def _remove_socket(self, control_path):
+        try:
+            os.remove(control_path)
+        except OSError:
+            pass
+
+    def check(self, control_path):
+        """
+        Checks if the master connection of a control socket is alive.
+        Forgets about it and removes its stale socket if not.
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: A deferred called with a bool.
+        """
+        if not os.path.exists(control_path):
+            self._connections.pop(control_path, None)
+            return defer.succeed(False)
+        def _cb(exit_code):
+            if exit_code == 0:
+                return True
+            log.info("SSH master connection %s is dead." % (control_path))
+            self._connections.pop(control_path, None)
+            self._remove_socket(control_path)
+            return False
+        d = self._run_control_command(control_path, "check")
+        d.addCallback(_cb)
+        return d
+
+    def check_all(self):
+        """
+        Checks all the master connections.
+        @rtype: L{twisted.internet.defer.DeferredList}
+        """
+        return defer.DeferredList([self.check(control_path)
+                for control_path in list(self._connections.keys())])
+
+    def close_all(self):
+        """
+        Tells all the master connections to exit and removes their sockets.
+        @rtype: L{twisted.internet.defer.DeferredList}
+        """
+        deferreds = []
+        for control_path in list(self._connections.keys()):
+            if not os.path.exists(control_path):
+                self._connections.pop(control_path, None)
+                continue
+            def _cb(exit_code, control_path):
+                self._connections.pop(control_path, None)
+                self._remove_socket(control_path)
+                return exit_code
+            log.info("Closing SSH master connection %s" % (control_path))
+            d = self._run_control_command(control_path, "exit")
+            d.addCallback(_cb, control_path)
+            deferreds.append(d)
+        return defer.DeferredList(deferreds)
@@ -31,3 +31,7 @@ INFO_DONE = "DONE"
 INFO_FAILED = "FAILED"
 INFO_TODO = "TODO"
 INFO_GAVEUP = "GAVE UP"
+INFO_READY = "READY" # running, and passed its readiness probe
+INFO_OOM = "OUT OF MEMORY" # killed by the kernel because it used more than its memory_max
+# why a child exited, when the lunch-slave knows it
+EXIT_REASON_OOM = "oom"
@@ -0,0 +1,51 @@
+"""
+Tests for the admission control of the lunch-slave startups.
+"""
+from twisted.trial import unittest
+from lunch import admission
+
+class Test_Admission_Controller(unittest.TestCase):
+    def test_no_limit(self):
+        controller = admission.AdmissionController()
+        self.assertFalse(controller.is_enabled())
+        for key in ["a", "b", "c"]:
+            controller.enqueue(key, "host")
+        self.assertEqual(controller.grant(0.0), ["a", "b", "c"])
+
+    def test_max_per_host(self):
+        controller = admission.AdmissionController(max_per_host=1)
+        for key, host in [("a1", "a"), ("a2", "a"), ("b1", "b")]:
+            controller.enqueue(key, host)
+        self.assertEqual(controller.grant(0.0), ["a1", "b1"])
+        controller.begin("a1")
+        self.assertEqual(controller.grant(0.0), [])
+        self.assertTrue(controller.release("a1"))
+        self.assertEqual(controller.grant(0.0), ["a2"])
+
+    def test_hosts_are_served_in_turn(self):
+        controller = admission.AdmissionController(max_total=4)
+        for key in ["a1", "a2", "a3", "a4"]:
+            controller.enqueue(key, "a")
+        for key in ["b1", "b2"]:
+            controller.enqueue(key, "b")
+        self.assertEqual(controller.grant(0.0), ["a1", "b1", "a2", "b2"])
+        self.assertEqual(sorted(controller.get_queued()), ["a3", "a4"])
+
+    def test_rate(self):
+        controller = admission.AdmissionController(rate=2.0, burst=1)
+        for key in ["a", "b", "c"]:
+            controller.enqueue(key, None)
+        self.assertEqual(controller.grant(10.0), ["a"])
+        self.assertEqual(controller.grant(10.1), [])
+        self.assertAlmostEqual(controller.get_next_token_time(10.1), 10.5)
+        self.assertEqual(controller.grant(10.5), ["b"])
+
+    def test_release_queued(self):
+        controller = admission.AdmissionController(max_total=1)
+        controller.enqueue("a", None)
+        controller.enqueue("b", None)
+        self.assertEqual(controller.grant(0.0), ["a"])
+        self.assertFalse(controller.release("b"))
+        self.assertTrue(controller.release("a"))
+        self.assertEqual(controller.grant(0.0), [])
+        self.assertEqual(controller.get_stats()["queued"], 0)
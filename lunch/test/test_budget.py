@@ -0,0 +1,48 @@
+"""
+Tests for the budget of restarts of the commands.
+"""
+from twisted.trial import unittest
+from lunch import budget
+
+class Test_Restart_Budget(unittest.TestCase):
+    def test_no_limit(self):
+        restarts = budget.RestartBudget()
+        self.assertFalse(restarts.is_enabled())
+        for key in ["a", "b", "c"]:
+            restarts.enqueue(key, "host")
+        self.assertEqual(restarts.grant(0.0), ["a", "b", "c"])
+        self.assertEqual(restarts.get_stats()["total_throttled"], 0)
+
+    def test_per_minute(self):
+        restarts = budget.RestartBudget(per_minute=2)
+        for key in ["a", "b", "c"]:
+            restarts.enqueue(key, "host")
+        self.assertEqual(restarts.grant(0.0), ["a", "b"])
+        self.assertTrue(restarts.is_queued("c"))
+        self.assertEqual(restarts.get_next_token_time(0.0), 30.0)
+        self.assertEqual(restarts.grant(29.0), [])
+        self.assertEqual(restarts.grant(30.0), ["c"])
+        restarts.use("a")
+        stats = restarts.get_stats()
+        self.assertEqual(stats["total_throttled"], 1) # counted once
+        self.assertEqual(stats["throttled_per_command"], {"c": 1})
+        self.assertEqual(stats["total_restarts"], 1)
+        self.assertEqual(stats["granted"], 2)
+
+    def test_per_host(self):
+        restarts = budget.RestartBudget(per_host_per_minute=1)
+        for key, host in [("a1", "a"), ("a2", "a"), ("b1", "b")]:
+            restarts.enqueue(key, host)
+        # a2 waits for its host, but does not delay b1:
+        self.assertEqual(restarts.grant(0.0), ["a1", "b1"])
+        self.assertEqual(restarts.get_stats()["throttled_per_host"], {"a": 1})
+        self.assertEqual(restarts.grant(60.0), ["a2"])
+
+    def test_release(self):
+        restarts = budget.RestartBudget(per_minute=1)
+        restarts.enqueue("a", "host")
+        restarts.enqueue("b", "host")
+        self.assertEqual(restarts.grant(0.0), ["a"])
+        restarts.release("b")
+        self.assertEqual(restarts.get_queued(), [])
+        self.assertEqual(restarts.get_next_token_time(0.0), None)
@@ -8,6 +8,15 @@ from twisted.internet import reactor
 from lunch import master
 from lunch import commands
 from lunch.states import *
+import errno
+import os
+import re
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
 
 LOG_LEVEL = "warning"
 #LOG_LEVEL = "info"
@@ -135,3 +144,947 @@ class Test_Master_Advanced(unittest.TestCase):
         #reactor.callLater(DELAY, _cl1)
         return self._deferred
 
+
+
+class Test_Events_Scheduler(unittest.TestCase):
+    """
+    Checks which nodes the event-driven scheduler treats.
+    Nothing is started, since the master does not want its children to live.
+    """
+    timeout = 4.0
+
+    def setUp(self):
+        self._master = master.Master(scheduler=master.SCHEDULER_EVENTS)
+        self._master.wants_to_live = False
+        self.treated = []
+        self._master._treat_node = self.treated.append
+        for identifier, depends in [("a", None), ("b", ["a"]), ("c", None)]:
+            self._master.add_command(commands.Command("true",
+                    identifier=identifier, depends=depends))
+
+    def tearDown(self):
+        return self._master.cleanup()
+
+    def _later(self, delay, function):
+        d = defer.Deferred()
+        def _cb():
+            try:
+                function()
+            except Exception:
+                d.errback()
+            else:
+                d.callback(None)
+        reactor.callLater(delay, _cb)
+        return d
+
+    def test_no_polling(self):
+        self.assertEqual(self._master._looping_call, None)
+
+    def test_added_commands_are_treated_once(self):
+        def _check():
+            self.assertEqual(self.treated, ["a", "b", "c"])
+        return self._later(0.1, _check)
+
+    def test_only_neighbours_are_treated(self):
+        def _change_state():
+            del self.treated[:]
+            command = self._master.get_command("b")
+            command.child_state_changed_signal(command, STATE_RUNNING)
+        def _check():
+            self.assertEqual(self.treated, ["a", "b"])
+        d = self._later(0.05, _change_state)
+        d.addCallback(lambda result: self._later(0.05, _check))
+        return d
+
+    def test_wake_up(self):
+        def _wait():
+            del self.treated[:]
+            self._master._wake_up_at("c", reactor.seconds() + 0.1)
+            self._master._wake_up_at("a", reactor.seconds() + 0.3)
+        def _check_c():
+            self.assertEqual(self.treated, ["c"])
+        def _check_a():
+            self.assertEqual(self.treated, ["c", "a"])
+        d = self._later(0.05, _wait)
+        d.addCallback(lambda result: self._later(0.15, _check_c))
+        d.addCallback(lambda result: self._later(0.2, _check_a))
+        return d
+
+
+class Test_Dirty_Nodes(unittest.TestCase):
+    """
+    Checks that each tick of the polling scheduler only treats dirty nodes.
+    """
+    def setUp(self):
+        self._master = master.Master(scheduler=master.SCHEDULER_POLLING)
+        self._master.wants_to_live = False
+        self.treated = []
+        def _treat_node(node):
+            self.treated.append(node)
+            return node == "a"
+        self._master._treat_node = _treat_node
+        for identifier, depends in [("a", None), ("b", ["a"]), ("c", None)]:
+            self._master.add_command(commands.Command("true",
+                    identifier=identifier, depends=depends))
+
+    def tearDown(self):
+        return self._master.cleanup()
+
+    def test_only_dirty_nodes(self):
+        self._master.main_loop()
+        self.assertEqual(self.treated, ["a", "b", "c"])
+        self._master.main_loop()
+        self.assertEqual(self.treated, ["a", "b", "c"])
+        self._master.get_command("c").enabled = False
+        self._master.main_loop()
+        self.assertEqual(self.treated, ["a", "b", "c", "c"])
+
+    def test_wake_up(self):
+        self._master.main_loop()
+        del self.treated[:]
+        self._master._wake_up_at("b", time.time() - 1.0)
+        self._master.main_loop()
+        self.assertEqual(self.treated, ["b"])
+
+    def test_stats(self):
+        self._master.main_loop()
+        self._master.main_loop()
+        stats = self._master.get_scheduler_stats()
+        self.assertEqual(stats["ticks"], 2)
+        self.assertEqual(stats["examined"], 3)
+        self.assertEqual(stats["acted_on"], 1)
+        self.assertEqual(stats["last_tick_examined"], 0)
+
+
+class _Fake_Command(commands.Command):
+    """
+    Command whose child is STARTING as soon as it is started.
+    No process is spawned.
+    """
+    def start(self):
+        self.enabled = True
+        self.started.append(self.identifier)
+        self._set_child_state(STATE_STARTING)
+
+
+class Test_Parallel_Launch(unittest.TestCase):
+    """
+    Checks that sleep_after only delays the dependees in parallel mode.
+    """
+    def setUp(self):
+        self.started = []
+        self._master = master.Master(scheduler=master.SCHEDULER_POLLING,
+                launch_mode=master.LAUNCH_PARALLEL)
+        for identifier, depends in [("a", None), ("b", ["a"]), ("c", None),
+                ("d", None)]:
+            command = _Fake_Command("true", identifier=identifier,
+                    depends=depends, sleep_after=10.0)
+            command.started = self.started
+            self._master.add_command(command)
+
+    def tearDown(self):
+        self._master.wants_to_live = False
+        return self._master.cleanup()
+
+    def test_independent_nodes_start_together(self):
+        self._master.main_loop()
+        self.assertEqual(self.started, ["a", "c", "d"])
+
+    def test_dependees_wait_for_sleep_after(self):
+        self._master.main_loop()
+        self._master.get_command("a")._set_child_state(STATE_RUNNING)
+        self._master.main_loop()
+        self.assertEqual(self.started, ["a", "c", "d"])
+        self.assertEqual(self._master._wake_up_times.get("b"),
+                self._master.get_command("a").ready_at + 10.0)
+        self._master.get_command("a").ready_at -= 10.0
+        self._master._mark_dirty("b")
+        self._master.main_loop()
+        self.assertEqual(self.started, ["a", "c", "d", "b"])
+
+    def test_max_concurrent_launches(self):
+        self._master.max_concurrent_launches = 2
+        self._master.main_loop()
+        self.assertEqual(self.started, ["a", "c"])
+        self._master.get_command("c")._set_child_state(STATE_RUNNING)
+        self._master.main_loop()
+        self.assertEqual(self.started, ["a", "c", "d"])
+        # a failed to start: its slot is freed too
+        self._master.get_command("a")._set_child_state(STATE_STOPPED)
+        self._master.get_command("d")._set_child_state(STATE_RUNNING)
+        self.assertEqual(self._master._launching, {})
+
+
+class Test_Readiness(unittest.TestCase):
+    """
+    Checks that the dependees wait for the readiness probe of a command.
+    """
+    def setUp(self):
+        self.started = []
+        self._master = master.Master(scheduler=master.SCHEDULER_POLLING,
+                launch_mode=master.LAUNCH_PARALLEL)
+        for identifier, depends in [("a", None), ("b", ["a"])]:
+            command = _Fake_Command("true", identifier=identifier,
+                    depends=depends, sleep_after=0, ready_tcp_port=8080)
+            command.started = self.started
+            command.protocol_version = 2
+            self._master.add_command(command)
+
+    def tearDown(self):
+        self._master.wants_to_live = False
+        return self._master.cleanup()
+
+    def _on_child_state_changed(self, command, new_state):
+        self.signals.append(new_state)
+
+    def _on_scheduling_changed(self, command):
+        self.signals.append("scheduling")
+
+    def test_probe(self):
+        a = self._master.get_command("a")
+        self.assertEqual(a.get_probe(), {"tcp_port": 8080, "timeout": 10.0})
+        self._master.main_loop()
+        a._set_child_state(STATE_RUNNING)
+        self.assertFalse(a.is_ready())
+        self.assertEqual(a.get_state_info(), STATE_RUNNING)
+        self._master.main_loop()
+        self.assertEqual(self.started, ["a"])
+        self.signals = []
+        a.child_state_changed_signal.connect(self._on_child_state_changed)
+        a.scheduling_changed_signal.connect(self._on_scheduling_changed)
+        a.recv_probe("ok 0.5")
+        self.assertEqual(self.signals, ["scheduling"])
+        self.assertTrue(a.is_ready())
+        self.assertEqual(a.get_state_info(), INFO_READY)
+        self._master.main_loop()
+        self.assertEqual(self.started, ["a", "b"])
+        a._set_child_state(STATE_STOPPED)
+        self.assertFalse(a.is_ready())
+
+    def test_remove_ready(self):
+        stopped = []
+        a = self._master.get_command("a")
+        a.stop = lambda: stopped.append(a.identifier)
+        self._master.main_loop()
+        a._set_child_state(STATE_RUNNING)
+        a.recv_probe("ok 0.5")
+        self.assertEqual(a.get_state_info(), INFO_READY)
+        self._master.remove_command("a")
+        self.assertEqual(stopped, ["a"])
+        self.assertTrue(a.to_be_deleted)
+
+    def test_old_slave(self):
+        a = self._master.get_command("a")
+        a.protocol_version = 1
+        self._master.main_loop()
+        a._set_child_state(STATE_RUNNING)
+        self.assertTrue(a.is_ready())
+
+
+class Test_Socket_Activation_Scheduling(unittest.TestCase):
+    """
+    Checks that the dependees of a command start once its sockets are bound.
+    """
+    def setUp(self):
+        self.started = []
+        self._master = master.Master(scheduler=master.SCHEDULER_POLLING,
+                launch_mode=master.LAUNCH_PARALLEL)
+        for identifier, depends in [("a", None), ("b", ["a"])]:
+            command = _Fake_Command("true", identifier=identifier,
+                    depends=depends, sleep_after=0, sockets=["tcp:8080"])
+            command.started = self.started
+            command.protocol_version = 2
+            self._master.add_command(command)
+
+    def tearDown(self):
+        self._master.wants_to_live = False
+        return self._master.cleanup()
+
+    def test_sockets_bound(self):
+        a = self._master.get_command("a")
+        self._master.main_loop()
+        self.assertFalse(a.is_ready())
+        a.recv_sockets("1")
+        self.assertTrue(a.is_ready()) # STARTING
+        self._master.main_loop()
+        self.assertEqual(self.started, ["a", "b"])
+        a._set_child_state(STATE_STOPPED)
+        self.assertFalse(a.sockets_bound)
+
+
+class _Fake_Slave_Command(commands.Command):
+    """
+    Command whose lunch-slave is STARTING as soon as it is started.
+    No process is spawned.
+    """
+    def start(self):
+        self.enabled = True
+        if self.slave_state == STATE_STOPPED:
+            self.started.append(self.identifier)
+            self.set_slave_state(STATE_STARTING)
+
+
+class Test_Admission(unittest.TestCase):
+    """
+    Checks that the master waits for its turn to start lunch-slave processes.
+    """
+    def setUp(self):
+        self.started = []
+        self._master = master.Master(scheduler=master.SCHEDULER_POLLING,
+                launch_mode=master.LAUNCH_PARALLEL, max_startups_per_host=1)
+        for identifier, host in [("a1", "a"), ("a2", "a"), ("b1", "b")]:
+            command = _Fake_Slave_Command("true", identifier=identifier,
+                    host=host)
+            command.started = self.started
+            self._master.add_command(command)
+
+    def tearDown(self):
+        self._master.wants_to_live = False
+        return self._master.cleanup()
+
+    def test_max_startups_per_host(self):
+        self._master.main_loop()
+        self.assertEqual(self.started, ["a1", "b1"])
+        self.assertEqual(self._master.get_admission_stats()["queued"], 1)
+        self._master.get_command("a1")._set_child_state(STATE_STARTING)
+        self._master.main_loop()
+        self.assertEqual(self.started, ["a1", "b1", "a2"])
+
+
+class _Fake_Transport(object):
+    def __init__(self):
+        self.written = []
+        self.signals = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def signalProcess(self, signal_number):
+        self.signals.append(signal_number)
+
+    def loseConnection(self):
+        pass
+
+
+class Test_Shared_Slave(unittest.TestCase):
+    """
+    Checks that many commands can use one lunch-slave process.
+    """
+    def setUp(self):
+        self.shared = commands.SharedSlave()
+        self.shared._process_transport = _Fake_Transport()
+        self.shared.slave_state = STATE_STARTING
+        self.commands = {}
+        for identifier in ["a", "b"]:
+            command = commands.Command("true", identifier=identifier)
+            command.shared_slave = self.shared
+            self.shared.attach(command)
+            command.set_slave_state(STATE_STARTING)
+            self.commands[identifier] = command
+
+    def test_startup_commands_are_addressed(self):
+        self.shared._on_connection_made()
+        self.assertEqual(self.commands["a"].slave_state, STATE_RUNNING)
+        self.shared._received_message("ready")
+        written = b"".join(self.shared._process_transport.written)
+        self.assertIn(b"@a do true\n", written)
+        self.assertIn(b"@b run \n", written)
+
+    def test_protocol_version_2(self):
+        self.shared._on_connection_made()
+        self.shared._received_message("ready 2")
+        written = b"".join(self.shared._process_transport.written)
+        self.assertIn(b"@a protocol 2\n", written)
+        self.assertIn(b'@a ["start", {"command": "true", ', written)
+        self.assertNotIn(b"@a do", written)
+        self.shared._received_message('@a ["state", "RUNNING"]')
+        self.shared._received_message('@a ["child_pid", 123]')
+        self.assertEqual(self.commands["a"].child_state, STATE_RUNNING)
+        self.assertEqual(self.commands["a"].child_pid, 123)
+
+    def test_lines_are_routed(self):
+        self.shared._on_connection_made()
+        self.shared._received_message("ready")
+        self.shared._received_message("@b state RUNNING")
+        self.assertEqual(self.commands["a"].child_state, STATE_STOPPED)
+        self.assertEqual(self.commands["b"].child_state, STATE_RUNNING)
+
+    def test_heartbeat(self):
+        for command in self.commands.values():
+            command.heartbeat_idle = 5.0
+        self.shared._on_connection_made()
+        self.shared._received_message("ready 2")
+        self.shared._received_message('@a ["state", "RUNNING"]')
+        a = self.commands["a"]
+        a._heartbeat._delayed_call.cancel()
+        a._heartbeat._on_timer() # idle for 5 seconds
+        self.assertIn(b'@a ["ping", "1"]\n', self.shared._process_transport.written)
+        self.shared._received_message('@a ["pong", "1"]')
+        self.assertEqual(a.rtt.get_stats()["count"], 1)
+        a._on_slave_lost()
+        self.assertEqual(a.slave_lost_count, 1)
+        self.assertEqual(self.shared._process_transport.signals, [9])
+        self.shared._on_process_ended(None)
+        self.assertEqual(a.child_state, STATE_STOPPED)
+        self.assertEqual(a.slave_state, STATE_STOPPED)
+        self.assertEqual(self.commands["b"]._heartbeat, None)
+
+    def test_default_and_duplicate_identifiers(self):
+        lunch_master = master.Master(scheduler=master.SCHEDULER_POLLING,
+                share_slaves=True)
+        for identifier in [None, None, "x", "x"]:
+            lunch_master.add_command(commands.Command("true", identifier=identifier))
+        shared = list(lunch_master.shared_slaves.values())[0]
+        self.assertEqual(sorted(shared._commands.keys()),
+                sorted(lunch_master.commands.keys()))
+        self.assertEqual(sorted(shared._commands.keys()),
+                ["default_0", "default_1", "x", "xX"])
+        shared.slave_state = STATE_RUNNING
+        shared._received_message("ready")
+        shared._received_message("@xX state RUNNING")
+        shared._received_message("@default_1 state RUNNING")
+        self.assertEqual(lunch_master.commands["xX"].child_state, STATE_RUNNING)
+        self.assertEqual(lunch_master.commands["x"].child_state, STATE_STOPPED)
+        self.assertEqual(lunch_master.commands["default_1"].child_state, STATE_RUNNING)
+        lunch_master.wants_to_live = False
+        return lunch_master.cleanup()
+
+
+class _Fake_Prewarm_Command(commands.Command):
+    """
+    Command whose lunch-slave is STARTING when started. No process is spawned.
+    """
+    def _start_slave(self):
+        self.slaves_started.append(self.identifier)
+        self._process_transport = _Fake_Transport()
+        self.set_slave_state(STATE_STARTING)
+
+    def quit_slave(self):
+        self.set_slave_state(STATE_STOPPED)
+        return defer.succeed(None)
+
+
+class Test_Prewarm(unittest.TestCase):
+    """
+    Checks that lunch-slave processes can be started before their children.
+    """
+    def setUp(self):
+        self.slaves_started = []
+        self._master = master.Master(scheduler=master.SCHEDULER_POLLING,
+                launch_mode=master.LAUNCH_PARALLEL, prewarm=True)
+        for identifier, depends in [("a", None), ("b", ["a"])]:
+            command = _Fake_Prewarm_Command("true", identifier=identifier,
+                    depends=depends, sleep_after=0)
+            command.slaves_started = self.slaves_started
+            self._master.add_command(command)
+
+    def tearDown(self):
+        self._master.wants_to_live = False
+        return self._master.cleanup()
+
+    def test_prewarm(self):
+        self._master.main_loop()
+        self.assertEqual(sorted(self.slaves_started), ["a", "b"])
+        b = self._master.get_command("b")
+        b._on_connection_made()
+        b.recv_ready("")
+        self.assertEqual(b._process_transport.written, []) # not yet
+        self.assertTrue(b.is_slave_ready())
+        self._master.get_command("a")._set_child_state(STATE_RUNNING)
+        self._master.main_loop()
+        self.assertEqual(b._process_transport.written[0], b"do true\n")
+        b._set_child_state(STATE_RUNNING)
+        self.assertTrue(self._master.get_time_to_running()["b"] >= 0)
+        self.assertEqual(sorted(self.slaves_started), ["a", "b"])
+
+    def test_child_starts_once_ready(self):
+        self._master.main_loop()
+        a = self._master.get_command("a")
+        a._on_connection_made()
+        self.assertEqual(a._process_transport.written, [])
+        a.recv_ready("")
+        self.assertEqual(a._process_transport.written[0], b"do true\n")
+
+
+class Test_Restart_Budget(unittest.TestCase):
+    """
+    Checks that the master waits for its turn to restart commands.
+    """
+    def setUp(self):
+        self.started = []
+        self._master = master.Master(scheduler=master.SCHEDULER_POLLING,
+                launch_mode=master.LAUNCH_PARALLEL, restart_budget_per_host=1)
+        for identifier, host in [("a1", "a"), ("a2", "a"), ("b1", "b")]:
+            command = _Fake_Slave_Command("true", identifier=identifier,
+                    host=host)
+            command.started = self.started
+            command.how_many_times_tried = 1 # it crashed
+            self._master.add_command(command)
+
+    def tearDown(self):
+        self._master.wants_to_live = False
+        return self._master.cleanup()
+
+    def test_restart_budget_per_host(self):
+        self._master.main_loop()
+        self.assertEqual(self.started, ["a1", "b1"])
+        stats = self._master.get_restart_budget_stats()
+        self.assertEqual(stats["queued"], 1)
+        self.assertEqual(stats["total_restarts"], 2)
+        self.assertEqual(stats["throttled_per_command"], {"a2": 1})
+
+    def test_backoff(self):
+        command = self._master.get_command("a1")
+        command.max_try_again_delay = 1.0
+        for i in range(5):
+            before = time.time()
+            command._give_up_if_we_should()
+            self.assertTrue(before <= command.get_next_try_time() <= time.time() + 1.0)
+        self.assertEqual(command._current_try_again_delay, 1.0)
+
+    def test_backoff_lowered_cap(self):
+        command = self._master.get_command("a1")
+        command._current_try_again_delay = 8.0
+        command.max_try_again_delay = 1.0
+        before = time.time()
+        command._give_up_if_we_should()
+        self.assertTrue(before <= command.get_next_try_time() <= time.time() + 1.0)
+
+
+class Test_SSH_Errors(unittest.TestCase):
+    """
+    Checks how a command reacts to the errors of the SSH client.
+    """
+    def setUp(self):
+        self.command = commands.Command("true", identifier="remote",
+                host="example.org", try_again_delay=0.25)
+        self.errors = []
+        self.command.ssh_error_signal.connect(self._on_ssh_error)
+
+    def _on_ssh_error(self, command, message):
+        self.errors.append(message)
+
+    def test_retryable(self):
+        before = time.time()
+        self.command._received_message("ssh: connect to host example.org port 22: Connection refused")
+        self.command._received_message("ssh: connect to host example.org port 22: Connection refused")
+        self.assertEqual(self.command.ssh_error.code, "refused")
+        self.assertFalse(self.command.gave_up)
+        # a random wait between 0 and the try_again_delay:
+        self.assertTrue(before <= self.command.get_next_try_time() <= time.time() + 0.25)
+        self.assertEqual(self.command._current_try_again_delay, 0.5)
+        self.assertEqual(len(self.errors), 1)
+
+    def test_fatal(self):
+        self.command._received_message("Host key verification failed.")
+        self.assertEqual(self.command.ssh_error.code, "host_key")
+        self.assertTrue(self.command.gave_up)
+        self.assertFalse(self.command.enabled)
+        self.assertEqual(self.command.get_state_info(), INFO_GAVEUP)
+
+    def test_not_checked_once_ready(self):
+        self.command.enabled = False
+        self.command.recv_ready("")
+        self.command._received_message("msg Connection refused")
+        self.assertEqual(self.command.ssh_error, None)
+        self.assertEqual(self.errors, [])
+
+
+class Test_Malformed_Messages(unittest.TestCase):
+    """
+    Checks that the malformed messages from the lunch-slave are ignored.
+    """
+    def setUp(self):
+        self.command = commands.Command("true", identifier="a")
+        self.command.protocol_version = 2
+        self.command._received_ready = True
+
+    def test_malformed(self):
+        for line in ['[{"a": 1}]', '[["state"]]', '[]', '[1, 2]', '[nope']:
+            self.command._received_message(line)
+        self.command._received_message('["child_pid", 123]')
+        self.assertEqual(self.command.child_pid, 123)
+
+
+class Test_Local_In_Process(unittest.TestCase):
+    """
+    Checks that local commands can run without a lunch-slave process.
+    """
+    timeout = 4.0
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self._master = master.Master(local_in_process=True)
+        self.command = commands.Command("true", identifier="true",
+                respawn=False, log_dir=self.log_dir)
+        self._master.add_command(self.command)
+
+    def tearDown(self):
+        self._master.wants_to_live = False
+        d = self._master.cleanup()
+        d.addBoth(lambda result: shutil.rmtree(self.log_dir, True) or result)
+        return d
+
+    def test_run_once(self):
+        d = defer.Deferred()
+        def _check():
+            if self.command.how_many_times_run == 0 or \
+                    self.command.child_state != STATE_STOPPED:
+                reactor.callLater(0.05, _check)
+                return
+            self.assertEqual(self.command.shared_slave, self._master.local_slave)
+            self.assertEqual(self.command._process_transport, None)
+            self.assertEqual(self.command.retval, 0)
+            d.callback(None)
+        _check()
+        return d
+
+    def test_default_and_duplicate_identifiers(self):
+        added = []
+        for identifier in [None, None, "true"]:
+            command = commands.Command("true", identifier=identifier,
+                    respawn=False, log_dir=self.log_dir)
+            self._master.add_command(command)
+            added.append(command)
+        self.assertEqual([command.identifier for command in added],
+                ["default_0", "default_1", "trueX"])
+        self.assertEqual(sorted(self._master.local_slave._commands.keys()),
+                sorted(self._master.commands.keys()))
+        d = defer.Deferred()
+        def _check():
+            for command in added + [self.command]:
+                if command.how_many_times_run == 0 or \
+                        command.child_state != STATE_STOPPED:
+                    reactor.callLater(0.05, _check)
+                    return
+            for command in added:
+                self.assertEqual(command.retval, 0)
+            d.callback(None)
+        _check()
+        return d
+
+
+class _In_Process_Test(unittest.TestCase):
+    """
+    Base class of the tests of a child with an in-process slave.
+
+    The setUp of the subclasses creates self.log_dir, self._master and
+    self.command. The child is stopped in the tearDown.
+    """
+    timeout = 4.0
+
+    def tearDown(self):
+        self._master.wants_to_live = False
+        if self.command.child_state != STATE_STOPPED:
+            self.command.stop()
+        d = self._wait_for(lambda: self.command.child_state == STATE_STOPPED)
+        d.addCallback(lambda result: self._master.cleanup())
+        d.addBoth(lambda result: shutil.rmtree(self.log_dir, True) or result)
+        return d
+
+    def _has_output(self):
+        """
+        Tells if the child wrote to self.output.
+        """
+        return os.path.exists(self.output) and os.path.getsize(self.output) > 0
+
+    def _wait_for(self, predicate):
+        """
+        Returns a Deferred called once the predicate is true.
+        """
+        d = defer.Deferred()
+        def _check():
+            if predicate():
+                d.callback(None)
+            else:
+                reactor.callLater(0.05, _check)
+        _check()
+        return d
+
+
+_NOTIFY_SCRIPT = """
+import os, socket, time
+notify = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+notify.sendto(b"STATUS=warm\\nREADY=1", os.environ["NOTIFY_SOCKET"])
+time.sleep(10)
+"""
+
+class Test_Notify(_In_Process_Test):
+    """
+    Checks the sd_notify messages of a child, with an in-process slave.
+    """
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        script = os.path.join(self.log_dir, "notify.py")
+        with open(script, "w") as f:
+            f.write(_NOTIFY_SCRIPT)
+        self._master = master.Master(local_in_process=True)
+        self.command = commands.Command("%s %s" % (sys.executable, script),
+                identifier="notify", log_dir=self.log_dir, notify=True,
+                try_again_delay=10.0)
+
+    def test_ready(self):
+        self._master.add_command(self.command)
+        d = self._wait_for(self.command.is_ready)
+        def _ready(result):
+            self.assertEqual(self.command.child_status, "warm")
+            self.assertEqual(self.command.get_state_info(), INFO_READY)
+        d.addCallback(_ready)
+        return d
+
+    def test_watchdog(self):
+        self.command.watchdog_sec = 0.5
+        self._master.add_command(self.command)
+        d = self._wait_for(lambda: self.command.how_many_times_run == 1 and
+                self.command.child_state == STATE_STOPPED)
+        def _hung(result):
+            self.assertTrue(self.command.get_next_try_time() > time.time())
+        d.addCallback(_hung)
+        return d
+
+
+_SOCKET_SCRIPT = """
+import os, socket, sys
+assert os.environ["LISTEN_PID"] == str(os.getpid())
+assert os.environ["LISTEN_FDS"] == "1"
+server = socket.socket(fileno=3)
+connection, address = server.accept()
+connection.sendall(os.environ["LISTEN_FDNAMES"].encode("ascii"))
+connection.close()
+"""
+
+class Test_Socket_Activation(unittest.TestCase):
+    """
+    Checks that a child gets the sockets bound by its slave.
+    """
+    timeout = 4.0
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        script = os.path.join(self.log_dir, "server.py")
+        with open(script, "w") as f:
+            f.write(_SOCKET_SCRIPT)
+        self.path = os.path.join(self.log_dir, "server.sock")
+        self._master = master.Master(local_in_process=True)
+        self.command = commands.Command("%s %s" % (sys.executable, script),
+                identifier="server", log_dir=self.log_dir, respawn=False,
+                sockets=["unix:" + self.path])
+        self._master.add_command(self.command)
+
+    def tearDown(self):
+        self._master.wants_to_live = False
+        d = self._master.cleanup()
+        d.addBoth(lambda result: shutil.rmtree(self.log_dir, True) or result)
+        return d
+
+    def test_listen_fds(self):
+        d = defer.Deferred()
+        received = []
+        def _check():
+            if self.command.sockets_bound and not received:
+                client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                client.connect(self.path) # even if the child is not started yet
+                client.settimeout(3.0)
+                received.append(client.recv(100))
+                client.close()
+            if not received or self.command.how_many_times_run == 0 or \
+                    self.command.child_state != STATE_STOPPED:
+                reactor.callLater(0.05, _check)
+                return
+            self.assertEqual(received, [b"unix:" + self.path.encode("ascii")])
+            self.assertEqual(self.command.retval, 0)
+            d.callback(None)
+        _check()
+        return d
+
+
+class Test_Resources(_In_Process_Test):
+    """
+    Checks the samples of the resources of a child, with an in-process slave.
+    """
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self._master = master.Master(local_in_process=True, sample_every=0.1)
+        self.command = commands.Command("sleep 10", identifier="sleep",
+                log_dir=self.log_dir)
+        self._master.add_command(self.command)
+
+    def test_deltas(self):
+        command = commands.Command("true", identifier="deltas")
+        command.recv_resources("cpu=1.5 rss=2048 threads=1 fds=3 procs=1")
+        command.recv_resources("cpu=0.0")
+        self.assertEqual(command.resources, {"cpu": 0.0, "rss": 2048,
+                "threads": 1, "fds": 3, "procs": 1})
+        self.assertEqual(len(command.resource_history), 2)
+        self.assertEqual(command.resource_history[0][1]["cpu"], 1.5)
+
+    def test_sample(self):
+        if not os.path.exists("/proc/self/stat"):
+            raise unittest.SkipTest("No /proc file system.")
+        d = self._wait_for(lambda: self._master.get_resources()["sleep"].get("procs") == 1)
+        def _sampled(result):
+            resources = self._master.get_resources()["sleep"]
+            self.assertTrue(resources["rss"] > 0)
+            self.assertEqual(resources["threads"], 1)
+            self.assertTrue(resources["fds"] >= 1)
+        d.addCallback(_sampled)
+        return d
+
+
+class Test_Limits(_In_Process_Test):
+    """
+    Checks the limits of the resources of a child, with an in-process slave.
+    """
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.log_dir, "limits.txt")
+        self._master = master.Master(local_in_process=True)
+        self.command = commands.Command(
+                "sh -c 'echo $(ulimit -n) $(ulimit -c) $(nice) > %s; exec sleep 10'" % (self.output),
+                identifier="limited", log_dir=self.log_dir,
+                rlimits={"nofile": 64, "core": 0}, nice=5)
+        self._master.add_command(self.command)
+
+    def test_oom(self):
+        command = commands.Command("true", identifier="oom", memory_max=1024)
+        command.how_many_times_run = 1
+        command.recv_exit_reason("oom")
+        command.recv_retval("9")
+        self.assertEqual(command.get_state_info(), INFO_OOM)
+        command._set_child_state(STATE_STARTING)
+        self.assertEqual(command.exit_reason, None)
+
+    def test_rlimits_and_nice(self):
+        self.assertEqual(self.command.get_limits(),
+                {"rlimits": {"nofile": 64, "core": 0}, "nice": 5})
+        d = self._wait_for(self._has_output)
+        def _limited(result):
+            nofile, core, nice = open(self.output).read().split()
+            self.assertEqual(nofile, "64")
+            self.assertEqual(core, "0")
+            self.assertEqual(int(nice), os.nice(0) + 5)
+            self.assertEqual(self.command.applied_limits,
+                    {"core": "0", "nofile": "64", "nice": "5"})
+        d.addCallback(_limited)
+        return d
+
+
+class Test_CPU_Affinity(_In_Process_Test):
+    """
+    Checks that a child runs on the CPUs that the master assigns to it, with
+    an in-process slave.
+    """
+    def setUp(self):
+        if not hasattr(os, "sched_getaffinity"):
+            raise unittest.SkipTest("No CPU affinity on this platform.")
+        self.log_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.log_dir, "affinity.txt")
+        self._master = master.Master(local_in_process=True)
+        self.command = commands.Command(
+                "sh -c 'grep Cpus_allowed_list /proc/self/status > %s; exec sleep 10'" % (self.output),
+                identifier="pinned", log_dir=self.log_dir, cpus=1)
+        self._master.add_command(self.command)
+
+    def test_pinned(self):
+        before = os.sched_getaffinity(0)
+        d = self._wait_for(self._has_output)
+        def _pinned(result):
+            cpus = self._master.get_cpu_placement()["localhost"]["pinned"]
+            self.assertEqual(len(cpus), 1)
+            self.assertEqual(self.command.affinity, cpus)
+            allowed = open(self.output).read().split(":")[1].strip()
+            self.assertEqual(allowed, str(cpus[0]))
+            self.assertEqual(os.sched_getaffinity(0), before)
+        d.addCallback(_pinned)
+        return d
+
+
+class _Error_Recording_Command(commands.Command):
+    """
+    Command that remembers the errors of its lunch-slave.
+    """
+    def recv_error(self, mess):
+        self.errors.append(mess)
+        commands.Command.recv_error(self, mess)
+
+
+class Test_Realtime_Not_Allowed(_In_Process_Test):
+    """
+    Checks that a child whose realtime priority is refused stays STOPPED,
+    and can be started again, with an in-process slave.
+    """
+    def setUp(self):
+        if not hasattr(os, "sched_setscheduler"):
+            raise unittest.SkipTest("No realtime scheduling on this platform.")
+        self.patch(os, "sched_setscheduler", self._refuse_scheduler)
+        self.log_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.log_dir, "started.txt")
+        self._master = master.Master(local_in_process=True)
+        self.command = _Error_Recording_Command(
+                "sh -c 'touch %s; exec sleep 10'" % (self.output),
+                identifier="realtime", log_dir=self.log_dir,
+                realtime_priority=10, try_again_delay=0.1)
+        self.command.errors = []
+        self._master.add_command(self.command)
+
+    def _refuse_scheduler(self, pid, policy, param):
+        raise OSError(errno.EPERM, os.strerror(errno.EPERM))
+
+    def test_refused(self):
+        d = self._wait_for(lambda: self.command.errors)
+        def _refused(result):
+            self.assertIn("Could not give the realtime priority 10 (SCHED_FIFO) to the child.",
+                    self.command.errors[0])
+            self.assertIn("RLIMIT_RTPRIO", self.command.errors[0])
+            self.assertEqual(self.command.child_state, STATE_STOPPED)
+            self.command.realtime_priority = None
+            return self._wait_for(lambda: os.path.exists(self.output))
+        def _started(result):
+            self.assertEqual(self.command.child_state, STATE_RUNNING)
+        d.addCallback(_refused)
+        d.addCallback(_started)
+        return d
+
+
+class Test_Realtime(_In_Process_Test):
+    """
+    Checks the realtime scheduling and the memory lock limit of a child,
+    with an in-process slave.
+    """
+    def setUp(self):
+        if not hasattr(os, "sched_setscheduler"):
+            raise unittest.SkipTest("No realtime scheduling on this platform.")
+        try:
+            os.sched_setscheduler(0, os.SCHED_RR, os.sched_param(10))
+        except OSError:
+            raise unittest.SkipTest("Not allowed to use realtime scheduling.")
+        os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+        self.log_dir = tempfile.mkdtemp()
+        self._master = master.Master(local_in_process=True)
+        self.command = commands.Command("sleep 10", identifier="realtime",
+                log_dir=self.log_dir, realtime_priority=10,
+                realtime_policy="rr")
+        self._master.add_command(self.command)
+
+    def test_realtime(self):
+        d = self._wait_for(lambda: self.command.child_state == STATE_RUNNING)
+        def _running(result):
+            pid = self.command.child_pid
+            self.assertEqual(os.sched_getscheduler(pid), os.SCHED_RR)
+            self.assertEqual(os.sched_getparam(pid).sched_priority, 10)
+            self.assertEqual(os.sched_getscheduler(0), os.SCHED_OTHER)
+            self.assertEqual(self.command.applied_limits["realtime"], "rr:10")
+        d.addCallback(_running)
+        return d
+
+    def test_mlock_all(self):
+        if resource.getrlimit(resource.RLIMIT_MEMLOCK)[1] != resource.RLIM_INFINITY:
+            raise unittest.SkipTest("The memory lock limit cannot be unlimited.")
+        self.command.mlock_all = True
+        d = self._wait_for(lambda: self.command.child_state == STATE_RUNNING)
+        def _running(result):
+            limits = open("/proc/%d/limits" % (self.command.child_pid)).read()
+            self.assertTrue(re.search(r"Max locked memory +unlimited", limits))
+            self.assertEqual(self.command.applied_limits["mlock_all"], "1")
+        d.addCallback(_running)
+        return d
@@ -0,0 +1,46 @@
+"""
+Tests for the heap of deadlines used by the master to know when to wake up.
+"""
+from twisted.trial import unittest
+from lunch import deadlines
+
+class Test_Deadline_Heap(unittest.TestCase):
+    def test_earliest(self):
+        heap = deadlines.DeadlineHeap()
+        self.assertEqual(heap.get_earliest(), None)
+        heap.set("a", 3.0)
+        heap.set("b", 1.0)
+        heap.set("c", 2.0)
+        self.assertEqual(len(heap), 3)
+        self.assertEqual(heap.get_earliest(), 1.0)
+
+    def test_pop_expired(self):
+        heap = deadlines.DeadlineHeap()
+        heap.set("a", 3.0)
+        heap.set("b", 1.0)
+        heap.set("c", 2.0)
+        self.assertEqual(heap.pop_expired(2.0), ["b", "c"])
+        self.assertEqual(heap.pop_expired(2.5), [])
+        self.assertEqual(heap.get_earliest(), 3.0)
+        self.assertEqual(len(heap), 1)
+
+    def test_replace_and_remove(self):
+        heap = deadlines.DeadlineHeap()
+        heap.set("a", 1.0)
+        heap.set("b", 2.0)
+        heap.set("a", 5.0)
+        self.assertEqual(heap.get_earliest(), 2.0)
+        heap.remove("b")
+        self.assertFalse("b" in heap)
+        self.assertEqual(heap.get_earliest(), 5.0)
+        self.assertEqual(heap.pop_expired(4.0), [])
+        self.assertEqual(heap.pop_expired(5.0), ["a"])
+        self.assertEqual(heap.get_earliest(), None)
+
+    def test_many_replacements(self):
+        heap = deadlines.DeadlineHeap()
+        for i in range(1000):
+            heap.set("a", float(i))
+        self.assertEqual(heap.get("a"), 999.0)
+        self.assertTrue(len(heap._heap) < 100)
+        self.assertEqual(heap.pop_expired(1000.0), ["a"])
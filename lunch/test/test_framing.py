@@ -0,0 +1,47 @@
+"""
+Tests for the splitting of the output of the lunch-slave into lines.
+"""
+from twisted.trial import unittest
+from lunch import framing
+
+class Test_Line_Framer(unittest.TestCase):
+    def setUp(self):
+        self.lines = []
+        self.discarded = []
+        self.framer = framing.LineFramer(self.lines.append, max_length=16,
+                line_too_long=self.discarded.append)
+
+    def test_split_across_reads(self):
+        self.framer.feed(b"state RUN")
+        self.assertEqual(self.lines, [])
+        self.framer.feed(b"NING\r\nchild_pid 12")
+        self.assertEqual(self.lines, ["state RUNNING"])
+        self.framer.feed(b"34\n")
+        self.assertEqual(self.lines, ["state RUNNING", "child_pid 1234"])
+
+    def test_many_lines_in_one_read(self):
+        self.framer.feed(memoryview(b"ok\n\r\npong\r\n\nready 2\n"))
+        self.assertEqual(self.lines, ["ok", "pong", "ready 2"])
+
+    def test_carriage_return_split_from_newline(self):
+        self.framer.feed(bytearray(b"pong\r"))
+        self.framer.feed(b"\n")
+        self.assertEqual(self.lines, ["pong"])
+
+    def test_line_too_long(self):
+        self.framer.feed(b"x" * 10)
+        self.framer.feed(b"x" * 10)
+        self.assertEqual(self.discarded, [20])
+        self.framer.feed(b"x" * 20 + b"\nok\n")
+        self.assertEqual(self.lines, ["ok"])
+        self.assertEqual(self.discarded, [20])
+        self.framer.feed(b"y" * 17 + b"\npong\n")
+        self.assertEqual(self.lines, ["ok", "pong"])
+        self.assertEqual(self.discarded, [20, 17])
+
+    def test_flush(self):
+        self.framer.feed(b"ok\nbye")
+        self.framer.flush()
+        self.assertEqual(self.lines, ["ok", "bye"])
+        self.framer.flush()
+        self.assertEqual(self.lines, ["ok", "bye"])
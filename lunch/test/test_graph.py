@@ -110,6 +110,34 @@ class Test_Graph(unittest.TestCase):
         all = g.get_all_dependees("a")
         self.assertEqual(all, ["b", "c", "d"])
 
+    def test_remove_node(self):
+        g = graph.DirectedGraph()
+        g.add_node("a")
+        g.add_node("b", ["a"])
+        g.add_node("c", ["a", "b"])
+        g.remove_node("b")
+        self.assertEqual(g.get_all_nodes(), [g.get_root(), "a", "c"])
+        self.assertEqual(g.get_supported_by("a"), ["c"])
+        self.assertEqual(g.get_dependencies("c"), ["a"])
+        g.remove_node("a")
+        # c falls back on the root
+        self.assertEqual(g.get_dependencies("c"), [g.get_root()])
+        self.assertEqual(g.get_supported_by(), ["c"])
+
+    def test_lookup_with_equal_strings(self):
+        g = graph.DirectedGraph()
+        name = "".join(["x", "y", "z"]) # not the same object as "xyz"
+        g.add_node(name)
+        self.assertEqual(g.get_dependencies("xyz"), [g.get_root()])
+
+    def test_supported_by_keeps_order_of_nodes(self):
+        g = graph.DirectedGraph()
+        g.add_node("a")
+        g.add_node("x")
+        g.add_node("y", ["a"])
+        g.add_dependency("x", "a")
+        self.assertEqual(g.get_supported_by("a"), ["x", "y"])
+
 class Test_Traversal(unittest.TestCase):
     """
     Many tests using the same tree which contains all the cases.
@@ -157,3 +185,79 @@ class Test_Traversal(unittest.TestCase):
             visited.append(n)
         self.assertEqual(visited, [self.g.ROOT, "a", "b", "c", "d", "e", "f", "g", "h", "i", "j"])
 
+
+class Test_Closure_Cache(unittest.TestCase):
+    """
+    Tests for the cache of transitive dependencies and dependees.
+    """
+    def setUp(self):
+        # The diamond from examples/dependencies_advanced.lunch
+        self.g = graph.DirectedGraph()
+        self.g.add_node("a")
+        self.g.add_node("b", ["a"])
+        self.g.add_node("c", ["a"])
+        self.g.add_node("d", ["b", "c"])
+        #  a -- b -- d
+        #   `-- c --'
+
+    def test_no_duplicates(self):
+        self.assertEqual(self.g.get_all_dependees("a"), ["b", "d", "c"])
+        self.assertEqual(self.g.get_all_dependencies("d"), ["b", "a", "c"])
+
+    def test_hits_and_misses(self):
+        self.g.get_all_dependencies("d")
+        stats = self.g.get_closure_cache_stats()
+        self.g.get_all_dependencies("d")
+        self.g.get_all_dependees("a")
+        self.g.get_all_dependees("a")
+        stats2 = self.g.get_closure_cache_stats()
+        self.assertEqual(stats2["hits"] - stats["hits"], 2)
+        self.assertEqual(stats2["misses"] - stats["misses"], 1)
+
+    def test_invalidated_when_adding(self):
+        self.assertEqual(self.g.get_all_dependees("a"), ["b", "d", "c"])
+        self.assertEqual(self.g.get_all_dependencies("d"), ["b", "a", "c"])
+        self.g.add_node("e")
+        self.g.add_dependency("a", "e")
+        self.g.add_node("f", ["d"])
+        self.assertEqual(self.g.get_all_dependees("e"), ["a", "b", "d", "f", "c"])
+        self.assertEqual(self.g.get_all_dependees("a"), ["b", "d", "f", "c"])
+        self.assertEqual(self.g.get_all_dependencies("d"), ["b", "a", "e", "c"])
+        self.assertTrue(self.g.depends_on("f", "e"))
+
+    def test_invalidated_when_removing(self):
+        self.assertEqual(self.g.get_all_dependencies("d"), ["b", "a", "c"])
+        self.assertEqual(self.g.get_all_dependees("a"), ["b", "d", "c"])
+        self.g.remove_dependency("d", "b")
+        self.assertEqual(self.g.get_all_dependencies("d"), ["c", "a"])
+        self.g.remove_node("c")
+        self.assertEqual(self.g.get_all_dependencies("d"), [])
+        self.assertEqual(self.g.get_all_dependees("a"), ["b"])
+        self.assertFalse(self.g.depends_on("d", "a"))
+
+class Test_Launch_Order(unittest.TestCase):
+    def setUp(self):
+        self.g = graph.DirectedGraph()
+        self.g.add_node("a")
+        self.g.add_node("b", ["a"])
+        self.g.add_node("h")
+        self.g.add_node("j")
+        self.g.add_node("i", ['h', 'j'])
+        self.g.add_node("c", ["b"])
+
+    def test_dependencies_come_first(self):
+        order = self.g.get_launch_order()
+        self.assertEqual(order, (self.g.ROOT, "a", "b", "c", "h", "j", "i"))
+
+    def test_cached_until_changed(self):
+        order = self.g.get_launch_order()
+        version = self.g.version
+        self.assertIs(self.g.get_launch_order(), order)
+        self.g.add_node("k", ["c"])
+        self.assertNotEqual(self.g.version, version)
+        order = self.g.get_launch_order()
+        self.assertEqual(order, (self.g.ROOT, "a", "b", "c", "k", "h", "j", "i"))
+        self.g.remove_node("b")
+        order = self.g.get_launch_order()
+        # c now depends on the root, and was added after j
+        self.assertEqual(order, (self.g.ROOT, "a", "h", "j", "i", "c", "k"))
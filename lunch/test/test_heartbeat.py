@@ -0,0 +1,90 @@
+"""
+Tests for the heartbeat between the master and the lunch-slaves.
+"""
+from twisted.trial import unittest
+from twisted.internet import task
+from lunch import heartbeat
+
+class Test_RTT_Histogram(unittest.TestCase):
+    def test_stats(self):
+        histogram = heartbeat.RTTHistogram(max_samples=3)
+        self.assertEqual(histogram.get_stats()["median"], None)
+        for rtt in [0.5, 0.001, 0.003, 0.004]:
+            histogram.add(rtt)
+        self.assertEqual(histogram.get_samples(), [0.001, 0.003, 0.004])
+        stats = histogram.get_stats()
+        self.assertEqual(stats["count"], 3)
+        self.assertEqual(stats["last"], 0.004)
+        self.assertEqual(stats["median"], 0.003)
+        self.assertEqual(stats["max"], 0.004)
+        buckets = dict(stats["buckets"])
+        self.assertEqual(buckets[1], 1)
+        self.assertEqual(buckets[5], 2)
+        self.assertEqual(buckets[None], 0)
+
+    def test_merged(self):
+        a = heartbeat.RTTHistogram()
+        b = heartbeat.RTTHistogram()
+        a.add(0.001)
+        b.add(0.002)
+        b.add(9.0)
+        merged = heartbeat.RTTHistogram.merged([a, b])
+        self.assertEqual(sorted(merged.get_samples()), [0.001, 0.002, 9.0])
+        self.assertEqual(dict(merged.get_buckets())[None], 1)
+
+
+class Test_Heartbeat(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pings = []
+        self.lost = []
+        self.heartbeat = heartbeat.Heartbeat(self.pings.append,
+                lambda: self.lost.append(True), idle=5.0, interval=1.0,
+                probes=3, clock=self.clock)
+        self.heartbeat.start()
+
+    def tearDown(self):
+        self.heartbeat.stop()
+
+    def test_ping_even_when_active(self):
+        self.clock.advance(4.0)
+        self.heartbeat.activity()
+        self.clock.advance(1.0)
+        self.assertEqual(self.pings, [1])
+        self.clock.advance(0.25)
+        self.assertEqual(self.heartbeat.pong_received(1), 0.25)
+        self.assertEqual(self.heartbeat.missed, 0)
+        for i in range(4):
+            self.clock.advance(1.0)
+            self.heartbeat.activity()
+        self.assertEqual(self.pings, [1])
+        self.clock.advance(1.0)
+        self.assertEqual(self.pings, [1, 2])
+
+    def test_activity_resets_missed(self):
+        self.clock.advance(5.0)
+        self.clock.advance(1.0)
+        self.assertEqual(self.heartbeat.missed, 2)
+        self.heartbeat.activity()
+        self.assertEqual(self.heartbeat.missed, 0)
+        self.clock.advance(1.0)
+        self.clock.advance(1.0)
+        self.assertEqual(self.lost, [])
+        self.assertEqual(self.pings, [1, 2, 3, 4])
+
+    def test_old_slave_pong(self):
+        self.clock.advance(5.0)
+        self.clock.advance(0.5)
+        self.assertEqual(self.heartbeat.pong_received(), 0.5)
+        self.assertEqual(self.heartbeat.pong_received(), None)
+
+    def test_lost(self):
+        self.clock.advance(5.0)
+        self.clock.advance(1.0)
+        self.clock.advance(1.0)
+        self.assertEqual(self.pings, [1, 2, 3])
+        self.assertEqual(self.lost, [])
+        self.clock.advance(1.0)
+        self.assertEqual(self.lost, [True])
+        self.assertFalse(self.heartbeat.is_running())
+        self.assertEqual(len(self.heartbeat.histogram), 0)
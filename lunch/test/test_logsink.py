@@ -0,0 +1,69 @@
+"""
+Tests for the buffered writing of the log files.
+"""
+import os
+import shutil
+import tempfile
+from twisted.trial import unittest
+from lunch import logsink
+
+class Test_Log_Sink(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sink = logsink.LogSink(max_buffer_size=64, flush_interval=10.0)
+
+    def tearDown(self):
+        d = self.sink.close()
+        d.addCallback(lambda result: shutil.rmtree(self.directory, True))
+        return d
+
+    def _read(self, name):
+        with open(os.path.join(self.directory, name)) as f:
+            return f.read()
+
+    def test_batches(self):
+        a = self.sink.open_log("a.log", self.directory)
+        b = self.sink.open_log("b.log", self.directory)
+        a.write("one\n")
+        b.write("two\n")
+        a.write("three\n")
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "a.log")))
+        def _check(result):
+            self.assertEqual(self._read("a.log"), "one\nthree\n")
+            self.assertEqual(self._read("b.log"), "two\n")
+            stats = self.sink.get_stats()
+            self.assertEqual(stats["lines_received"], 3)
+            self.assertEqual(stats["writes"], 2)
+            self.assertEqual(stats["batches_written"], 1)
+            self.assertEqual(stats["bytes_written"], 14)
+        d = self.sink.flush()
+        d.addCallback(_check)
+        return d
+
+    def test_max_buffer_size(self):
+        a = self.sink.open_log("a.log", self.directory)
+        a.write("x" * 40 + "\n")
+        self.assertEqual(self.sink.get_stats()["bytes_pending"], 41)
+        a.write("y" * 40 + "\n") # over 64 bytes: written without waiting
+        self.assertEqual(self.sink.get_stats()["bytes_pending"], 0)
+        d = self.sink.flush()
+        d.addCallback(lambda result: self.assertEqual(
+                len(self._read("a.log")), 82))
+        return d
+
+    def test_close(self):
+        a = self.sink.open_log("a.log", self.directory)
+        a.write("bye\n")
+        d = self.sink.close()
+        def _check(result):
+            self.assertTrue(a.closed)
+            self.assertEqual(self._read("a.log"), "bye\n")
+            a.write("too late\n")
+            self.assertEqual(self.sink.get_stats()["bytes_pending"], 0)
+        d.addCallback(_check)
+        return d
+
+    def test_format_time(self):
+        first = logsink.format_time(1000000000.2)
+        self.assertIs(logsink.format_time(1000000000.9), first)
+        self.assertNotEqual(logsink.format_time(1000000001.0), first)
@@ -0,0 +1,37 @@
+"""
+Tests for the placement of the children on the CPUs of their host.
+"""
+from twisted.trial import unittest
+from lunch import placement
+
+class Test_CPU_Placement(unittest.TestCase):
+    def setUp(self):
+        self.placement = placement.CPUPlacement()
+        # 4 cores with 2 hardware threads each:
+        self.placement.set_topology("host", [[0, 4], [1, 5], [2, 6], [3, 7]])
+
+    def test_whole_cores_first(self):
+        self.assertEqual(self.placement.assign("host", "a", 2), [0, 4])
+        self.assertEqual(self.placement.assign("host", "b", 1), [1])
+        # the sibling of 1 is taken before a CPU of a free core:
+        self.assertEqual(self.placement.assign("host", "c", 3), [2, 5, 6])
+        self.assertEqual(self.placement.assign("host", "d", 2), [3, 7])
+        self.assertEqual(self.placement.assign("host", "e", 1), None)
+
+    def test_kept_until_released(self):
+        self.assertEqual(self.placement.assign("host", "a", 4), [0, 1, 4, 5])
+        self.assertEqual(self.placement.assign("host", "a", 4), [0, 1, 4, 5])
+        self.assertEqual(self.placement.assign("host", "b", 6), None)
+        self.placement.release("host", "a")
+        self.assertEqual(self.placement.assign("host", "b", 6), [0, 1, 2, 4, 5, 6])
+        self.assertEqual(self.placement.get_assignments(),
+                {"host": {"b": [0, 1, 2, 4, 5, 6]}})
+
+    def test_unknown_host(self):
+        self.assertEqual(self.placement.get_topology("other"), None)
+        self.assertEqual(self.placement.assign("other", "a", 1), None)
+
+    def test_cpu_lists(self):
+        self.assertEqual(placement.parse_cpu_list("0-3,6\n"), [0, 1, 2, 3, 6])
+        self.assertEqual(placement.format_cpu_list([6, 0, 1, 2, 3]), "0-3,6")
+        self.assertEqual(placement.format_cpu_list([1, 3]), "1,3")
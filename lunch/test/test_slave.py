@@ -1,7 +1,14 @@
 """
 Test cases for the lunch-slave process.
 """
+import io
+import os
+import shutil
+import tempfile
 from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet import reactor
+from lunch import local
 
 class Test_Slave(unittest.TestCase):
     pass
@@ -32,3 +39,132 @@ class Test_Slave(unittest.TestCase):
 #    test_stop.skip = "TODO"
 #    test_help.skip = "TODO"
 #    test_quit.skip = "TODO"
+
+
+class Test_CGroup(unittest.TestCase):
+    """
+    Checks the cgroups of the children, in a fake cgroup v2 file system.
+    """
+    def setUp(self):
+        self.module = local.load_slave_module()
+        self.root = tempfile.mkdtemp()
+        self.own = os.path.join(self.root, "user.slice")
+        os.mkdir(self.own)
+        open(os.path.join(self.own, "cgroup.controllers"), "w").close()
+        self._find_own_cgroup = self.module.find_own_cgroup
+        self.module.find_own_cgroup = lambda: self.own
+        self.slave = self.module.Slave(identifier="my visualizer")
+
+    def tearDown(self):
+        self.module.find_own_cgroup = self._find_own_cgroup
+        self.slave.close()
+        shutil.rmtree(self.root, True)
+
+    def _read(self, *names):
+        with open(os.path.join(self.own, *names)) as f:
+            return f.read()
+
+    def test_children_are_siblings_of_the_slave(self):
+        cgroup = self.slave._create_cgroup(1024, 0.5)
+        self.assertEqual(self._read("lunch-slave", "cgroup.procs"), str(os.getpid()))
+        self.assertEqual(self._read("cgroup.subtree_control"), "+memory +cpu")
+        self.assertEqual(cgroup.path, os.path.join(self.own, "lunch-child-my_visualizer"))
+        self.assertEqual(self._read("lunch-child-my_visualizer", "memory.max"), "1024")
+        self.assertEqual(self._read("lunch-child-my_visualizer", "cpu.max"), "50000 100000")
+        self.assertFalse(cgroup.was_oom_killed())
+        with open(os.path.join(cgroup.path, "memory.events"), "w") as f:
+            f.write("low 0\nhigh 0\nmax 3\noom 1\noom_kill 1\n")
+        self.assertTrue(cgroup.was_oom_killed())
+        # once moved, it stays in its leaf cgroup:
+        self.module.find_own_cgroup = lambda: os.path.join(self.own, "lunch-slave")
+        self.assertEqual(self.module.move_to_leaf_cgroup(), self.own)
+
+
+class Test_Malformed_Messages(unittest.TestCase):
+    """
+    Checks that the lunch-slave answers the malformed messages with an error.
+    """
+    def setUp(self):
+        self.module = local.load_slave_module()
+        self.slave = self.module.Slave(identifier="a")
+        self.io = self.module.SlaveIO(self.slave)
+        self.io.protocol_version = 2
+        self.sent = []
+        self.io.send = lambda key, *args: self.sent.append(key)
+
+    def tearDown(self):
+        self.slave.close()
+
+    def test_malformed(self):
+        for line in [b'[{"a": 1}]', b'["start"]', b'["start", "ls"]', b'[]', b'[nope']:
+            self.io._json_line_received(line)
+        self.assertEqual(self.sent, ["error"] * 5)
+        self.assertEqual(self.slave.command, None)
+
+
+class Test_Start_Failure(unittest.TestCase):
+    """
+    Checks that a child that could not be started stays STOPPED.
+    """
+    timeout = 4.0
+
+    def setUp(self):
+        self.module = local.load_slave_module()
+        self.log_dir = tempfile.mkdtemp()
+        self.slave = self.module.Slave(command="true", identifier="failing")
+        self.slave.log_dir = self.log_dir
+        self.io = self.module.SlaveIO(self.slave)
+        self.sent = []
+        self.io.send = lambda key, *args: self.sent.append((key,) + args)
+
+    def tearDown(self):
+        self.slave.close()
+        shutil.rmtree(self.log_dir, True)
+
+    def test_bad_limits(self):
+        self.slave.limits = {"ionice": "bogus"}
+        self.slave.start_child()
+        self.assertEqual(self.slave.child_state, self.module.STATE_STOPPED)
+        self.assertEqual([message[0] for message in self.sent], ["error"])
+        self.assertIn("Could not limit the resources", self.sent[0][1])
+        self.slave.stop() # nothing to stop
+        self.slave.limits = {}
+        self.sent = []
+        self.slave.start_child()
+        self.assertEqual(self.sent[0], ("state", self.module.STATE_STARTING))
+        d = defer.Deferred()
+        def _check():
+            if self.slave.child_state != self.module.STATE_STOPPED:
+                reactor.callLater(0.05, _check)
+            else:
+                d.callback(None)
+        _check()
+        return d
+
+
+class Test_Child_Output(unittest.TestCase):
+    """
+    Checks that the output of a child is given line by line.
+    """
+    def setUp(self):
+        self.module = local.load_slave_module()
+        self.slave = self.module.Slave(identifier="output")
+        self.slave._stdout_file = io.StringIO()
+        self.lines = []
+        self.slave._probe = self # gets the lines, as the ReadinessProbe
+        self.child = self.module.ChildProcess(self.slave)
+
+    def tearDown(self):
+        self.slave.close()
+
+    def line_received(self, line):
+        self.lines.append(line)
+
+    def test_line_split_across_reads(self):
+        self.child.outReceived(b"warm")
+        self.assertEqual(self.lines, [])
+        self.child.outReceived(b"ing up\r\nready\r\n\r\nbye")
+        self.assertEqual(self.lines, ["warming up", "ready"])
+        self.child.flush()
+        self.assertEqual(self.lines, ["warming up", "ready", "bye"])
+        self.assertEqual(self.slave._stdout_file.getvalue(), "warming up\nready\nbye\n")
@@ -0,0 +1,33 @@
+"""
+Tests for the recognition of SSH errors.
+"""
+from twisted.trial import unittest
+from lunch import ssherrors
+
+class Test_SSH_Errors(unittest.TestCase):
+    def test_codes(self):
+        lines = {
+            "bob@example.org's password: ": ssherrors.SSH_ERROR_AUTH,
+            "bob@example.org: Permission denied (publickey,password).": ssherrors.SSH_ERROR_AUTH,
+            "Host key verification failed.": ssherrors.SSH_ERROR_HOST_KEY,
+            "ssh: connect to host example.org port 22: Connection refused": ssherrors.SSH_ERROR_REFUSED,
+            "kex_exchange_identification: read: Connection reset by peer": ssherrors.SSH_ERROR_REFUSED,
+            "ssh: connect to host example.org port 22: No route to host": ssherrors.SSH_ERROR_UNREACHABLE,
+            "ssh: Could not resolve hostname nowhere: Name or service not known": ssherrors.SSH_ERROR_UNREACHABLE,
+            "bash: lunch-slave: command not found": ssherrors.SSH_ERROR_MISSING_SLAVE,
+            }
+        for line, code in lines.items():
+            ssh_error = ssherrors.parse_ssh_error(line, host="example.org")
+            self.assertEqual(ssh_error.code, code, line)
+            self.assertEqual(ssh_error.retryable, code in ssherrors.RETRYABLE_ERRORS)
+            self.assertIn("example.org", ssh_error.get_description())
+
+    def test_not_an_error(self):
+        self.assertEqual(ssherrors.parse_ssh_error("ready 2"), None)
+        self.assertEqual(ssherrors.parse_ssh_error(
+                "Warning: Permanently added 'example.org' to the list of known hosts."), None)
+
+    def test_port(self):
+        ssh_error = ssherrors.parse_ssh_error("Connection refused",
+                host="example.org", port=2222)
+        self.assertIn("2222", ssh_error.get_description())
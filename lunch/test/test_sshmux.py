@@ -0,0 +1,48 @@
+"""
+Tests for the sharing of SSH connections.
+"""
+import os
+import tempfile
+from twisted.trial import unittest
+from lunch import sshmux
+
+class Test_SSH_Multiplexer(unittest.TestCase):
+    def setUp(self):
+        self.control_dir = tempfile.mkdtemp()
+        self.multiplexer = sshmux.SSHMultiplexer(self.control_dir)
+
+    def tearDown(self):
+        for name in os.listdir(self.control_dir):
+            os.remove(os.path.join(self.control_dir, name))
+        os.rmdir(self.control_dir)
+
+    def test_control_path(self):
+        path = self.multiplexer.get_control_path("bob", "example.org", 22)
+        self.assertEqual(os.path.dirname(path), self.control_dir)
+        self.assertEqual(path,
+                self.multiplexer.get_control_path("bob", "example.org", 22))
+        self.assertNotEqual(path,
+                self.multiplexer.get_control_path("bob", "example.org", 2222))
+        self.assertNotEqual(path,
+                self.multiplexer.get_control_path(None, "example.org", 22))
+
+    def test_options(self):
+        path = self.multiplexer.get_control_path(None, "example.org", None)
+        options = self.multiplexer.get_ssh_options(None, "example.org", None)
+        self.assertIn("ControlPath=%s" % (path), options)
+        self.assertIn("ControlMaster=auto", options)
+        open(path, "w").close() # as if the master connection was open
+        self.multiplexer.get_ssh_options(None, "example.org", None)
+        stats = self.multiplexer.get_stats()
+        self.assertEqual(stats["connections"], 1)
+        self.assertEqual(stats["opened"], 1)
+        self.assertEqual(stats["reused"], 1)
+
+    def test_check_without_socket(self):
+        self.multiplexer.get_ssh_options(None, "example.org", None)
+        def _cb(result):
+            self.assertEqual(result, [(True, False)])
+            self.assertEqual(self.multiplexer.get_stats()["connections"], 0)
+        d = self.multiplexer.check_all()
+        d.addCallback(_cb)
+        return d
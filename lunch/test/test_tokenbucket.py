@@ -0,0 +1,22 @@
+"""
+Tests for the token bucket of the admission control and of the restart budget.
+"""
+from twisted.trial import unittest
+from lunch import tokenbucket
+
+class Test_Token_Bucket(unittest.TestCase):
+    def test_burst(self):
+        bucket = tokenbucket.TokenBucket(1.0, 2)
+        for i in range(2):
+            self.assertTrue(bucket.has_token(0.0))
+            bucket.take(0.0)
+        self.assertFalse(bucket.has_token(0.0))
+        self.assertEqual(bucket.get_next_token_time(0.0), 1.0)
+        self.assertTrue(bucket.has_token(1.0))
+
+    def test_full(self):
+        bucket = tokenbucket.TokenBucket(1.0, 2)
+        bucket.take(0.0)
+        bucket.take(100.0) # it does not hold more than its burst
+        bucket.take(100.0)
+        self.assertFalse(bucket.has_token(100.0))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Lunch
+# Copyright (C) 2009 Société des arts technologiques (SAT)
+# http://www.sat.qc.ca
+# All rights reserved.
+#
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Lunch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Lunch.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Token bucket, to limit how many events happen each second.
+
+Used by the admission control of the lunch-slave startups and by the
+budget of restarts.
+"""
+
+
+class TokenBucket(object):
+    """
+    Allows a number of events per second, with bursts.
+    """
+    def __init__(self, rate, burst):
+        """
+        @param rate: How many tokens are earned each second.
+        @type rate: C{float}
+        @param burst: How many tokens it holds at most. It starts full.
+        @type burst: C{int}
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._tokens_time = None
+
+    def has_token(self, now):
+        self._refill(now)
+        return self._tokens >= 1.0
+
+    def take(self, now):
+        self._refill(now)
+        self._tokens -= 1.0
+
+    def get_next_token_time(self, now):
+        """
+        Returns when there will be one token.
+        @rtype: C{float}
+        """
+        self._refill(now)
+        if self._tokens >= 1.0:
+            return now
+        return now + (1.0 - self._tokens) / self.rate
+
+    def _refill(self, now):
+        """
+        Adds the tokens earned since the last time.
+        """
+        if self._tokens_time is not None and now > self._tokens_time:
+            self._tokens = min(float(self.burst),
+                    self._tokens + (now - self._tokens_time) * self.rate)
+        if self._tokens_time is None or now > self._tokens_time:
+            self._tokens_time = now
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Compares two ways of running local commands: a lunch-slave process for each
+of them, and the Slave logic running within the master process.
+
+For each way, starts many "sleep" commands and measures how long it takes
+until they are all running, and the memory (RSS) used by the master and its
+lunch-slave processes, not counting the children themselves.
+
+Usage: PATH=scripts:$PATH PYTHONPATH=. python3 utils/benchmark_local_commands.py [number of commands]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = ["lunch-slave", "in-process"]
+
+
+def get_rss_kb(pid):
+    with open("/proc/%d/status" % (pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def get_children(pid):
+    ret = []
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open("/proc/%s/stat" % (name)) as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except (IOError, IndexError):
+                continue
+            if int(fields[1]) == pid:
+                ret.append(int(name))
+    return ret
+
+
+def get_overhead(pid):
+    """
+    Returns the number of processes and RSS of the master and its
+    lunch-slave processes.
+    """
+    processes = 1
+    rss = get_rss_kb(pid)
+    for child in get_children(pid):
+        with open("/proc/%d/cmdline" % (child), "rb") as f:
+            cmdline = f.read()
+        if b"lunch-slave" in cmdline:
+            processes += 1
+            rss += get_rss_kb(child)
+    return processes, rss
+
+
+def run_one(mode, number):
+    from twisted.internet import reactor
+    from lunch import commands
+    from lunch import master
+    master.start_stdout_logging("error")
+    commands.log.setLevel("ERROR")
+    log_dir = tempfile.mkdtemp()
+    lunch_master = master.Master(log_dir=log_dir, pid_dir=log_dir,
+            launch_mode=master.LAUNCH_PARALLEL,
+            local_in_process=(mode == "in-process"))
+    started = time.perf_counter()
+    for i in range(number):
+        lunch_master.add_command(commands.Command("sleep 60",
+                identifier="sleep_%d" % (i), log_dir=log_dir, sleep_after=0))
+
+    def _check():
+        running = [c for c in lunch_master.get_all_commands()
+                if c.child_state == "RUNNING"]
+        if len(running) < number:
+            reactor.callLater(0.01, _check)
+            return
+        elapsed = time.perf_counter() - started
+        processes, rss = get_overhead(os.getpid())
+        print("%12s %10d %20.1f %12d %12.1f" % (mode, number,
+                elapsed * 1000.0, processes, rss / 1024.0))
+        sys.stdout.flush()
+        lunch_master.stop_all()
+        reactor.callLater(2.0, reactor.stop)
+
+    reactor.callLater(0, _check)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        run_one(sys.argv[2], int(sys.argv[1]))
+    else:
+        number = 500
+        if len(sys.argv) > 1:
+            number = int(sys.argv[1])
+        print("%12s %10s %20s %12s %12s" % ("mode", "commands",
+                "all running (ms)", "processes", "RSS (MiB)"))
+        for mode in MODES:
+            subprocess.call([sys.executable, __file__, str(number), mode])
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Measures the cost of writing the log files of many commands.
+
+Compares the old way of Command.log (formatting the time, writing the line
+and flushing the file, for each line) to the LogSink, which writes the lines
+in batches from a thread. The time spent on the reactor thread is what
+matters: it is time during which the master does nothing else.
+
+Usage: PYTHONPATH=. python3 utils/benchmark_log_writer.py [number of commands] [lines per command]
+"""
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import reactor
+from twisted.python import logfile
+
+from lunch import logsink
+
+
+def time_legacy(directory, num_commands, num_lines):
+    files = [logfile.LogFile("legacy-%d.log" % (i), directory)
+            for i in range(num_commands)]
+    started = time.perf_counter()
+    for line in range(num_lines):
+        for log_file in files:
+            prefix = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+            log_file.write("%s %s\n" % (prefix, "Slave default is RUNNING."))
+            log_file.flush()
+    elapsed = time.perf_counter() - started
+    for log_file in files:
+        log_file.close()
+    return elapsed
+
+
+def time_sink(directory, num_commands, num_lines):
+    """
+    @return: Time spent on the reactor thread, and the statistics of the sink.
+    """
+    sink = logsink.LogSink()
+    files = [sink.open_log("sink-%d.log" % (i), directory)
+            for i in range(num_commands)]
+    started = time.perf_counter()
+    for line in range(num_lines):
+        for log_file in files:
+            log_file.write("%s %s\n" % (logsink.format_time(), "Slave default is RUNNING."))
+    elapsed = time.perf_counter() - started
+    result = {}
+    def _done(ignored):
+        result.update(sink.get_stats())
+        reactor.stop()
+    reactor.callWhenRunning(lambda: sink.close().addCallback(_done))
+    reactor.run()
+    return elapsed, result
+
+
+def run(num_commands, num_lines):
+    directory = tempfile.mkdtemp()
+    try:
+        total = num_commands * num_lines
+        legacy = time_legacy(directory, num_commands, num_lines)
+        sink, stats = time_sink(directory, num_commands, num_lines)
+    finally:
+        shutil.rmtree(directory, True)
+    print("%d commands, %d lines each" % (num_commands, num_lines))
+    print("%-40s %12.0f lines/s on the reactor" % ("write and flush each line:", total / legacy))
+    print("%-40s %12.0f lines/s on the reactor" % ("LogSink:", total / sink))
+    print("%-40s %12d writes, %d batches, %.0f bytes/s in the thread" % ("",
+            stats["writes"], stats["batches_written"], stats["bytes_per_second"]))
+
+
+if __name__ == "__main__":
+    num_commands = 1000
+    num_lines = 20
+    if len(sys.argv) > 1:
+        num_commands = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        num_lines = int(sys.argv[2])
+    run(num_commands, num_lines)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Measures the cost of one iteration of the master's main loop.
+
+Compares the old way (walking the graph with iter_from_root_to_leaves and a
+list of visited nodes on every tick) to the cached launch order of the graph,
+when all the nodes are dirty, and to a tick when none of them is.
+No process is started: the master does not want its children to live.
+
+Usage: PYTHONPATH=. python3 utils/benchmark_main_loop.py [number of nodes ...]
+The default sizes are 100, 1000 and 10000 nodes. With 10000 nodes, a tick
+of the old walk takes a few seconds.
+"""
+import sys
+import time
+
+from lunch import commands
+from lunch import master
+
+CHAIN_LENGTH = 10 # each command depends on the previous one in its chain
+
+
+def legacy_iter_from_root_to_leaves(graph):
+    """
+    Copy of graph.iter_from_root_to_leaves as it used to be: O(n^2).
+    """
+    current = graph.ROOT
+    visited = []
+    stack = []
+    while True:
+        if current not in visited:
+            visited.append(current)
+            yield current
+            stack.append(iter(graph.get_supported_by(current)))
+        try:
+            current = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+        except IndexError:
+            break
+
+
+def legacy_main_loop(lunch_master):
+    lunch_master._time_now = time.time()
+    for current in legacy_iter_from_root_to_leaves(lunch_master.tree):
+        if current != lunch_master.tree.ROOT:
+            lunch_master._treat_node(current)
+
+
+def all_dirty_main_loop(lunch_master):
+    lunch_master._mark_all_dirty()
+    lunch_master.main_loop()
+
+
+def create_master(number_of_nodes):
+    lunch_master = master.Master(scheduler=master.SCHEDULER_POLLING)
+    lunch_master.wants_to_live = False # do not start anything
+    for i in range(number_of_nodes):
+        depends = None
+        if i % CHAIN_LENGTH != 0:
+            depends = ["node_%d" % (i - 1)]
+        lunch_master.add_command(commands.Command("true",
+                identifier="node_%d" % (i), depends=depends))
+    return lunch_master
+
+
+def time_ticks(function, lunch_master, ticks):
+    function(lunch_master) # warm up the caches
+    started = time.perf_counter()
+    for i in range(ticks):
+        function(lunch_master)
+    return (time.perf_counter() - started) / ticks
+
+
+def run(sizes):
+    print("%10s %16s %16s %16s" % ("nodes", "before (ms/tick)",
+            "after (ms/tick)", "idle (ms/tick)"))
+    for size in sizes:
+        lunch_master = create_master(size)
+        ticks = max(1, 10000 // size)
+        before = time_ticks(legacy_main_loop, lunch_master, ticks)
+        after = time_ticks(all_dirty_main_loop, lunch_master, ticks)
+        idle = time_ticks(master.Master.main_loop, lunch_master, ticks)
+        print("%10d %16.3f %16.3f %16.3f" % (size, before * 1000.0,
+                after * 1000.0, idle * 1000.0))
+        lunch_master.cleanup()
+
+
+if __name__ == "__main__":
+    master.start_stdout_logging("error")
+    commands.log.setLevel("ERROR")
+    sizes = [100, 1000, 10000]
+    if len(sys.argv) > 1:
+        sizes = [int(arg) for arg in sys.argv[1:]]
+    run(sizes)
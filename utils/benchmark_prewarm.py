@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Measures the time to RUNNING of commands, with and without pre-warmed
+lunch-slave processes.
+
+Starts a chain of "sleep" commands, each of which depends on the previous
+one, so that each child can only start sleep_after seconds after the
+previous one is running.
+The time to RUNNING of a command goes from the moment the master starts
+it until its child is running. Without pre-warming, it includes the startup
+of its lunch-slave (and of SSH, for a remote host).
+
+Usage: PATH=scripts:$PATH PYTHONPATH=. python3 utils/benchmark_prewarm.py [number of commands] [sleep_after]
+"""
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = ["cold", "prewarm"]
+
+
+def run_one(mode, number, sleep_after):
+    from twisted.internet import reactor
+    from lunch import commands
+    from lunch import master
+    master.start_stdout_logging("error")
+    commands.log.setLevel("ERROR")
+    log_dir = tempfile.mkdtemp()
+    lunch_master = master.Master(log_dir=log_dir, pid_dir=log_dir,
+            launch_mode=master.LAUNCH_PARALLEL, prewarm=(mode == "prewarm"))
+    started = time.perf_counter()
+    previous = None
+    for i in range(number):
+        depends = None
+        if previous is not None:
+            depends = [previous]
+        previous = "sleep_%d" % (i)
+        lunch_master.add_command(commands.Command("sleep 60",
+                identifier=previous, log_dir=log_dir, sleep_after=sleep_after,
+                depends=depends))
+
+    def _check():
+        times = [t for t in lunch_master.get_time_to_running().values()
+                if t is not None]
+        if len(times) < number:
+            reactor.callLater(0.01, _check)
+            return
+        elapsed = time.perf_counter() - started
+        times.sort()
+        print("%10s %10d %12.1f %12.1f %12.1f %18.1f" % (mode, number,
+                sum(times) / len(times) * 1000.0, times[len(times) // 2] * 1000.0,
+                times[-1] * 1000.0, elapsed * 1000.0))
+        sys.stdout.flush()
+        lunch_master.stop_all()
+        reactor.callLater(2.0, reactor.stop)
+
+    reactor.callLater(0, _check)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3:
+        run_one(sys.argv[3], int(sys.argv[1]), float(sys.argv[2]))
+    else:
+        number = 10
+        sleep_after = 0.5
+        if len(sys.argv) > 1:
+            number = int(sys.argv[1])
+        if len(sys.argv) > 2:
+            sleep_after = float(sys.argv[2])
+        print("%10s %10s %12s %12s %12s %18s" % ("mode", "commands",
+                "mean (ms)", "median (ms)", "max (ms)", "all running (ms)"))
+        for mode in MODES:
+            subprocess.call([sys.executable, __file__, str(number),
+                    str(sleep_after), mode])
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Measures how many messages per second the master can parse and dispatch,
+with the text protocol (version 1) and the JSON-lines one (version 2).
+
+Also measures the lunch-slave side, which parses the messages from the
+master, and the number of messages needed to start a child.
+
+Usage: PATH=scripts:$PATH PYTHONPATH=. python3 utils/benchmark_protocol.py [number of messages]
+"""
+import json
+import sys
+import time
+
+from lunch import commands
+from lunch import local
+
+# What a lunch-slave sends the most:
+SLAVE_MESSAGES = [
+    ("log", "DEBUG", "child state: RUNNING"),
+    ("child_pid", 1234),
+    ("ok",),
+    ("pong",),
+    ("msg", "Using sleep 30 as a command to run."),
+    ]
+
+
+class _NullTransport(object):
+    disconnecting = False
+
+    def write(self, data):
+        pass
+
+    def writeSequence(self, data):
+        pass
+
+
+def format_line(version, message):
+    if version >= 2:
+        return json.dumps(list(message))
+    return " ".join([str(item) for item in message])
+
+
+def time_master(version, number):
+    command = commands.Command("sleep 30", identifier="bench")
+    command.protocol_version = version
+    command.log = lambda *args: None # do not count the logging
+    lines = [format_line(version, SLAVE_MESSAGES[i % len(SLAVE_MESSAGES)])
+            for i in range(number)]
+    started = time.perf_counter()
+    for line in lines:
+        command._received_message(line)
+    return number / (time.perf_counter() - started)
+
+
+def time_slave(version, number):
+    module = local.load_slave_module()
+    slave_io = module.SlaveIO(module.Slave(identifier="bench"))
+    slave_io.makeConnection(_NullTransport())
+    slave_io.protocol_version = version
+    if version >= 2:
+        line = b'["ping"]'
+    else:
+        line = b"ping"
+    started = time.perf_counter()
+    for i in range(number):
+        slave_io.lineReceived(line)
+    elapsed = time.perf_counter() - started
+    slave_io.slave.close()
+    return number / elapsed
+
+
+def count_startup_messages(version):
+    command = commands.Command("sleep 30", identifier="bench",
+            env={"GREETING": "hello world"})
+    sent = []
+    command.shared_slave = type("_Recorder", (object,), {
+            "send": lambda self, identifier, data: sent.append(data)})()
+    command.log = lambda *args: None
+    command.recv_ready(str(version))
+    return len(sent)
+
+
+def run(number):
+    print("%10s %20s %20s %18s" % ("protocol", "master (msg/s)",
+            "lunch-slave (msg/s)", "startup messages"))
+    for version in [1, 2]:
+        print("%10d %20.0f %20.0f %18d" % (version,
+                time_master(version, number), time_slave(version, number),
+                count_startup_messages(version)))
+
+
+if __name__ == "__main__":
+    number = 100000
+    if len(sys.argv) > 1:
+        number = int(sys.argv[1])
+    run(number)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Measures how long it takes to open SSH sessions to a host, with a new
+connection each time, and sharing one master connection like the lunch
+master does with --ssh-multiplex.
+
+You need a SSH server on that host, and a key that lets you in without a
+password.
+
+Usage: PYTHONPATH=. python3 utils/benchmark_ssh_multiplexing.py [host [number of sessions]]
+"""
+import subprocess
+import sys
+import tempfile
+import time
+
+from lunch import sshmux
+
+
+def time_sessions(host, sessions, options):
+    started = time.perf_counter()
+    for i in range(sessions):
+        subprocess.check_call(["ssh", "-o", "BatchMode=yes"] + options
+                + [host, "true"])
+    return (time.perf_counter() - started) / sessions
+
+
+def run(host, sessions):
+    control_dir = tempfile.mkdtemp()
+    multiplexer = sshmux.SSHMultiplexer(control_dir)
+    without = time_sessions(host, sessions, [])
+    with_mux = time_sessions(host, sessions,
+            multiplexer.get_ssh_options(None, host, None))
+    control_path = multiplexer.get_control_path(None, host, None)
+    subprocess.call(["ssh", "-S", control_path, "-O", "exit", host])
+    print("%10s %20s %20s" % ("sessions", "new (ms/session)",
+            "shared (ms/session)"))
+    print("%10d %20.1f %20.1f" % (sessions, without * 1000.0,
+            with_mux * 1000.0))
+
+
+if __name__ == "__main__":
+    host = "localhost"
+    sessions = 20
+    if len(sys.argv) > 1:
+        host = sys.argv[1]
+    if len(sys.argv) > 2:
+        sessions = int(sys.argv[2])
+    run(host, sessions)